@@ -1,39 +1,350 @@
+import csv
+import hashlib
+import json
+import math
+import mimetypes
 import os
+import re
+import shutil
+import socket
 import sqlite3
+import stat
+import subprocess
+import sys
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict, namedtuple
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from functools import wraps
+from io import BytesIO
+from time import perf_counter
+from urllib.parse import urlsplit
+import click
 from flask import Flask, jsonify, render_template, redirect, url_for, flash, request, send_from_directory, abort, g
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestedRangeNotSatisfiable, ServiceUnavailable, TooManyRequests
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, FileField
 from wtforms.validators import DataRequired, EqualTo, Length
 from uuid import uuid4
+from compression import asset_url, asset_version, init_compression
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow 是可选依赖，只有图片优化和相似图片检测用到
+    Image = None
+try:
+    import numpy as np
+except ImportError:  # 相似图片检测需要 NumPy
+    np = None
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，导入文件时 reflink 退回为复制
+    fcntl = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key_here'  # 请替换为您的密钥
 app.config['UPLOAD_FOLDER_IMAGES'] = os.path.join('static', 'uploads', 'images')
 app.config['UPLOAD_FOLDER_VIDEOS'] = os.path.join('static', 'uploads', 'videos')
+app.config['UPLOAD_FOLDER_POSTERS'] = os.path.join('static', 'uploads', 'posters')  # 视频封面，由后台处理生成
+app.config['UPLOAD_FOLDER_VARIANTS'] = os.path.join('static', 'uploads', 'variants')  # 图片优化后的版本
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB
+app.config['UPLOAD_FSYNC'] = 'none'  # 上传保存后的刷盘策略：none 交给操作系统；file 刷文件内容；file+dir 再刷目录，断电也不丢已确认的上传
 app.config['DATABASE'] = os.path.join(app.root_path, 'database.db')  # 数据库文件路径
+app.config['METRICS_ENABLED'] = False  # 开启后记录请求和各环节耗时，并提供 /metrics 接口
+app.config['SLOW_QUERY_LOG'] = False  # 开启后统计每条 SQL 的耗时，超过阈值的写入日志并附带执行计划
+app.config['SLOW_QUERY_THRESHOLD_MS'] = 100  # 慢查询阈值（毫秒）
+app.config['ADMIN_USERS'] = set()  # 可以访问 /admin/ 下管理接口的用户名
+app.config['PROFILER_ENABLED'] = False  # 开启后管理员可以采样分析 CPU 热点
+app.config['PROFILER_MAX_SECONDS'] = 30  # 单次采样的最长时间
+app.config['FFMPEG_PATH'] = None   # 为 None 时在 PATH 中查找 ffmpeg / ffprobe，找不到则跳过视频处理
+app.config['FFPROBE_PATH'] = None
+app.config['VIDEO_WORKERS'] = 2   # 同时处理的视频数
+app.config['VIDEO_TIMEOUT'] = 120  # 单个 ffmpeg / ffprobe 命令的超时秒数
+app.config['HLS_ENABLED'] = False  # 开启后视频处理完成时自动转码为多档码率的 HLS
+app.config['HLS_LADDER'] = [(1080, 5000, 192), (720, 2800, 128), (480, 1400, 128), (360, 800, 96)]  # (高度, 视频 kbps, 音频 kbps)
+app.config['HLS_SEGMENT_SECONDS'] = 6
+app.config['HLS_WORKERS'] = 1  # 每个进程同时进行的转码数
+app.config['HLS_TIMEOUT'] = 3600  # 单个视频转码的超时秒数
+app.config['IMAGE_OPTIMIZE'] = False  # 开启后上传的图片在后台去除元数据、重新编码，并生成 WebP / AVIF 版本（需要 Pillow）
+app.config['IMAGE_QUALITY'] = 82  # JPEG 和有损 WebP / AVIF 的编码质量
+app.config['IMAGE_FORMATS'] = ('webp', 'avif')  # 额外尝试生成的格式，Pillow 不支持的会跳过
+app.config['IMAGE_WORKERS'] = 2
+app.config['IMAGE_HASH_ENABLED'] = True  # 为上传的图片计算感知哈希，用于查找相似图片（需要 Pillow 和 NumPy）
+app.config['ORPHAN_FOLDER'] = 'orphans'  # flask reconcile --repair 把没有记录的上传文件移到这里，不在 static 下以免被访问
+app.config['RECONCILE_CHECKPOINT'] = os.path.join(app.root_path, 'reconcile-checkpoint.json')  # 对账进度，用于中断后继续
+app.config['MEDIA_CACHE_SIZE'] = 10000  # 每类文件元数据缓存的最大条目数，0 表示不缓存
+app.config['USER_CACHE_SIZE'] = 10000  # 用户和文件列表缓存的最大条目数，0 表示不缓存
+app.config['CACHE_BACKEND'] = 'local'  # local：每个进程各自缓存；sqlite / redis：多个 worker 共享缓存，失效时通知所有进程
+app.config['CACHE_PATH'] = os.path.join(app.root_path, 'cache.db')  # sqlite 后端的缓存文件，放在 /dev/shm 上更快
+app.config['CACHE_URL'] = 'redis://localhost:6379/0'  # redis 后端的地址，格式 redis://[:密码@]主机:端口/库
+app.config['CACHE_TTL'] = 3600  # 共享缓存条目的有效期（秒）
+app.config['CACHE_SYNC_INTERVAL'] = 1.0  # sqlite 后端检查失效记录的间隔（秒）
+app.config['CACHE_TIMEOUT'] = 1.0  # 访问共享缓存的超时（秒），出错时按未命中处理
+app.config['CACHE_LOCAL_TTL'] = 60  # 进程内缓存条目的最长保留秒数，限制错过失效通知（如命令行工具修改数据）时返回旧数据的时间
+app.config['COMPRESS_ENABLED'] = True  # 按 Accept-Encoding 用 brotli / gzip 压缩页面和 JSON
+app.config['COMPRESS_MIN_SIZE'] = 1024  # 小于这个字节数的响应不压缩
+app.config['COMPRESS_LEVEL'] = 6  # 页面和 JSON 的 gzip 压缩级别；brotli 固定使用 quality 5
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 3600  # /assets/ 下带指纹的静态资源的缓存时间（秒）
+app.config['HLS_JS_URL'] = None  # hls.js 地址，为 None 时使用 static/vendor/hls/hls.min.js；都没有时浏览器直接播放原视频
+app.config['RATE_LIMIT_ENABLED'] = False  # 开启后搜索、登录、注册、上传按用户和 IP 限流，超出时返回 429
+app.config['RATE_LIMIT_IP'] = (5, 150)  # 每个 IP 的令牌桶：(每秒补充的令牌数, 最多攒下的令牌数)
+app.config['RATE_LIMIT_USER'] = (2, 60)  # 每个登录用户的令牌桶
+app.config['RATE_LIMIT_COSTS'] = {'search': 5, 'login': 5, 'register': 10, 'upload': 2}  # 每次请求消耗的令牌数
+app.config['HEAVY_CONCURRENCY'] = 0  # 每个进程同时执行搜索、登录等 CPU 密集请求的上限，超出时立即返回 503；0 表示不限
+app.config['ASGI_THREADS'] = 32  # 以 asgi.py 运行时用于磁盘、数据库读写和普通 Flask 请求的线程数
 
 # 允许的文件扩展名
 ALLOWED_EXTENSIONS_IMAGES = {'png', 'jpg', 'jpeg', 'gif'}
 ALLOWED_EXTENSIONS_VIDEOS = {'mp4', 'avi', 'mov', 'mkv'}
 
-# 确保上传文件夹存在
-os.makedirs(app.config['UPLOAD_FOLDER_IMAGES'], exist_ok=True)
-os.makedirs(app.config['UPLOAD_FOLDER_VIDEOS'], exist_ok=True)
-
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+############### 性能统计 ###############
+# 关闭时 span() 直接返回空上下文，请求钩子也只做一次配置判断，几乎没有开销。
+# 统计数据保存在进程内，多 worker 部署时每个 worker 各自统计。
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+metrics_lock = threading.Lock()
+request_histograms = {}  # (endpoint, method, status) -> Histogram
+span_histograms = {}     # 环节名 -> Histogram
+
+def observe(store, key, seconds):
+    with metrics_lock:
+        hist = store.get(key)
+        if hist is None:
+            hist = store[key] = Histogram()
+        hist.observe(seconds)
+
+class _Span:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        observe(span_histograms, self.name, perf_counter() - self.start)
+
+def span(name):
+    if not app.config['METRICS_ENABLED']:
+        return nullcontext()
+    return _Span(name)
+
+@app.before_request
+def start_request_timer():
+    if app.config['METRICS_ENABLED']:
+        g.request_start = perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        key = (request.endpoint or 'unknown', request.method, response.status_code)
+        observe(request_histograms, key, perf_counter() - start)
+    return response
+
+def _format_histograms(lines, metric, store, label_names):
+    for key, hist in sorted(store.items(), key=lambda item: str(item[0])):
+        values = key if isinstance(key, tuple) else (key,)
+        labels = ','.join(f'{n}="{v}"' for n, v in zip(label_names, values))
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), hist.counts):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{{labels}}} {hist.sum:.6f}')
+        lines.append(f'{metric}_count{{{labels}}} {hist.count}')
+
+@app.route('/metrics')
+def metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    lines = ['# HELP http_request_duration_seconds Request latency by endpoint.',
+             '# TYPE http_request_duration_seconds histogram']
+    with metrics_lock:
+        _format_histograms(lines, 'http_request_duration_seconds', request_histograms, ('endpoint', 'method', 'status'))
+        lines += ['# HELP app_span_duration_seconds Time spent in sqlite, templates, search scoring and file sends.',
+                  '# TYPE app_span_duration_seconds histogram']
+        _format_histograms(lines, 'app_span_duration_seconds', span_histograms, ('span',))
+    return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+#########################################
+
 ############### 数据库部分 ###############
 
+class TimedCursor:
+    # 包装 sqlite3 游标，不提前取出结果：语句耗时为 execute 加上之后每次取数的时间，
+    # 结果取完或 close() 时记录一次。只取一行就丢弃的游标在 __del__ 中只把耗时交给连接，
+    # 由连接在所属线程执行下一条语句或关闭时记录；垃圾回收可能发生在别的线程或连接关闭之后，
+    # 所以 __del__ 里不碰数据库，连接已关闭时什么也不做
+    def __init__(self, timed_conn, cursor, sql, params, elapsed):
+        self.lastrowid = cursor.lastrowid
+        self.rowcount = cursor.rowcount
+        self.description = cursor.description
+        self._timed_conn = timed_conn
+        self._cursor = cursor
+        self._sql = sql
+        self._params = params
+        self._elapsed = elapsed
+        self._recorded = False
+        if cursor.description is None:
+            self._finish()  # 不返回结果的语句在 execute 时已经执行完
+
+    def _finish(self):
+        if not self._recorded:
+            self._recorded = True
+            self._timed_conn._record(self._sql, self._params, self._elapsed)
+
+    def _timed(self, method, *args):
+        start = perf_counter()
+        result = method(*args)
+        self._elapsed += perf_counter() - start
+        return result
+
+    def fetchone(self):
+        row = self._timed(self._cursor.fetchone)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=1):
+        rows = self._timed(self._cursor.fetchmany, size)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._cursor.fetchall)
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self._finish()
+        self._cursor.close()
+
+    def __del__(self):
+        if not self._recorded and not self._timed_conn.closed:
+            self._recorded = True
+            self._timed_conn._deferred.append((self._sql, self._params, self._elapsed))
+
+# 按语句汇总的耗时：SQL -> [次数, 总耗时, 最大耗时, 慢查询次数]
+query_stats = {}
+
+def redact_params(params):
+    # 日志里只保留参数的类型和长度，不记录具体值
+    if isinstance(params, dict):
+        return {k: redact_params([v])[0] for k, v in params.items()}
+    redacted = []
+    for value in params:
+        if isinstance(value, (str, bytes)):
+            redacted.append(f'<{type(value).__name__}:{len(value)}>')
+        else:
+            redacted.append(f'<{type(value).__name__}>')
+    return redacted
+
+def record_query(conn, sql, params, elapsed):
+    key = ' '.join(sql.split())
+    slow = elapsed * 1000 >= app.config['SLOW_QUERY_THRESHOLD_MS']
+    with metrics_lock:
+        stats = query_stats.get(key)
+        if stats is None:
+            stats = query_stats[key] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        stats[3] += slow
+    if slow and params is not None:
+        try:
+            plan = conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+            plan = '\n'.join(f'  {row[3]}' for row in plan)
+        except sqlite3.Error as e:
+            plan = f'  (无法获取执行计划: {e})'
+        app.logger.warning('慢查询 %.1fms: %s 参数=%s\n%s', elapsed * 1000, key, redact_params(params), plan)
+
+class TimedConnection:
+    # 开启统计或慢查询日志时包在 sqlite3 连接外面，记录每条语句的耗时
+    def __init__(self, conn):
+        self._conn = conn
+        self._open = weakref.WeakSet()  # 还没有记录的游标，关闭连接时补记
+        self._deferred = []  # 被丢弃的游标留下的 (sql, 参数, 耗时)
+        self.closed = False
+
+    def _flush(self):
+        while self._deferred:
+            self._record(*self._deferred.pop())
+
+    def _record(self, sql, params, elapsed):
+        if app.config['METRICS_ENABLED']:
+            observe(span_histograms, 'sqlite', elapsed)
+        if app.config['SLOW_QUERY_LOG']:
+            record_query(self._conn, sql, params, elapsed)
+
+    def execute(self, sql, params=()):
+        self._flush()
+        start = perf_counter()
+        cursor = TimedCursor(self, self._conn.execute(sql, params), sql, params, perf_counter() - start)
+        if not cursor._recorded:
+            self._open.add(cursor)
+        return cursor
+
+    def executemany(self, sql, seq):
+        start = perf_counter()
+        cursor = self._conn.executemany(sql, seq)
+        self._record(sql, None, perf_counter() - start)
+        return cursor
+
+    def executescript(self, script):
+        with span('sqlite'):
+            return self._conn.executescript(script)
+
+    def close(self):
+        for cursor in list(self._open):
+            cursor._finish()
+        self._flush()
+        self.closed = True
+        self._conn.close()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
 def get_db():
+    if not storage_ready:
+        init_storage()
     if 'db' not in g:
-        g.db = sqlite3.connect(app.config['DATABASE'])
-        g.db.row_factory = sqlite3.Row  # 使查询结果支持字典访问
+        db = sqlite3.connect(app.config['DATABASE'])
+        db.row_factory = sqlite3.Row  # 使查询结果支持字典访问
+        timed = app.config['METRICS_ENABLED'] or app.config['SLOW_QUERY_LOG']
+        g.db = TimedConnection(db) if timed else db
     return g.db
 
 @app.teardown_appcontext
@@ -42,30 +353,694 @@ def close_db(exception):
     if db is not None:
         db.close()
 
+# 建表语句全部是 IF NOT EXISTS，放在 BEGIN IMMEDIATE 事务里执行：
+# 多个进程同时启动时由 SQLite 的写锁串行化，重复执行也没有副作用
 def init_db():
-    db = get_db()
-    with app.open_resource('schema.sql', mode='r', encoding='utf-8') as f:
-        db.executescript(f.read())
-    db.commit()
+    with app.open_resource('schema.sql') as f:
+        schema = f.read().decode('utf-8')
+    db = sqlite3.connect(app.config['DATABASE'], timeout=30)
+    try:
+        db.executescript('BEGIN IMMEDIATE;\n' + schema + '\nCOMMIT;')
+    finally:
+        db.close()
+
+storage_ready = False
+storage_lock = threading.Lock()
+
+# 创建上传目录和数据库表，每个进程只执行一次
+def init_storage():
+    global storage_ready
+    with storage_lock:
+        if storage_ready:
+            return
+        os.makedirs(app.config['UPLOAD_FOLDER_IMAGES'], exist_ok=True)
+        os.makedirs(app.config['UPLOAD_FOLDER_VIDEOS'], exist_ok=True)
+        os.makedirs(app.config['UPLOAD_FOLDER_POSTERS'], exist_ok=True)
+        os.makedirs(app.config['UPLOAD_FOLDER_VARIANTS'], exist_ok=True)
+        init_db()
+        storage_ready = True
+
+@app.cli.command('init-db')
+def init_db_command():
+    """创建上传目录和数据库表"""
+    init_storage()
+    print('数据库已初始化')
+
+#########################################
+
+############### 上传目录分片 ###############
+# 单个目录里有上百万个文件时查找、备份和列目录都很慢。上传文件按文件名开头的 4 个
+# 十六进制字符（即 uuid 前缀）分两级存放，如 images/3f/a2/3fa2..._cat.jpg；不以十六进制
+# 开头的文件名改用其哈希值。封面、优化版本和 HLS 目录的名字都以原文件名开头，自然落在
+# 同一个分片里。迁移完成前旧文件仍在根目录，读取时先找分片目录，再找根目录。
+# 上传的文件先写入同一目录的临时文件，写完（按 UPLOAD_FSYNC 刷盘）后再改名为正式文件名。
+
+SHARD_NAME = re.compile(r'[0-9a-f]{2}')
+HEX_PREFIX = re.compile(r'[0-9a-f]{4}')
+
+def shard_dir(filename):
+    prefix = filename[:4]
+    if not HEX_PREFIX.fullmatch(prefix):
+        prefix = hashlib.md5(filename.encode('utf-8')).hexdigest()[:4]
+    return os.path.join(prefix[:2], prefix[2:])
+
+def upload_relpath(folder, filename):
+    """文件在 folder 中的相对路径。先查分片目录，再查根目录；都不存在时返回分片路径，
+    这样迁移工具恰好在两次检查之间移走文件时也能找到"""
+    sharded = os.path.join(shard_dir(filename), filename)
+    if os.path.lexists(os.path.join(folder, sharded)) or not os.path.lexists(os.path.join(folder, filename)):
+        return sharded
+    return filename
+
+def upload_path(folder, filename):
+    return os.path.join(folder, upload_relpath(folder, filename))
+
+def new_upload_path(folder, filename):
+    """新文件的保存路径，总是在分片目录中"""
+    directory = os.path.join(folder, shard_dir(filename))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+def fsync_dir(directory):
+    """让目录中新建、改名的条目落盘；Windows 不能打开目录，跳过"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_upload_file(f):
+    """按 UPLOAD_FSYNC 把写完的上传文件刷到磁盘，需要在改名之前调用"""
+    if app.config['UPLOAD_FSYNC'] in ('file', 'file+dir'):
+        f.flush()
+        os.fsync(f.fileno())
+
+def sync_upload_dir(path):
+    """按 UPLOAD_FSYNC 让改名后的目录项落盘，之后才能把上传视为成功"""
+    if app.config['UPLOAD_FSYNC'] == 'file+dir':
+        fsync_dir(os.path.dirname(path))
+
+def atomic_save(stream, path):
+    """先写入同目录的隐藏临时文件，写完再改名为 path。并发读取的请求看不到写了一半的
+    文件，中途出错或进程崩溃时只留下以点开头的临时文件，对账时会跳过"""
+    tmp_path = os.path.join(os.path.dirname(path), f'.tmp-{uuid4().hex}')
+    try:
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(stream, f, 64 * 1024)
+            sync_upload_file(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    sync_upload_dir(path)
+
+def migrate_to_shard(folder, name):
+    src = os.path.join(folder, name)
+    dst = new_upload_path(folder, name)
+    if os.path.isdir(src):
+        os.rename(src, dst)
+        return
+    # 先建硬链接再删除旧路径，移动过程中文件始终至少在一个位置可以访问
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        pass  # 上次迁移在两步之间中断
+    except OSError:
+        os.replace(src, dst)  # 文件系统不支持硬链接
+        return
+    os.unlink(src)
+
+@app.cli.command('shard-uploads')
+@click.option('--rate', default=500, show_default=True, help='每秒最多移动的文件数，0 表示不限制')
+def shard_uploads_command(rate):
+    """把上传目录根目录中的旧文件移到分片目录，服务不需要停止"""
+    limiter = RateLimiter(rate)
+    for key in ('IMAGES', 'VIDEOS', 'POSTERS', 'VARIANTS'):
+        folder = app.config[f'UPLOAD_FOLDER_{key}']
+        moved, failed = 0, set()
+        while True:
+            # 每次只取一批，移走后重新列目录，避免边遍历边修改目录
+            batch = []
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.') or entry.name in failed:
+                        continue
+                    if entry.is_file(follow_symlinks=False) or (
+                            entry.name.endswith('_hls') and entry.is_dir(follow_symlinks=False)):
+                        batch.append(entry.name)
+                        if len(batch) >= RECONCILE_PAGE:
+                            break
+            if not batch:
+                break
+            for name in batch:
+                limiter.wait()
+                try:
+                    migrate_to_shard(folder, name)
+                    moved += 1
+                except OSError as e:
+                    print(f'移动失败 {folder}/{name}: {e}')
+                    failed.add(name)
+        print(f'{folder}: 移动 {moved} 个，失败 {len(failed)} 个')
+
+#########################################
+
+############### 缓存 ###############
+# 默认每个进程各自在内存中缓存（LRU）。多 worker 部署时，CACHE_BACKEND 设为 sqlite 或
+# redis 后缓存内容保存在共享存储中（值以 JSON 保存），各进程在本地保留最近用过的副本。
+# 任何进程（包括命令行工具）清除一个条目时都会通知所有进程丢弃本地副本：
+#   sqlite：失效记录写入 cache_invalidations 表，各进程至多每 CACHE_SYNC_INTERVAL 秒读取一次
+#   redis：通过 PUBLISH 广播，各进程的订阅线程收到后立即丢弃；断线期间不保留本地副本
+# 共享存储出错时记录日志并按未命中处理，请求照常从数据库和磁盘读取。
+# 读数据库和写回缓存之间可能有其他请求清除了同一个条目，写回的就是旧值：
+#   本进程内：每次清除（含收到的通知）使缓存的 generation 加一，写回前 generation 变了就放弃；
+#   共享存储：清除时写入一个 CACHE_INVALIDATION_HOLD 秒的空值占位，期间不接受写回；
+#   清除共享条目失败时记下来，之后每次访问缓存前重试，重试成功前不从共享存储读取该条目。
+# 本地副本最多保留 CACHE_LOCAL_TTL 秒，错过通知时也不会一直返回旧数据。
+# 限流的令牌桶也保存在同一个共享存储中（见“限流”一节）。
+
+class CacheError(Exception):
+    pass
+
+CACHE_ERRORS = (OSError, sqlite3.Error, CacheError)
+
+CACHE_INVALIDATION_HOLD = 10  # 共享条目清除后拒绝写回的秒数，挡住清除之前从数据库读出的旧值
+
+class LRUCache:
+    def __init__(self, config_key):
+        self.config_key = config_key
+        self.data = OrderedDict()  # 键 -> (值, 过期时刻)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.monotonic():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value):
+        limit = app.config[self.config_key]
+        if limit <= 0:
+            return
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + app.config['CACHE_LOCAL_TTL'])
+            self.data.move_to_end(key)
+            while len(self.data) > limit:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+def gcra(tat, now, cost, interval, tolerance):
+    """令牌桶的 GCRA 实现，只需保存一个时间戳 tat（桶重新装满的时刻）。
+    返回 (需要等待的秒数, 新的 tat)，等待为 0 表示放行"""
+    tat = max(tat or now, now)
+    new_tat = tat + cost * interval
+    wait = new_tat - tolerance - now
+    if wait > 0:
+        return wait, tat
+    return 0, new_tat
+
+def gcra_all(buckets, tats, now, cost):
+    """同时从多个令牌桶取令牌，buckets 为 [(键, interval, tolerance)]，tats 为各桶当前的 tat。
+    返回 (需要等待的秒数, 各桶新的 tat)；只要有一个桶不够就要等待，这时调用方一个桶都不扣"""
+    wait, new_tats = 0, []
+    for (key, interval, tolerance), tat in zip(buckets, tats):
+        bucket_wait, tat = gcra(tat, now, cost, interval, tolerance)
+        wait = max(wait, bucket_wait)
+        new_tats.append(tat)
+    return wait, new_tats
+
+class SQLiteCacheBackend:
+    """本机多进程共享的缓存，保存在一个 SQLite 文件中（WAL + mmap）"""
+    keep_local = True
+
+    def __init__(self, path, on_invalidate):
+        self.path = path
+        self.on_invalidate = on_invalidate
+        self.local = threading.local()
+        self.sync_lock = threading.Lock()
+        self.next_sync = 0
+        self.writes = 0
+        self.cursor = self._db().execute('SELECT coalesce(max(id), 0) FROM cache_invalidations').fetchone()[0]
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=app.config['CACHE_TIMEOUT'], isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')  # 缓存丢了可以重建，不需要落盘
+            db.execute('PRAGMA mmap_size=67108864')
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS cache_invalidations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, created REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tat REAL NOT NULL);
+            """)
+            self.local.db = db
+        return db
+
+    def get(self, key):
+        row = self._db().execute('SELECT value FROM cache WHERE key = ? AND expires > ?', (key, time.time())).fetchone()
+        return row[0] if row and row[0] else None  # 空字符串是清除后的占位
+
+    def set(self, key, value):
+        now = time.time()
+        db = self._db()
+        # 清除占位还没过期时不写入
+        db.execute('''INSERT INTO cache (key, value, expires) VALUES (?, ?, ?)
+                      ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires
+                      WHERE cache.value != '' OR cache.expires <= ?''',
+                   (key, value, now + app.config['CACHE_TTL'], now))
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            # 过期条目和一小时前的失效记录不再有用；各进程每秒都会读取失效记录，不会错过
+            db.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+            db.execute('DELETE FROM cache_invalidations WHERE created < ?', (now - 3600,))
+            db.execute('DELETE FROM rate_limits WHERE tat < ?', (now,))
+
+    def delete(self, key):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            db.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                       (key, '', now + CACHE_INVALIDATION_HOLD))
+            db.execute('INSERT INTO cache_invalidations (key, created) VALUES (?, ?)', (key, now))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def take(self, buckets, cost):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            tats = []
+            for key, _, _ in buckets:
+                row = db.execute('SELECT tat FROM rate_limits WHERE key = ?', (key,)).fetchone()
+                tats.append(row[0] if row else None)
+            wait, tats = gcra_all(buckets, tats, now, cost)
+            if not wait:
+                db.executemany('INSERT OR REPLACE INTO rate_limits (key, tat) VALUES (?, ?)',
+                               [(key, tat) for (key, _, _), tat in zip(buckets, tats)])
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return wait
+
+    def sync(self):
+        """读取其他进程写入的失效记录，丢弃对应的本地副本"""
+        now = time.monotonic()
+        if now < self.next_sync:
+            return
+        with self.sync_lock:
+            if now < self.next_sync:
+                return
+            self.next_sync = now + app.config['CACHE_SYNC_INTERVAL']
+            rows = self._db().execute('SELECT id, key FROM cache_invalidations WHERE id > ? ORDER BY id',
+                                      (self.cursor,)).fetchall()
+            for row_id, key in rows:
+                self.on_invalidate(key)
+                self.cursor = row_id
+
+def redis_command(*args):
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        arg = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+def redis_reply(f):
+    line = f.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('Redis 连接已断开')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest
+    if kind == b'-':
+        raise CacheError(rest.decode('utf-8', 'replace'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        if int(rest) < 0:
+            return None
+        data = f.read(int(rest) + 2)
+        if len(data) != int(rest) + 2:
+            raise ConnectionError('Redis 连接已断开')
+        return data[:-2]
+    if kind == b'*':
+        return None if int(rest) < 0 else [redis_reply(f) for _ in range(int(rest))]
+    raise CacheError(f'无法解析的 Redis 回复: {line[:50]!r}')
 
-# 在应用启动时检查数据库是否存在，如不存在则初始化
-if not os.path.exists(app.config['DATABASE']):
-    init_db()
+class RedisCacheBackend:
+    """通过 Redis 协议共享的缓存，只用到 GET / SET / PUBLISH / SUBSCRIBE 和 WATCH / MULTI / EXEC，兼容 Redis 和 Valkey 等实现"""
+    PREFIX = 'cache:'
+    CHANNEL = 'cache:invalidate'
+
+    def __init__(self, url, on_invalidate):
+        parts = urlsplit(url)
+        self.address = (parts.hostname or 'localhost', parts.port or 6379)
+        self.password = parts.password
+        self.database = int(parts.path.strip('/') or 0)
+        self.on_invalidate = on_invalidate
+        self.local = threading.local()
+        self.retry_at = 0  # 连接失败后 1 秒内不再尝试，避免每个请求都等待连接超时
+        self.keep_local = False  # 订阅成功后才保留本地副本，否则收不到失效通知
+        threading.Thread(target=self._listen, name='cache-invalidate', daemon=True).start()
+
+    def _connect(self, subscribe=False):
+        sock = socket.create_connection(self.address, timeout=app.config['CACHE_TIMEOUT'])
+        f = sock.makefile('rwb')
+        if self.password:
+            self._call(f, 'AUTH', self.password)
+        if self.database:
+            self._call(f, 'SELECT', self.database)
+        if subscribe:
+            # 订阅连接长时间没有数据是正常的，靠 TCP keepalive 发现对端已经不在
+            sock.settimeout(None)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 10)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        return f
+
+    def _call(self, f, *args):
+        f.write(redis_command(*args))
+        f.flush()
+        return redis_reply(f)
+
+    def call(self, *args):
+        f = getattr(self.local, 'conn', None)
+        if f is None:
+            if time.monotonic() < self.retry_at:
+                raise CacheError('Redis 暂时不可用')
+            try:
+                f = self.local.conn = self._connect()
+            except OSError:
+                self.retry_at = time.monotonic() + 1
+                raise
+        try:
+            return self._call(f, *args)
+        except (OSError, ConnectionError):
+            # 连接出错后状态未知，丢弃连接，下次重新建立
+            self.local.conn = None
+            f.close()
+            raise
+
+    def get(self, key):
+        value = self.call('GET', self.PREFIX + key)
+        return value.decode('utf-8') if value else None  # 空值是清除后的占位
+
+    def set(self, key, value):
+        # 清除占位还在时不写入；读和写之间被清除时 EXEC 返回空，同样放弃
+        key = self.PREFIX + key
+        self.call('WATCH', key)
+        if self.call('GET', key) == b'':
+            self.call('UNWATCH')
+            return
+        self.call('MULTI')
+        self.call('SET', key, value, 'EX', app.config['CACHE_TTL'])
+        self.call('EXEC')
+
+    def delete(self, key):
+        self.call('SET', self.PREFIX + key, '', 'EX', CACHE_INVALIDATION_HOLD)
+        self.call('PUBLISH', self.CHANNEL, key)
+
+    def take(self, buckets, cost):
+        # WATCH / MULTI / EXEC 乐观锁：其他进程在读写之间改了其中一个键时 EXEC 返回空，重试
+        keys = [self.PREFIX + 'rate:' + key for key, _, _ in buckets]
+        for _ in range(5):
+            self.call('WATCH', *keys)
+            values = [self.call('GET', key) for key in keys]
+            now = time.time()
+            wait, tats = gcra_all(buckets, [float(v) if v else None for v in values], now, cost)
+            if wait:
+                self.call('UNWATCH')
+                return wait
+            self.call('MULTI')
+            for key, tat in zip(keys, tats):
+                self.call('SET', key, repr(tat), 'PX', max(1, int((tat - now) * 1000)))
+            if self.call('EXEC') is not None:
+                return 0
+        raise CacheError(f'令牌桶 {", ".join(keys)} 更新冲突')
+
+    def sync(self):
+        pass
+
+    def _listen(self):
+        while True:
+            try:
+                f = self._connect(subscribe=True)
+                self._call(f, 'SUBSCRIBE', self.CHANNEL)
+                # 订阅之前可能错过了通知，本地副本全部作废
+                self.on_invalidate(None)
+                self.keep_local = True
+                while True:
+                    message = redis_reply(f)
+                    if message[0] == b'message':
+                        self.on_invalidate(message[2].decode('utf-8'))
+            except (*CACHE_ERRORS, ConnectionError) as e:
+                self.keep_local = False
+                self.on_invalidate(None)
+                log_cache_error('缓存失效通知订阅中断，1 秒后重连', e)
+                time.sleep(1)
+
+caches = {}  # 名称 -> Cache
+shared_cache = None  # (进程号, 后端)
+shared_cache_lock = threading.Lock()
+cache_error_times = {}  # 日志消息 -> 上次记录的时间
+failed_invalidations = set()  # 清除失败、等待重试的共享缓存键
+
+def log_cache_error(message, e):
+    """共享存储不可用时每个请求都会出错，同一类错误每 10 秒只记录一次"""
+    now = time.monotonic()
+    if now - cache_error_times.get(message, -10) >= 10:
+        cache_error_times[message] = now
+        app.logger.warning('%s: %s', message, e)
+
+def drop_local_copies(key):
+    """收到失效通知时调用；key 为 None 表示全部作废"""
+    if key is None:
+        for cache in caches.values():
+            cache.generation += 1
+            cache.local.clear()
+        return
+    name, _, local_key = key.partition(':')
+    if name in caches:
+        caches[name].generation += 1
+        caches[name].local.pop(local_key)
+
+def retry_invalidations(backend):
+    for key in list(failed_invalidations):
+        try:
+            backend.delete(key)
+        except CACHE_ERRORS:
+            return  # 仍然不可用，下次再试
+        failed_invalidations.discard(key)
+
+def cache_backend():
+    """当前进程的共享缓存后端，CACHE_BACKEND 为 local 时返回 None"""
+    global shared_cache
+    kind = app.config['CACHE_BACKEND']
+    if kind == 'local':
+        return None
+    pid = os.getpid()
+    state = shared_cache
+    if state is None or state[0] != pid:
+        # fork 出来的 worker 不能沿用父进程的连接和订阅线程
+        with shared_cache_lock:
+            state = shared_cache
+            if state is None or state[0] != pid:
+                if kind == 'sqlite':
+                    backend = SQLiteCacheBackend(app.config['CACHE_PATH'], drop_local_copies)
+                elif kind == 'redis':
+                    backend = RedisCacheBackend(app.config['CACHE_URL'], drop_local_copies)
+                else:
+                    raise ValueError(f'未知的 CACHE_BACKEND: {kind}')
+                state = shared_cache = (pid, backend)
+    backend = state[1]
+    try:
+        backend.sync()
+    except CACHE_ERRORS as e:
+        log_cache_error('读取缓存失效记录失败', e)
+    if failed_invalidations:
+        retry_invalidations(backend)
+    return backend
+
+class Cache:
+    """按名称区分的缓存：本地 LRU 副本加可选的共享存储。
+    键为字符串或字符串元组；load 把 JSON 解出的值还原为原来的类型。"""
+
+    def __init__(self, name, config_key, load=None):
+        self.name = name
+        self.local = LRUCache(config_key)
+        self.load = load
+        self.generation = 0  # 每次清除加一
+        self.last_miss = threading.local()  # 本线程最近一次未命中的 (键, generation)
+        caches[name] = self
+
+    def key(self, key):
+        return key if isinstance(key, str) else json.dumps(key, ensure_ascii=False)
+
+    def peek(self, key):
+        """只查本地副本，不访问共享存储，可以在事件循环中直接调用"""
+        return self.local.get(self.key(key))
+
+    def _miss(self, key):
+        self.last_miss.entry = (key, self.generation)
+        return None
+
+    def get(self, key):
+        backend = cache_backend()
+        key = self.key(key)
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        if backend is None or f'{self.name}:{key}' in failed_invalidations:
+            return self._miss(key)
+        try:
+            raw = backend.get(f'{self.name}:{key}')
+        except CACHE_ERRORS as e:
+            log_cache_error('读取共享缓存失败', e)
+            return self._miss(key)
+        if raw is None:
+            return self._miss(key)
+        value = json.loads(raw)
+        if self.load is not None:
+            value = self.load(value)
+        if backend.keep_local:
+            self.local.put(key, value)
+        return value
+
+    def put(self, key, value):
+        """写入缓存。本线程上次对同一个键 get 未命中之后如果有过清除，value 可能是
+        清除之前读到的旧值，放弃写入"""
+        backend = cache_backend()
+        key = self.key(key)
+        miss = getattr(self.last_miss, 'entry', None)
+        if miss is not None and miss[0] == key:
+            self.last_miss.entry = None
+            if miss[1] != self.generation:
+                return
+        if backend is None or backend.keep_local:
+            self.local.put(key, value)
+        if backend is not None and f'{self.name}:{key}' not in failed_invalidations:
+            try:
+                backend.set(f'{self.name}:{key}', json.dumps(value, ensure_ascii=False))
+            except CACHE_ERRORS as e:
+                log_cache_error('写入共享缓存失败', e)
+
+    def pop(self, key):
+        backend = cache_backend()
+        key = self.key(key)
+        self.generation += 1
+        self.local.pop(key)
+        if backend is not None:
+            try:
+                backend.delete(f'{self.name}:{key}')
+            except CACHE_ERRORS as e:
+                failed_invalidations.add(f'{self.name}:{key}')
+                log_cache_error('清除共享缓存失败，稍后重试', e)
+
+#########################################
+
+############### 元数据缓存 ###############
+# 一个相册页面会同时请求上百个文件，每个请求都要查数据库确认归属、stat 文件取大小和
+# 修改时间。这些信息在第一次访问时放入缓存（每类最多 MEDIA_CACHE_SIZE 条），
+# delete_file 时清除。浏览器重新验证缓存时可以直接回复 304，不查数据库也不访问磁盘。
+# 使用进程内缓存时，其他进程（命令行工具）修改文件不会通知到这里：发送文件前会对
+# 打开的文件做 fstat 核对，文件已被移走时会重新查找。
+# 用户信息和每个用户的文件列表同样缓存，上传、删除文件时清除对应用户的列表。
+
+class FileInfo(namedtuple('FileInfo', 'path size mtime_ns etag')):
+    @property
+    def mtime(self):
+        return datetime.fromtimestamp(self.mtime_ns / 1e9, timezone.utc)
+
+file_cache = Cache('file', 'MEDIA_CACHE_SIZE', FileInfo._make)  # (目录, 文件名) -> FileInfo
+owner_cache = Cache('owner', 'MEDIA_CACHE_SIZE')    # (类型, 文件名) -> 上传者
+variant_cache = Cache('variant', 'MEDIA_CACHE_SIZE')  # 图片文件名 -> image_variants 中的记录
+user_cache = Cache('user', 'USER_CACHE_SIZE')      # 用户名 -> True（用户存在）；不缓存密码哈希，共享缓存里不出现凭据
+listing_cache = Cache('listing', 'USER_CACHE_SIZE')  # 用户名 -> [图片列表, 视频列表]
+
+def cache_file_info(folder, filename, path, st):
+    info = FileInfo(path, st.st_size, st.st_mtime_ns, f'{st.st_mtime_ns:x}-{st.st_size:x}')
+    file_cache.put((folder, filename), info)
+    return info
+
+def file_info(folder, filename, refresh=False):
+    """文件的路径、大小、修改时间和 ETag，文件不存在时返回 None"""
+    info = None if refresh else file_cache.get((folder, filename))
+    if info is not None:
+        return info
+    path = safe_join(folder, upload_relpath(folder, filename))
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return cache_file_info(folder, filename, path, st)
+
+def media_owner(filetype, filename):
+    """上传者用户名，没有记录时返回 None（不缓存，刚保存的文件稍后就会有记录）"""
+    owner = owner_cache.get((filetype, filename))
+    if owner is None:
+        row = get_db().execute(f'SELECT username FROM {filetype} WHERE filename = ?', (filename,)).fetchone()
+        if row is None:
+            return None
+        owner = row['username']
+        owner_cache.put((filetype, filename), owner)
+    return owner
+
+def invalidate_media(filetype, filename, username):
+    owner_cache.pop((filetype, filename))
+    file_cache.pop((app.config[f'UPLOAD_FOLDER_{filetype.upper()}'], filename))
+    listing_cache.pop(username)
 
 #########################################
 
 # User 类，继承 UserMixin
 class User(UserMixin):
-    def __init__(self, id, password_hash):
+    def __init__(self, id):
         self.id = id
-        self.password_hash = password_hash
 
     @staticmethod
     def get(user_id):
-        db = get_db()
-        user = db.execute('SELECT * FROM users WHERE username = ?', (user_id,)).fetchone()
-        if user:
-            return User(user['username'], user['password'])
+        if user_cache.get(user_id) is None:
+            db = get_db()
+            if db.execute('SELECT 1 FROM users WHERE username = ?', (user_id,)).fetchone() is None:
+                return None
+            user_cache.put(user_id, True)
+        return User(user_id)
+
+    @staticmethod
+    def authenticate(username, password):
+        """校验用户名和密码，成功时返回 User；密码哈希每次从数据库读取"""
+        row = get_db().execute('SELECT password FROM users WHERE username = ?', (username,)).fetchone()
+        if row and check_password_hash(row['password'], password):
+            return User(username)
         return None
 
     @staticmethod
@@ -73,14 +1048,105 @@ class User(UserMixin):
         db = get_db()
         db.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, password_hash))
         db.commit()
-        # 初始化用户的文件信息
-        db.execute('INSERT INTO user_files (username) VALUES (?)', (username,))
-        db.commit()
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.get(user_id)
 
+# 仅允许 ADMIN_USERS 中的用户访问
+def admin_required(view):
+    @wraps(view)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if current_user.id not in app.config['ADMIN_USERS']:
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+############### 限流 ###############
+# 搜索要对所有用户名算 LCS，登录和注册要算密码哈希，都比普通页面贵得多。
+# RATE_LIMIT_ENABLED 开启后，这些请求按 RATE_LIMIT_COSTS 从 IP 和登录用户两个令牌桶中
+# 扣除令牌，任一个不够时两个都不扣，返回 429 和 Retry-After。令牌桶保存在 CACHE_BACKEND 对应的
+# 共享存储中，多个 worker 共用同一份额度；local 时每个进程各自计数。共享存储出错时放行。
+# HEAVY_CONCURRENCY 限制每个进程同时执行的 CPU 密集请求数，超出的请求立即返回 503，
+# 而不是在线程池里排队越积越多。部署在反向代理之后时，需要用 ProxyFix 取得真实 IP。
+
+local_buckets = {}  # 键 -> tat
+local_buckets_lock = threading.Lock()
+heavy_slots = None  # (上限, 信号量)
+heavy_slots_lock = threading.Lock()
+
+def take_tokens(limits, cost):
+    """limits 为 [(键, (rate, burst))]，从每个令牌桶各取 cost 个令牌，返回需要等待的秒数，0 表示放行。
+    所有桶先检查、全部够了才一起扣除，被用户桶拒绝的请求不会白白消耗 IP 桶的额度"""
+    buckets = [(key, 1.0 / rate, burst / rate) for key, (rate, burst) in limits]
+    backend = cache_backend()
+    if backend is not None:
+        try:
+            return backend.take(buckets, cost)
+        except CACHE_ERRORS as e:
+            log_cache_error('读写共享令牌桶失败，暂不限流', e)
+            return 0
+    with local_buckets_lock:
+        now = time.time()
+        if len(local_buckets) > 100000:
+            # tat 已经过去的桶是满的，和不存在一样，可以删掉
+            for stale in [k for k, tat in local_buckets.items() if tat <= now]:
+                del local_buckets[stale]
+        wait, tats = gcra_all(buckets, [local_buckets.get(key) for key, _, _ in buckets], now, cost)
+        if not wait:
+            for (key, _, _), tat in zip(buckets, tats):
+                local_buckets[key] = tat
+        return wait
+
+def rate_limit_wait(cost_key, username, ip):
+    """按 IP 和用户两个令牌桶扣除令牌，返回需要等待的秒数，0 表示放行"""
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return 0
+    cost = app.config['RATE_LIMIT_COSTS'].get(cost_key, 1)
+    limits = [(f'ip:{ip}', app.config['RATE_LIMIT_IP'])]
+    if username:
+        limits.append((f'user:{username}', app.config['RATE_LIMIT_USER']))
+    return take_tokens(limits, cost)
+
+def heavy_semaphore():
+    global heavy_slots
+    limit = app.config['HEAVY_CONCURRENCY']
+    if limit <= 0:
+        return None
+    slots = heavy_slots
+    if slots is None or slots[0] != limit:
+        with heavy_slots_lock:
+            if heavy_slots is None or heavy_slots[0] != limit:
+                heavy_slots = (limit, threading.BoundedSemaphore(limit))
+            slots = heavy_slots
+    return slots[1]
+
+def rate_limited(cost_key, heavy=False, methods=None):
+    """限流装饰器；methods 指定时只对这些请求方法生效，heavy 表示受 HEAVY_CONCURRENCY 限制"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if methods is not None and request.method not in methods:
+                return view(*args, **kwargs)
+            username = current_user.id if current_user.is_authenticated else None
+            wait = rate_limit_wait(cost_key, username, request.remote_addr)
+            if wait:
+                raise TooManyRequests(retry_after=math.ceil(wait))
+            semaphore = heavy_semaphore() if heavy else None
+            if semaphore is None:
+                return view(*args, **kwargs)
+            if not semaphore.acquire(blocking=False):
+                raise ServiceUnavailable('服务器繁忙，请稍后重试', retry_after=1)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                semaphore.release()
+        return wrapper
+    return decorator
+
+#########################################
+
 # 表单定义
 
 class RegistrationForm(FlaskForm):
@@ -123,11 +1189,1180 @@ def lcs_length(s1, s2):
                 L[i+1][j+1] = max(L[i+1][j], L[i][j+1])
     return L[m][n]
 
+# 按 LCS 匹配度降序返回匹配的用户名
+def rank_users(keyword):
+    db = get_db()
+    users_list = db.execute('SELECT username FROM users').fetchall()
+    users_list = [u['username'] for u in users_list]
+    matches = []
+    with span('search_scoring'):
+        for username in users_list:
+            score = lcs_length(keyword, username)
+            if score > 0:
+                matches.append((username, score))
+    matches.sort(key=lambda x: x[1], reverse=True)
+    return [username for username, score in matches]
+
+def render_page(template_name, **context):
+    with span('template'):
+        return render_template(template_name, **context)
+
+def send_media(folder, filename):
+    # 只统计构造响应的时间，文件内容由 WSGI 服务器在之后流式发送
+    with span('file_send'):
+        info = file_info(folder, filename)
+        if info is None:
+            abort(404)
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                      direct_passthrough=True)
+        response.cache_control.no_cache = True
+        # 浏览器带着缓存的 ETag 重新验证时，直接用缓存的元数据回复 304，不访问磁盘
+        if not is_resource_modified(request.environ, etag=info.etag, last_modified=info.mtime):
+            response.set_etag(info.etag)
+            response.last_modified = info.mtime
+            return response.make_conditional(request.environ)
+        try:
+            f = open(info.path, 'rb')
+        except FileNotFoundError:
+            # 文件被移动（如目录分片迁移）或删除，重新查找一次
+            info = file_info(folder, filename, refresh=True)
+            if info is None:
+                abort(404)
+            f = open(info.path, 'rb')
+        # 已经打开的文件做一次 fstat 核对，文件在其他进程中被替换时以实际内容为准
+        st = os.fstat(f.fileno())
+        if st.st_size != info.size or st.st_mtime_ns != info.mtime_ns:
+            info = cache_file_info(folder, filename, info.path, st)
+        response.response = wrap_file(request.environ, f)
+        response.content_length = info.size
+        response.set_etag(info.etag)
+        response.last_modified = info.mtime
+        try:
+            return response.make_conditional(request.environ, accept_ranges=True, complete_length=info.size)
+        except RequestedRangeNotSatisfiable:
+            f.close()
+            raise
+
+############### 压缩和静态资源 ###############
+# 页面和 JSON 按 Accept-Encoding 压缩，输出了 CSRF 令牌的页面不压缩（BREACH）；静态资源通过
+# /assets/<指纹>/<路径> 提供，可以缓存一年。实现在 compression.py，几个脚本共用。
+
+init_compression(app, timer=lambda: span('compress'))
+
+#########################################
+
+############### 视频处理 ###############
+# 视频上传后在后台用 ffprobe 读取时长、分辨率和编码，用 ffmpeg 截取一帧作为封面。
+# 主页只显示封面，点击播放时浏览器才开始下载视频。没有安装 ffmpeg 时记录保持
+# pending 状态，页面照常显示视频；安装后执行 flask process-media 补处理。
+
+executors = {}  # 名称 -> (进程号, 线程池)
+executors_lock = threading.Lock()
+
+def submit_background(name, workers, func, *args):
+    """提交到指定名称的后台线程池，同一线程池内最多 workers 个任务并行。
+    线程池按进程创建，fork 出的 worker 各自拥有。"""
+    with executors_lock:
+        pid, pool = executors.get(name, (None, None))
+        if pid != os.getpid():
+            pool = ThreadPoolExecutor(workers, thread_name_prefix=name)
+            executors[name] = (os.getpid(), pool)
+    pool.submit(func, *args)
+
+def ffmpeg_tools():
+    ffmpeg = app.config['FFMPEG_PATH'] or shutil.which('ffmpeg')
+    ffprobe = app.config['FFPROBE_PATH'] or shutil.which('ffprobe')
+    if ffmpeg and ffprobe:
+        return ffmpeg, ffprobe
+    return None
+
+def probe_video(ffprobe, path):
+    out = subprocess.run(
+        [ffprobe, '-v', 'error', '-select_streams', 'v:0',
+         '-show_entries', 'stream=codec_name,width,height:format=duration', '-of', 'json', path],
+        capture_output=True, check=True, timeout=app.config['VIDEO_TIMEOUT']).stdout
+    info = json.loads(out)
+    stream = (info.get('streams') or [{}])[0]
+    duration = info.get('format', {}).get('duration')
+    return {
+        'duration': float(duration) if duration not in (None, 'N/A') else None,
+        'width': stream.get('width'),
+        'height': stream.get('height'),
+        'codec': stream.get('codec_name'),
+    }
+
+def make_poster(ffmpeg, path, poster_path, duration):
+    # 取第 1 秒的画面，避开常见的黑色首帧；视频太短时取中间
+    offset = min(1.0, duration / 2) if duration else 0
+    tmp_path = poster_path + '.tmp'
+    subprocess.run(
+        [ffmpeg, '-v', 'error', '-y', '-ss', f'{offset:.3f}', '-i', path,
+         '-frames:v', '1', '-vf', 'scale=480:-2', '-q:v', '4', '-f', 'image2', tmp_path],
+        capture_output=True, check=True, timeout=app.config['VIDEO_TIMEOUT'])
+    os.replace(tmp_path, poster_path)
+
+def process_video(filename):
+    """提取一个视频的元数据并生成封面，需要在应用上下文中调用"""
+    tools = ffmpeg_tools()
+    if tools is None:
+        return False
+    ffmpeg, ffprobe = tools
+    db = get_db()
+    path = upload_path(app.config['UPLOAD_FOLDER_VIDEOS'], filename)
+    poster = filename + '.jpg'
+    try:
+        meta = probe_video(ffprobe, path)
+        make_poster(ffmpeg, path, new_upload_path(app.config['UPLOAD_FOLDER_POSTERS'], poster), meta['duration'])
+    except (OSError, ValueError, subprocess.SubprocessError) as e:
+        app.logger.warning('视频处理失败 %s: %s', filename, e)
+        db.execute("UPDATE video_meta SET status = 'failed' WHERE filename = ?", (filename,))
+        db.commit()
+        return False
+    db.execute("""UPDATE video_meta SET status = 'done', duration = ?, width = ?, height = ?, codec = ?, poster = ?
+                  WHERE filename = ?""",
+               (meta['duration'], meta['width'], meta['height'], meta['codec'], poster, filename))
+    db.commit()
+    return True
+
+def _in_app_context(func, *args):
+    with app.app_context():
+        return func(*args)
+
+def _process_video_job(filename):
+    try:
+        if _in_app_context(process_video, filename) and app.config['HLS_ENABLED']:
+            _in_app_context(queue_hls, filename)
+    except Exception:
+        app.logger.exception('视频处理出错 %s', filename)
+
+def queue_video(filename):
+    """把视频交给后台线程处理"""
+    if ffmpeg_tools() is None:
+        return
+    submit_background('video', app.config['VIDEO_WORKERS'], _process_video_job, filename)
+
+def add_media(username, filetype, filename):
+    """登记一个已保存的上传文件，视频和图片同时加入后台处理队列"""
+    db = get_db()
+    db.execute(f'INSERT INTO {filetype} (username, filename) VALUES (?, ?)', (username, filename))
+    if filetype == 'videos':
+        db.execute('INSERT OR IGNORE INTO video_meta (filename) VALUES (?)', (filename,))
+    db.commit()
+    listing_cache.pop(username)
+    queue_media_jobs(filetype, filename)
+
+def queue_media_jobs(filetype, filename):
+    if filetype == 'videos':
+        queue_video(filename)
+    elif image_optimization_enabled() or image_hashing_enabled():
+        submit_background('image', app.config['IMAGE_WORKERS'], _process_image_job, filename)
+
+def get_video_meta(filenames):
+    db = get_db()
+    rows = db.execute(f"""SELECT m.*, h.status AS hls_status FROM video_meta m
+                          LEFT JOIN video_hls h ON h.filename = m.filename
+                          WHERE m.filename IN ({",".join("?" * len(filenames))})""",
+                      filenames).fetchall() if filenames else []
+    return {row['filename']: row for row in rows}
+
+@app.template_filter('duration')
+def format_duration(seconds):
+    seconds = int(seconds or 0)
+    if seconds >= 3600:
+        return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+    return f'{seconds // 60}:{seconds % 60:02d}'
+
+@app.template_global()
+def hls_js_url():
+    if app.config['HLS_JS_URL']:
+        return app.config['HLS_JS_URL']
+    # 和 Bootstrap 一样从 /assets/ 加载，带指纹，可以长期缓存
+    return asset_url('hls/hls.min.js') if asset_version('hls/hls.min.js') else None
+
+@app.cli.command('process-media')
+@click.option('--retry-failed', is_flag=True, help='同时重新处理之前失败的视频')
+def process_media_command(retry_failed):
+    """为还没有封面的视频提取元数据并生成封面"""
+    if ffmpeg_tools() is None:
+        raise click.ClickException('没有找到 ffmpeg / ffprobe，请安装或设置 FFMPEG_PATH、FFPROBE_PATH')
+    db = get_db()
+    # 补登记在引入 video_meta 之前上传的视频
+    db.execute('INSERT OR IGNORE INTO video_meta (filename) SELECT filename FROM videos')
+    db.commit()
+    statuses = ('pending', 'failed') if retry_failed else ('pending',)
+    filenames = [row['filename'] for row in db.execute(
+        f'SELECT filename FROM video_meta WHERE status IN ({",".join("?" * len(statuses))})', statuses)]
+    done = 0
+    with ThreadPoolExecutor(app.config['VIDEO_WORKERS']) as pool:
+        for ok in pool.map(lambda name: _in_app_context(process_video, name), filenames):
+            done += ok
+    print(f'处理完成 {done}/{len(filenames)}')
+
+#########################################
+
+############### HLS 转码 ###############
+# 把视频转成多档码率的 HLS：每档一个子目录，切成固定时长的 TS 分片，主播放列表
+# master.m3u8 列出所有档位，播放器按网速切换，只下载需要的分片。结果放在原视频旁边的
+# <文件名>_hls 目录，先写到临时目录，全部完成后再改名，播放器不会读到半成品。
+# 转码很耗 CPU，HLS_WORKERS 限制每个进程同时进行的转码数，多 worker 部署时总数要乘以进程数。
+
+def hls_dir(filename):
+    # 与原视频在同一个目录
+    video = upload_path(app.config['UPLOAD_FOLDER_VIDEOS'], filename)
+    return os.path.join(os.path.dirname(video), filename + '_hls')
+
+def has_audio(ffprobe, path):
+    out = subprocess.run(
+        [ffprobe, '-v', 'error', '-select_streams', 'a', '-show_entries', 'stream=index', '-of', 'csv=p=0', path],
+        capture_output=True, check=True, timeout=app.config['VIDEO_TIMEOUT']).stdout
+    return bool(out.strip())
+
+def hls_ladder(source_height):
+    # 不向上放大；比最低一档还小的视频只输出最低一档
+    ladder = [rung for rung in app.config['HLS_LADDER'] if rung[0] <= (source_height or 0)]
+    return ladder or [min(app.config['HLS_LADDER'])]
+
+def hls_command(ffmpeg, path, out_dir, ladder, audio):
+    seconds = app.config['HLS_SEGMENT_SECONDS']
+    split = ''.join(f'[v{i}]' for i in range(len(ladder)))
+    filters = [f'[0:v]split={len(ladder)}{split}']
+    filters += [f'[v{i}]scale=-2:{height}[v{i}out]' for i, (height, _, _) in enumerate(ladder)]
+    cmd = [ffmpeg, '-v', 'error', '-y', '-i', path, '-filter_complex', ';'.join(filters)]
+    streams = []
+    for i, (height, video_kbps, audio_kbps) in enumerate(ladder):
+        cmd += ['-map', f'[v{i}out]', f'-b:v:{i}', f'{video_kbps}k',
+                f'-maxrate:v:{i}', f'{video_kbps}k', f'-bufsize:v:{i}', f'{video_kbps * 2}k']
+        if audio:
+            cmd += ['-map', '0:a:0', f'-b:a:{i}', f'{audio_kbps}k']
+            streams.append(f'v:{i},a:{i},name:{height}p')
+        else:
+            streams.append(f'v:{i},name:{height}p')
+    # 按时间强制关键帧，保证每个分片都是 HLS_SEGMENT_SECONDS 秒且各档位对齐，便于切换
+    cmd += ['-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main', '-pix_fmt', 'yuv420p',
+            '-sc_threshold', '0', '-force_key_frames', f'expr:gte(t,n_forced*{seconds})',
+            '-c:a', 'aac', '-ac', '2',
+            '-f', 'hls', '-hls_time', str(seconds), '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(out_dir, '%v', 'seg_%05d.ts'),
+            '-master_pl_name', 'master.m3u8', '-var_stream_map', ' '.join(streams),
+            os.path.join(out_dir, '%v', 'index.m3u8')]
+    return cmd
+
+def transcode_hls(filename):
+    """把一个视频转成 HLS，需要在应用上下文中调用并且已经完成 process_video"""
+    tools = ffmpeg_tools()
+    if tools is None:
+        return False
+    ffmpeg, ffprobe = tools
+    db = get_db()
+    meta = db.execute('SELECT height FROM video_meta WHERE filename = ? AND status = ?', (filename, 'done')).fetchone()
+    if meta is None:
+        return False
+    path = upload_path(app.config['UPLOAD_FOLDER_VIDEOS'], filename)
+    ladder = hls_ladder(meta['height'])
+    tmp_dir = os.path.join(app.config['UPLOAD_FOLDER_VIDEOS'], f'.tmp-hls-{uuid4().hex}')
+    try:
+        cmd = hls_command(ffmpeg, path, tmp_dir, ladder, has_audio(ffprobe, path))
+        for height, _, _ in ladder:
+            os.makedirs(os.path.join(tmp_dir, f'{height}p'))
+        subprocess.run(cmd, capture_output=True, check=True, timeout=app.config['HLS_TIMEOUT'])
+        # 转码期间视频可能已被删除。持有写锁确认记录还在之后再改名；remove_derived 先删
+        # video_hls 记录（需要同一把写锁）再删 HLS 目录，所以不会留下没有视频的 _hls 目录
+        db.execute('BEGIN IMMEDIATE')
+        if db.execute('SELECT 1 FROM video_hls WHERE filename = ?', (filename,)).fetchone() is None:
+            db.rollback()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return False
+        shutil.rmtree(hls_dir(filename), ignore_errors=True)
+        os.replace(tmp_dir, hls_dir(filename))
+    except (OSError, subprocess.SubprocessError) as e:
+        stderr = getattr(e, 'stderr', None) or b''
+        app.logger.warning('HLS 转码失败 %s: %s %s', filename, e, stderr[-500:].decode('utf-8', 'replace'))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        db.execute("UPDATE video_hls SET status = 'failed' WHERE filename = ?", (filename,))
+        db.commit()
+        return False
+    except BaseException:
+        db.rollback()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    db.execute("UPDATE video_hls SET status = 'done', renditions = ? WHERE filename = ?",
+               (','.join(f'{height}p' for height, _, _ in ladder), filename))
+    db.commit()
+    return True
+
+def _transcode_hls_job(filename):
+    try:
+        _in_app_context(transcode_hls, filename)
+    except Exception:
+        app.logger.exception('HLS 转码出错 %s', filename)
+
+def queue_hls(filename):
+    db = get_db()
+    db.execute("INSERT OR REPLACE INTO video_hls (filename, status) VALUES (?, 'pending')", (filename,))
+    db.commit()
+    submit_background('hls', app.config['HLS_WORKERS'], _transcode_hls_job, filename)
+
+@app.route('/hls/<filename>/<path:name>')
+def hls_file(filename, name):
+    # 分片和 VOD 播放列表生成后不再改变，可以长期缓存
+    if name.endswith('.m3u8'):
+        mimetype = 'application/vnd.apple.mpegurl'
+    elif name.endswith('.ts'):
+        mimetype = 'video/mp2t'
+    else:
+        abort(404)
+    with span('file_send'):
+        return send_from_directory(hls_dir(secure_filename(filename)), name, mimetype=mimetype, max_age=86400)
+
+@app.cli.command('transcode-hls')
+@click.option('--retry-failed', is_flag=True, help='同时重新转码之前失败的视频')
+def transcode_hls_command(retry_failed):
+    """为已经提取过元数据、还没有 HLS 的视频转码"""
+    if ffmpeg_tools() is None:
+        raise click.ClickException('没有找到 ffmpeg / ffprobe，请安装或设置 FFMPEG_PATH、FFPROBE_PATH')
+    db = get_db()
+    statuses = ('pending', 'failed') if retry_failed else ('pending',)
+    filenames = [row['filename'] for row in db.execute(
+        f"""SELECT m.filename FROM video_meta m LEFT JOIN video_hls h ON h.filename = m.filename
+            WHERE m.status = 'done' AND (h.status IS NULL OR h.status IN ({",".join("?" * len(statuses))}))""",
+        statuses)]
+    db.executemany("INSERT OR REPLACE INTO video_hls (filename, status) VALUES (?, 'pending')",
+                   ((name,) for name in filenames))
+    db.commit()
+    done = 0
+    with ThreadPoolExecutor(app.config['HLS_WORKERS']) as pool:
+        for ok in pool.map(lambda name: _in_app_context(transcode_hls, name), filenames):
+            done += ok
+    print(f'转码完成 {done}/{len(filenames)}')
+
+#########################################
+
+############### 图片优化 ###############
+# 原图保持不变，另外生成去除 EXIF 等元数据的版本：同格式重新编码（PNG 无损，JPEG 按
+# IMAGE_QUALITY），以及 WebP / AVIF。只保存比原图小的版本，image_variants 表记录每个
+# 版本的格式和大小（包括原图本身，表示已处理过）。访问图片时按 Accept 请求头在浏览器
+# 明确支持的格式中选最小的一个返回，并带上 Vary: Accept 以免缓存混用。
+
+# 格式 -> (Pillow 格式名, MIME 类型, 扩展名)
+IMAGE_ENCODINGS = {
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'png': ('PNG', 'image/png', 'png'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'avif': ('AVIF', 'image/avif', 'avif'),
+}
+
+def image_optimization_enabled():
+    return app.config['IMAGE_OPTIMIZE'] and Image is not None
+
+def encode_image(img, fmt, lossless, icc_profile):
+    """按格式编码图片，不写入 EXIF / XMP，只保留颜色配置文件"""
+    pil_format = IMAGE_ENCODINGS[fmt][0]
+    options = {'icc_profile': icc_profile} if icc_profile else {}
+    if fmt == 'jpeg':
+        options.update(quality=app.config['IMAGE_QUALITY'], optimize=True, progressive=True)
+        img = img.convert('RGB')
+    elif fmt == 'png':
+        options.update(optimize=True)
+    elif fmt == 'webp' and lossless:
+        options.update(lossless=True, method=6)
+    elif fmt == 'webp':
+        options.update(quality=app.config['IMAGE_QUALITY'], method=6)
+    elif fmt == 'avif':
+        # Pillow 的 AVIF 编码没有无损模式，无损来源用最高质量代替
+        options.update(quality=100 if lossless else app.config['IMAGE_QUALITY'])
+    out = BytesIO()
+    img.save(out, pil_format, **options)
+    return out.getvalue()
+
+def optimize_image(filename):
+    """生成一张图片的优化版本，需要在应用上下文中调用"""
+    if Image is None:
+        return False
+    path = upload_path(app.config['UPLOAD_FOLDER_IMAGES'], filename)
+    db = get_db()
+    try:
+        original_size = os.path.getsize(path)
+        with Image.open(path) as img:
+            source_format = (img.format or '').lower()
+            # GIF 可能是动图，重新编码会丢帧，保持原样
+            if source_format not in ('jpeg', 'png'):
+                variants = {}
+            else:
+                icc_profile = img.info.get('icc_profile')
+                # 先按 EXIF 方向旋转，去掉 EXIF 后图片方向仍然正确
+                img = ImageOps.exif_transpose(img)
+                lossless = source_format == 'png'
+                formats = [source_format] + [f for f in app.config['IMAGE_FORMATS']
+                                             if f in IMAGE_ENCODINGS and features.check(f)]
+                variants = {}
+                for fmt in formats:
+                    try:
+                        variants[fmt] = encode_image(img, fmt, lossless, icc_profile)
+                    except (OSError, ValueError) as e:
+                        app.logger.warning('图片 %s 无法编码为 %s: %s', filename, fmt, e)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        app.logger.warning('图片优化失败 %s: %s', filename, e)
+        return False
+
+    rows = [(filename, 'original', None, IMAGE_ENCODINGS.get(source_format, (None, None))[1], original_size)]
+    for fmt, data in variants.items():
+        if len(data) >= original_size:
+            continue
+        variant = f'{filename}.{IMAGE_ENCODINGS[fmt][2]}'
+        if fmt == source_format:
+            variant = f'{filename}.min.{IMAGE_ENCODINGS[fmt][2]}'
+        tmp_path = os.path.join(app.config['UPLOAD_FOLDER_VARIANTS'], f'.tmp-{uuid4().hex}')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, new_upload_path(app.config['UPLOAD_FOLDER_VARIANTS'], variant))
+        rows.append((filename, fmt, variant, IMAGE_ENCODINGS[fmt][1], len(data)))
+    db.execute('DELETE FROM image_variants WHERE filename = ?', (filename,))
+    db.executemany('INSERT INTO image_variants (filename, format, variant, mimetype, size) VALUES (?, ?, ?, ?, ?)', rows)
+    db.commit()
+    variant_cache.pop(filename)
+    for row in rows:
+        if row[2] is not None:
+            file_cache.pop((app.config['UPLOAD_FOLDER_VARIANTS'], row[2]))
+    return True
+
+def _process_image_job(filename):
+    try:
+        if image_optimization_enabled():
+            _in_app_context(optimize_image, filename)
+        if image_hashing_enabled():
+            _in_app_context(hash_image, filename)
+    except Exception:
+        app.logger.exception('图片处理出错 %s', filename)
+
+def pick_image_variant(filename, accept):
+    """按 Accept 选出最小的可用版本，返回 (目录, 文件名)；没有优化版本时返回原图"""
+    original = (app.config['UPLOAD_FOLDER_IMAGES'], filename)
+    if not image_optimization_enabled():
+        return original
+    rows = variant_cache.get(filename)
+    if rows is None:
+        rows = [dict(row) for row in get_db().execute(
+            'SELECT format, variant, mimetype, size FROM image_variants WHERE filename = ?', (filename,))]
+        # 还没有处理过的图片不缓存，处理完成后才能用上优化版本
+        if rows:
+            variant_cache.put(filename, rows)
+    original_type = next((row['mimetype'] for row in rows if row['format'] == 'original'), None)
+    # 只使用浏览器明确列出的新格式，*/* 不算，避免把 WebP / AVIF 发给不支持的客户端
+    accepted = {value for value, quality in accept if quality > 0}
+    best = None
+    for row in rows:
+        if row['mimetype'] != original_type and row['mimetype'] not in accepted:
+            continue
+        if best is None or row['size'] < best['size']:
+            best = row
+    if best is None or best['variant'] is None:
+        return original
+    return app.config['UPLOAD_FOLDER_VARIANTS'], best['variant']
+
+def remove_image_variants(db, filename):
+    variant_cache.pop(filename)
+    for row in db.execute('SELECT variant FROM image_variants WHERE filename = ? AND variant IS NOT NULL', (filename,)):
+        file_cache.pop((app.config['UPLOAD_FOLDER_VARIANTS'], row['variant']))
+        try:
+            os.remove(upload_path(app.config['UPLOAD_FOLDER_VARIANTS'], row['variant']))
+        except OSError:
+            pass
+    db.execute('DELETE FROM image_variants WHERE filename = ?', (filename,))
+
+@app.cli.command('optimize-images')
+@click.option('--all', 'redo', is_flag=True, help='重新处理所有图片，而不只是还没有处理过的')
+def optimize_images_command(redo):
+    """为已上传的图片生成优化版本"""
+    if Image is None:
+        raise click.ClickException('需要先安装 Pillow：pip install Pillow')
+    db = get_db()
+    query = 'SELECT filename FROM images'
+    if not redo:
+        query += ' WHERE filename NOT IN (SELECT filename FROM image_variants)'
+    filenames = [row['filename'] for row in db.execute(query)]
+    done = 0
+    with ThreadPoolExecutor(app.config['IMAGE_WORKERS']) as pool:
+        for ok in pool.map(lambda name: _in_app_context(optimize_image, name), filenames):
+            done += ok
+    print(f'处理完成 {done}/{len(filenames)}')
+
+#########################################
+
+############### 相似图片 ###############
+# 为每张图片计算 64 位的 pHash（DCT 低频系数与中位数比较）和 dHash（相邻像素明暗比较），
+# 缩放、重新压缩过的同一张图片哈希值只差几位。查找时用多索引哈希：把 pHash 切成 4 段
+# 16 位分别建索引，汉明距离不超过 3 的两个哈希至少有一段完全相同（抽屉原理），
+# 所以只需按 4 个索引取出候选再精确计算距离，百万级图片也只需检查几十个候选。
+
+HASH_BANDS = 4
+NEAR_DUPLICATE_MAX_DISTANCE = HASH_BANDS - 1
+
+def image_hashing_enabled():
+    return app.config['IMAGE_HASH_ENABLED'] and Image is not None and np is not None
+
+def _dct_matrix(n):
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+DCT_32 = _dct_matrix(32) if np is not None else None
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+def perceptual_hashes(img):
+    """返回 (phash, dhash)，均为 64 位无符号整数"""
+    gray = ImageOps.exif_transpose(img).convert('L')
+    pixels = np.asarray(gray.resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    coeffs = (DCT_32 @ pixels @ DCT_32.T)[:8, :8]
+    # 直流分量只反映整体亮度，不参与中位数
+    phash = _bits_to_int(coeffs > np.median(coeffs.flatten()[1:]))
+    small = np.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    dhash = _bits_to_int(small[:, 1:] > small[:, :-1])
+    return phash, dhash
+
+def to_signed64(value):
+    # SQLite 的 INTEGER 是有符号 64 位
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def hash_bands(phash):
+    return [(phash >> (16 * i)) & 0xFFFF for i in range(HASH_BANDS)]
+
+def compute_image_hash(filename):
+    path = upload_path(app.config['UPLOAD_FOLDER_IMAGES'], filename)
+    with Image.open(path) as img:
+        # JPEG 可以在解码时直接缩小，大图也只需解码很小的一部分
+        img.draft('L', (64, 64))
+        phash, dhash = perceptual_hashes(img)
+    return (filename, to_signed64(phash), to_signed64(dhash), *hash_bands(phash))
+
+def save_image_hashes(db, rows):
+    db.executemany('INSERT OR REPLACE INTO image_hashes (filename, phash, dhash, b0, b1, b2, b3) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    db.commit()
+
+def hash_image(filename):
+    """计算一张图片的感知哈希并保存，需要在应用上下文中调用"""
+    try:
+        row = compute_image_hash(filename)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        app.logger.warning('图片哈希失败 %s: %s', filename, e)
+        return False
+    save_image_hashes(get_db(), [row])
+    return True
+
+def find_near_duplicates(filename, max_distance):
+    db = get_db()
+    target = db.execute('SELECT * FROM image_hashes WHERE filename = ?', (filename,)).fetchone()
+    if target is None:
+        return None
+    phash = target['phash'] & 0xFFFFFFFFFFFFFFFF
+    dhash = target['dhash'] & 0xFFFFFFFFFFFFFFFF
+    candidates = db.execute(
+        """SELECT h.filename, h.phash, h.dhash, i.username FROM image_hashes h
+           JOIN images i ON i.filename = h.filename
+           WHERE (h.b0 = ? OR h.b1 = ? OR h.b2 = ? OR h.b3 = ?) AND h.filename != ?""",
+        (*hash_bands(phash), filename)).fetchall()
+    matches = []
+    for row in candidates:
+        distance = bin(phash ^ (row['phash'] & 0xFFFFFFFFFFFFFFFF)).count('1')
+        if distance <= max_distance:
+            matches.append({'filename': row['filename'], 'username': row['username'], 'distance': distance,
+                            'dhash_distance': bin(dhash ^ (row['dhash'] & 0xFFFFFFFFFFFFFFFF)).count('1')})
+    matches.sort(key=lambda m: (m['distance'], m['dhash_distance']))
+    return matches
+
+@app.cli.command('hash-images')
+@click.option('--all', 'redo', is_flag=True, help='重新计算所有图片，而不只是还没有哈希的')
+@click.option('--batch-size', default=500, show_default=True, help='每批写入数据库的条数')
+def hash_images_command(redo, batch_size):
+    """为 images 表中的图片计算感知哈希"""
+    if Image is None or np is None:
+        raise click.ClickException('需要先安装 Pillow 和 NumPy：pip install Pillow numpy')
+    db = get_db()
+    query = 'SELECT filename FROM images'
+    if not redo:
+        query += ' WHERE filename NOT IN (SELECT filename FROM image_hashes)'
+    filenames = [row['filename'] for row in db.execute(query)]
+
+    def compute(name):
+        try:
+            return compute_image_hash(name)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            app.logger.warning('图片哈希失败 %s: %s', name, e)
+            return None
+
+    done, batch = 0, []
+    # 解码和缩放在 Pillow 中会释放 GIL，线程池即可并行
+    with ThreadPoolExecutor(app.config['IMAGE_WORKERS']) as pool:
+        for row in pool.map(compute, filenames):
+            if row is None:
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                save_image_hashes(db, batch)
+                done += len(batch)
+                batch = []
+    save_image_hashes(db, batch)
+    done += len(batch)
+    print(f'处理完成 {done}/{len(filenames)}')
+
+#########################################
+
+############### 文件对账 ###############
+# 比对上传目录和 images / videos 表，找出没有记录的孤儿文件和文件已丢失的记录。
+# 两边都按文件名排序后归并：目录用 os.scandir 流式读取，分批写入临时表排序；数据库
+# 一侧按文件名索引分页读取。内存占用与文件数无关，每处理一批记录一次进度，中断后
+# 可以从上次的位置继续。--rate 限制每秒处理的条目数，避免影响线上服务的磁盘。
+
+RECONCILE_PAGE = 1000
+
+def remove_derived(db, filetype, filename):
+    """删除一个上传文件派生出的封面、HLS、优化版本和相关记录，不含原文件和主记录"""
+    if filetype == 'videos':
+        meta = db.execute('SELECT poster FROM video_meta WHERE filename = ?', (filename,)).fetchone()
+        if meta and meta['poster']:
+            file_cache.pop((app.config['UPLOAD_FOLDER_POSTERS'], meta['poster']))
+            try:
+                os.remove(upload_path(app.config['UPLOAD_FOLDER_POSTERS'], meta['poster']))
+            except OSError:
+                pass
+        # 先删记录再删目录：正在进行的转码看到记录已删除就不会再把目录改名过来
+        db.execute('DELETE FROM video_hls WHERE filename = ?', (filename,))
+        shutil.rmtree(hls_dir(filename), ignore_errors=True)
+        db.execute('DELETE FROM video_meta WHERE filename = ?', (filename,))
+    else:
+        remove_image_variants(db, filename)
+        db.execute('DELETE FROM image_hashes WHERE filename = ?', (filename,))
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+        self.next_time = max(self.next_time, now) + self.interval
+
+def iter_upload_entries(folder, depth=0):
+    """遍历根目录中尚未迁移的文件和两级分片目录中的文件，跳过隐藏文件和未完成的临时文件"""
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if depth < 2 and SHARD_NAME.fullmatch(entry.name) and entry.is_dir(follow_symlinks=False):
+                yield from iter_upload_entries(entry.path, depth + 1)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+def scan_upload_names(db, folder, after, limiter):
+    """把目录中排在 after 之后的文件名写入临时表，HLS 等子目录不参与比对"""
+    db.execute('CREATE TEMP TABLE IF NOT EXISTS reconcile_names (name TEXT PRIMARY KEY)')
+    db.execute('DELETE FROM reconcile_names')
+    batch = []
+    for entry in iter_upload_entries(folder):
+        limiter.wait()
+        if entry.name <= after:
+            continue
+        batch.append((entry.name,))
+        if len(batch) >= RECONCILE_PAGE:
+            db.executemany('INSERT OR IGNORE INTO reconcile_names VALUES (?)', batch)
+            batch = []
+    db.executemany('INSERT OR IGNORE INTO reconcile_names VALUES (?)', batch)
+
+def _paged(db, sql, after):
+    # 每页读完再返回，两页之间不持有打开的查询，修复时可以直接写数据库
+    while True:
+        rows = db.execute(sql, (after, RECONCILE_PAGE)).fetchall()
+        if not rows:
+            return
+        yield from rows
+        after = rows[-1][0]
+
+def _reconcile_orphan(folder, filetype, name, repair, grace):
+    path = upload_path(folder, name)
+    try:
+        age = time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return 'vanished'
+    if age < grace:
+        # 可能是刚保存、还没来得及写入记录的上传
+        return 'recent'
+    print(f'孤儿文件: {filetype}/{name}')
+    if repair:
+        orphan_dir = os.path.join(app.config['ORPHAN_FOLDER'], filetype)
+        os.makedirs(orphan_dir, exist_ok=True)
+        os.replace(path, os.path.join(orphan_dir, name))
+        return 'orphans_moved'
+    return 'orphans'
+
+def _reconcile_dangling(db, folder, filetype, row, repair, max_id, stale):
+    if row['id'] > max_id:
+        # 扫描目录之后才写入的记录，文件可能不在快照里
+        return 'recent'
+    # 目录快照可能是几分钟前的，删除前再确认一次文件确实不存在（期间上传或被 shard-uploads 移动）
+    try:
+        os.stat(upload_path(folder, row['filename']))
+        return 'reappeared'
+    except FileNotFoundError:
+        pass
+    print(f'记录缺少文件: {filetype}/{row["filename"]} ({row["username"]})')
+    if repair:
+        remove_derived(db, filetype, row['filename'])
+        db.execute(f'DELETE FROM {filetype} WHERE filename = ? AND username = ?', (row['filename'], row['username']))
+        # 提交之后才清缓存，否则并发请求可能在提交前读到旧记录又写回缓存
+        stale.append((filetype, row['filename'], row['username']))
+        return 'dangling_removed'
+    return 'dangling'
+
+def reconcile_folder(db, filetype, after, repair, grace, limiter, checkpoint):
+    folder = app.config[f'UPLOAD_FOLDER_{filetype.upper()}']
+    # 扫描开始时的最大 id：之后写入的记录对应的文件可能不在目录快照中，不当作缺少文件
+    max_id = db.execute(f'SELECT COALESCE(MAX(id), 0) FROM {filetype}').fetchone()[0]
+    scan_upload_names(db, folder, after, limiter)
+    disk = _paged(db, 'SELECT name FROM reconcile_names WHERE name > ? ORDER BY name LIMIT ?', after)
+    rows = _paged(db, f'SELECT filename, username, id FROM {filetype} WHERE filename > ? ORDER BY filename LIMIT ?', after)
+    stats = Counter()
+    stale = []
+
+    def commit():
+        db.commit()
+        for item in stale:
+            invalidate_media(*item)
+        stale.clear()
+
+    name, row = next(disk, None), next(rows, None)
+    last_row = None
+    while name is not None or row is not None:
+        limiter.wait()
+        if name is None or (row is not None and row['filename'] < name[0]):
+            # 同一个文件名有多条记录时只处理第一条，其余跟随第一条的结果
+            if row['filename'] != last_row:
+                stats[_reconcile_dangling(db, folder, filetype, row, repair, max_id, stale)] += 1
+            else:
+                stats['duplicate_rows'] += 1
+            current = last_row = row['filename']
+            row = next(rows, None)
+        elif row is None or name[0] < row['filename']:
+            current = name[0]
+            stats[_reconcile_orphan(folder, filetype, current, repair, grace)] += 1
+            name = next(disk, None)
+        else:
+            current = last_row = name[0]
+            stats['ok'] += 1
+            name, row = next(disk, None), next(rows, None)
+        if sum(stats.values()) % RECONCILE_PAGE == 0:
+            commit()
+            checkpoint(current)
+    commit()
+    return stats
+
+def iter_temp_entries(folder, depth=0):
+    """遍历根目录和两级分片目录中写到一半的 .tmp-* 临时文件和 .tmp-hls-* 转码目录"""
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.name.startswith('.tmp-'):
+            yield entry
+        elif depth < 2 and SHARD_NAME.fullmatch(entry.name) and entry.is_dir(follow_symlinks=False):
+            yield from iter_temp_entries(entry.path, depth + 1)
+
+def sweep_temp_files(folder, repair, grace, limiter):
+    """进程崩溃时 atomic_save、图片优化和 HLS 转码的临时文件不会被清理，修改时间超过 grace
+    的才处理；转码目录在整个转码期间都可能在用，至少等 HLS_TIMEOUT"""
+    stats = Counter()
+    for entry in iter_temp_entries(folder):
+        limiter.wait()
+        is_dir = entry.is_dir(follow_symlinks=False)
+        try:
+            age = time.time() - entry.stat(follow_symlinks=False).st_mtime
+        except FileNotFoundError:
+            continue
+        if age < (max(grace, app.config['HLS_TIMEOUT']) if is_dir else grace):
+            stats['temp_recent'] += 1
+            continue
+        print(f'残留临时文件: {entry.path}')
+        if not repair:
+            stats['temp'] += 1
+            continue
+        if is_dir:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        stats['temp_removed'] += 1
+    return stats
+
+def load_reconcile_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_reconcile_checkpoint(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+@app.cli.command('reconcile')
+@click.option('--repair', is_flag=True, help='删除缺少文件的记录，把孤儿文件移到 ORPHAN_FOLDER，删除残留的临时文件；默认只报告')
+@click.option('--rate', default=2000, show_default=True, help='每秒最多处理的条目数，0 表示不限制')
+@click.option('--grace', default=3600, show_default=True, help='修改时间在这么多秒以内的文件不视为孤儿')
+@click.option('--restart', is_flag=True, help='忽略上次中断时保存的进度，从头开始')
+def reconcile_command(repair, rate, grace, restart):
+    """比对上传目录和数据库记录，报告或修复不一致"""
+    path = app.config['RECONCILE_CHECKPOINT']
+    state = {} if restart else load_reconcile_checkpoint(path)
+    if state:
+        print(f'从上次的进度继续: {state}')
+    db = get_db()
+    limiter = RateLimiter(rate)
+    for filetype in ('images', 'videos'):
+        if state.get(filetype) is True:
+            continue
+
+        def checkpoint(last, filetype=filetype):
+            state[filetype] = last
+            save_reconcile_checkpoint(path, state)
+
+        stats = reconcile_folder(db, filetype, state.get(filetype) or '', repair, grace, limiter, checkpoint)
+        print(f'{filetype}: ' + ', '.join(f'{k}={v}' for k, v in sorted(stats.items())))
+        state[filetype] = True
+        save_reconcile_checkpoint(path, state)
+    for key in ('IMAGES', 'VIDEOS', 'VARIANTS'):
+        stats = sweep_temp_files(app.config[f'UPLOAD_FOLDER_{key}'], repair, grace, limiter)
+        if stats:
+            print(f'{key.lower()} 临时文件: ' + ', '.join(f'{k}={v}' for k, v in sorted(stats.items())))
+    os.remove(path)
+
+#########################################
+
+############### 批量导入导出用户 ###############
+# 导入文件每行一个用户：CSV 需要表头 username,password，JSONL 每行一个对象。
+# password 为明文时在进程池中并行计算哈希；也可以提供 password_hash（export-users 导出
+# 的格式），直接写入。每批用 executemany 插入，整个导入在一个事务中完成，出错时
+# 全部回滚。导入期间数据库写锁一直被占用，注册、上传会等待，请在低峰期执行。
+
+def open_text(path, mode):
+    if path == '-':
+        return nullcontext(sys.stdin if mode == 'r' else sys.stdout)
+    return open(path, mode, encoding='utf-8', newline='')
+
+def detect_format(path, fmt):
+    if fmt:
+        return fmt
+    if path.endswith('.csv'):
+        return 'csv'
+    if path.endswith('.jsonl'):
+        return 'jsonl'
+    raise click.BadParameter('无法从文件名判断格式，请指定 --format', param_hint='--format')
+
+def read_user_records(f, fmt):
+    """逐行产出 (行号, 记录)；无法解析的 JSON 行记录为 None，由 check_user_record 报告"""
+    if fmt == 'csv':
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_num, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    yield line_num, json.loads(line)
+                except ValueError:
+                    yield line_num, None
+
+def check_user_record(record):
+    """返回 (用户名, 明文密码, 密码哈希) 或错误说明；规则与注册页面一致"""
+    if not isinstance(record, dict):
+        return '不是有效的 JSON 对象'
+    username = str(record.get('username') or '').strip().lower()
+    password, password_hash = record.get('password'), record.get('password_hash')
+    if not 3 <= len(username) <= 25:
+        return '用户名长度需要在 3 到 25 之间'
+    if password_hash:
+        if str(password_hash).count('$') < 2:
+            return 'password_hash 格式不正确'
+        return username, None, str(password_hash)
+    if not password or len(str(password)) < 6:
+        return '密码至少 6 位'
+    return username, str(password), None
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+@app.cli.command('import-users')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='默认按扩展名判断；从标准输入读取时必须指定')
+@click.option('--batch-size', default=1000, show_default=True, help='每批计算哈希和插入的用户数')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='计算密码哈希的进程数')
+def import_users_command(path, fmt, batch_size, workers):
+    """从 CSV / JSONL 批量导入用户，已存在的用户名跳过"""
+    fmt = detect_format(path, fmt)
+    db = get_db()
+    inserted = skipped = invalid = 0
+    started = time.monotonic()
+    with open_text(path, 'r') as f, ProcessPoolExecutor(workers) as pool:
+        try:
+            for batch in batched(read_user_records(f, fmt), batch_size):
+                users = []
+                for line_num, record in batch:
+                    result = check_user_record(record)
+                    if isinstance(result, str):
+                        print(f'第 {line_num} 行: {result}，已跳过')
+                        invalid += 1
+                    else:
+                        users.append(result)
+                plain = [password for _, password, _ in users if password is not None]
+                hashes = iter(pool.map(generate_password_hash, plain, chunksize=max(1, len(plain) // (workers * 4))))
+                rows = [(username, password_hash or next(hashes)) for username, _, password_hash in users]
+                # 文件内重复的用户名和已存在的用户名都由 OR IGNORE 跳过
+                count = db.executemany('INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)', rows).rowcount
+                inserted += count
+                skipped += len(rows) - count
+                elapsed = time.monotonic() - started
+                print(f'已导入 {inserted}，已存在 {skipped}，无效 {invalid}（{inserted / elapsed:.0f} 个/秒）')
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+    print(f'导入完成：新增 {inserted}，已存在 {skipped}，无效 {invalid}')
+
+@app.cli.command('export-users')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='默认按扩展名判断；输出到标准输出时必须指定')
+@click.option('--media', 'media_path', help='同时把图片、视频记录导出到这个文件，格式与用户文件相同')
+def export_users_command(path, fmt, media_path):
+    """导出用户名和密码哈希，PATH 为 - 时写到标准输出"""
+    fmt = detect_format(path, fmt)
+    if not storage_ready:
+        init_storage()
+    # 直接用原始连接的游标逐行写出，内存占用与用户数无关，导出也不计入慢查询统计
+    db = sqlite3.connect(app.config['DATABASE'])
+    exports = [(path, ('username', 'password_hash'), 'SELECT username, password FROM users ORDER BY username')]
+    if media_path:
+        exports.append((media_path, ('username', 'filetype', 'filename'),
+                        "SELECT username, 'images', filename FROM images "
+                        "UNION ALL SELECT username, 'videos', filename FROM videos"))
+    for target, columns, query in exports:
+        count = 0
+        with open_text(target, 'w') as f:
+            writer = csv.writer(f) if fmt == 'csv' else None
+            if writer:
+                writer.writerow(columns)
+            for row in db.execute(query):
+                if writer:
+                    writer.writerow(tuple(row))
+                else:
+                    f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+                count += 1
+        if target != '-':
+            print(f'{target}: 导出 {count} 条')
+    db.close()
+
+#########################################
+
+############### 批量导入媒体文件 ###############
+# 把已有的照片、视频目录导入上传目录，不必通过网页逐个上传。文件按扩展名分类，由线程池
+# 并行放入分片目录：copy 复制；link 建立硬链接，不占额外空间，但源文件被修改时上传的
+# 文件也会变；reflink 在 Btrfs、XFS 等文件系统上共享数据块，写入时才复制，不支持时退回
+# 为复制。每批记录在一个事务中写入，ingested_files 记录每个源文件的大小和修改时间，
+# 重复运行时跳过没有变化的文件；目标文件名由源文件路径等信息算出，中断后重跑会覆盖
+# 上次未登记的文件，不会留下重复文件。
+
+FICLONE = 0x40049409  # linux/fs.h
+
+def reflink_or_copy(src, dst):
+    if fcntl is not None:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass  # 文件系统不支持，或跨文件系统
+    shutil.copyfile(src, dst)
+
+def place_file(src, dst, mode):
+    """把源文件放到上传目录；复制先写入同目录的隐藏临时文件再改名，中断时不会留下不完整的文件"""
+    if mode == 'link':
+        try:
+            os.link(src, dst)
+            return
+        except FileExistsError:
+            return  # 上次导入放好了文件，但没来得及登记
+        except OSError:
+            pass  # 跨文件系统或不支持硬链接，改为复制
+    tmp_path = os.path.join(os.path.dirname(dst), f'.{os.path.basename(dst)}.tmp')
+    try:
+        if mode == 'reflink':
+            reflink_or_copy(src, tmp_path)
+        else:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def classify_media(name):
+    if allowed_file(name, 'image'):
+        return 'images'
+    if allowed_file(name, 'video'):
+        return 'videos'
+    return None
+
+def iter_media_sources(root, username):
+    """遍历 root 下的所有媒体文件，产出 (源路径, 用户名, 类型, stat)，跳过隐藏文件和符号链接"""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_media_sources(entry.path, username)
+            elif entry.is_file(follow_symlinks=False):
+                filetype = classify_media(entry.name)
+                if filetype:
+                    yield entry.path, username, filetype, entry.stat(follow_symlinks=False)
+
+def ingest_filename(source, st, filetype):
+    """由源路径、大小和修改时间算出目标文件名，格式与网页上传相同：32 位十六进制 + 下划线 + 原文件名"""
+    digest = hashlib.sha1(f'{source}\0{st.st_size}\0{st.st_mtime_ns}'.encode('utf-8', 'surrogateescape')).hexdigest()[:32]
+    name = secure_filename(os.path.basename(source))
+    if classify_media(name) != filetype:
+        # 中文等字符被去掉后只剩扩展名
+        name = 'file.' + source.rsplit('.', 1)[1].lower()
+    return f'{digest}_{name}'
+
+def ingest_batch(db, batch, mode, pool):
+    """导入一批源文件，返回 (导入数, 跳过数, 失败数, 新文件列表)"""
+    known = {row['source']: row for row in db.execute(
+        f'SELECT source, size, mtime_ns, filetype, filename FROM ingested_files WHERE source IN ({",".join("?" * len(batch))})',
+        [source for source, _, _, _ in batch])}
+    todo = [(source, username, filetype, st, ingest_filename(source, st, filetype))
+            for source, username, filetype, st in batch
+            if source not in known or (known[source]['size'], known[source]['mtime_ns']) != (st.st_size, st.st_mtime_ns)]
+
+    def place(item):
+        source, _, filetype, _, filename = item
+        try:
+            place_file(source, new_upload_path(app.config[f'UPLOAD_FOLDER_{filetype.upper()}'], filename), mode)
+            return True
+        except OSError as e:
+            print(f'导入失败 {source}: {e}')
+            return False
+
+    placed = [item for item, ok in zip(todo, pool.map(place, todo)) if ok]
+    for filetype in ('images', 'videos'):
+        db.executemany(f'INSERT INTO {filetype} (username, filename) VALUES (?, ?)',
+                       [(username, filename) for _, username, t, _, filename in placed if t == filetype])
+    db.executemany('INSERT OR IGNORE INTO video_meta (filename) VALUES (?)',
+                   [(filename,) for _, _, t, _, filename in placed if t == 'videos'])
+    # 源文件修改过时会作为新文件再导入一次，这里记录最新的大小和修改时间
+    db.executemany('INSERT OR REPLACE INTO ingested_files (source, size, mtime_ns, filetype, filename) VALUES (?, ?, ?, ?, ?)',
+                   [(source, st.st_size, st.st_mtime_ns, t, filename) for source, _, t, st, filename in placed])
+    # 上一次导入的版本由新版本替换：删除旧记录和派生文件，提交之后再删除旧文件，
+    # 中途崩溃最多留下孤儿文件，由 reconcile 处理
+    replaced = [(known[source]['filetype'], known[source]['filename']) for source, _, _, _, _ in placed if source in known]
+    stale = []
+    for filetype, filename in replaced:
+        owner = db.execute(f'SELECT username FROM {filetype} WHERE filename = ?', (filename,)).fetchone()
+        remove_derived(db, filetype, filename)
+        db.execute(f'DELETE FROM {filetype} WHERE filename = ?', (filename,))
+        if owner is not None:
+            stale.append((filetype, filename, owner['username']))
+    db.commit()
+    for item in stale:
+        invalidate_media(*item)
+    for filetype, filename in replaced:
+        try:
+            os.remove(upload_path(app.config[f'UPLOAD_FOLDER_{filetype.upper()}'], filename))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f'删除旧版本失败 {filename}: {e}')
+    return len(placed), len(batch) - len(todo), len(todo) - len(placed), placed
+
+@app.cli.command('ingest-media')
+@click.argument('source', type=click.Path(exists=True, file_okay=False))
+@click.option('--user', help='所有文件都归这个用户；不指定时 SOURCE 下的每个子目录名是一个用户名')
+@click.option('--mode', type=click.Choice(['copy', 'link', 'reflink']), default='copy', show_default=True,
+              help='放入上传目录的方式')
+@click.option('--workers', default=8, show_default=True, help='同时放置的文件数')
+@click.option('--batch-size', type=click.IntRange(1, 900), default=500, show_default=True,
+              help='每批登记的文件数')
+@click.option('--no-process', is_flag=True, help='不生成封面和优化版本，之后用 process-media 等命令补处理')
+def ingest_media_command(source, user, mode, workers, batch_size, no_process):
+    """把已有目录中的图片和视频导入上传目录，可以重复运行"""
+    db = get_db()
+    root = os.path.realpath(source)
+    if user:
+        if User.get(user) is None:
+            raise click.ClickException(f'用户 {user} 不存在')
+        sources = iter_media_sources(root, user)
+    else:
+        def iter_user_dirs():
+            with os.scandir(root) as entries:
+                dirs = sorted(entry.name for entry in entries
+                              if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.'))
+            for name in dirs:
+                if User.get(name) is None:
+                    print(f'用户 {name} 不存在，跳过目录 {name}/')
+                    continue
+                yield from iter_media_sources(os.path.join(root, name), name)
+        sources = iter_user_dirs()
+    stats = Counter()
+    started = time.monotonic()
+    with ThreadPoolExecutor(workers) as pool:
+        for batch in batched(sources, batch_size):
+            ingested, skipped, failed, placed = ingest_batch(db, batch, mode, pool)
+            stats.update(ingested=ingested, skipped=skipped, failed=failed)
+            for username in {username for _, username, _, _, _ in placed}:
+                listing_cache.pop(username)
+            if not no_process:
+                for _, _, filetype, _, filename in placed:
+                    queue_media_jobs(filetype, filename)
+            elapsed = time.monotonic() - started
+            print(f'已导入 {stats["ingested"]}，未变化 {stats["skipped"]}，失败 {stats["failed"]}'
+                  f'（{(stats["ingested"] + stats["skipped"]) / elapsed:.0f} 个/秒）')
+    print(f'导入完成：新增 {stats["ingested"]}，未变化 {stats["skipped"]}，失败 {stats["failed"]}')
+    if not no_process and stats['ingested']:
+        print('等待后台处理封面和图片……')
+        # 视频处理完成后才会提交 HLS 转码，所以按这个顺序等待
+        for name in ('image', 'video', 'hls'):
+            pid, background = executors.get(name, (None, None))
+            if pid == os.getpid():
+                background.shutdown(wait=True)
+
+#########################################
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_page('index.html')
 
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limited('register', heavy=True, methods=('POST',))
 def register():
     form = RegistrationForm()
     if form.validate_on_submit():
@@ -141,21 +2376,22 @@ def register():
         User.create(username, password_hash)
         flash('注册成功，请登录', 'success')
         return redirect(url_for('login'))
-    return render_template('register.html', form=form)
+    return render_page('register.html', form=form)
 
 @app.route('/login', methods=['GET','POST'])
+@rate_limited('login', heavy=True, methods=('POST',))
 def login():
     form = LoginForm()
     if form.validate_on_submit():
         username = form.username.data.lower()
-        user = User.get(username)
-        if user and check_password_hash(user.password_hash, form.password.data):
+        user = User.authenticate(username, form.password.data)
+        if user:
             login_user(user)
             flash('登录成功', 'success')
             return redirect(url_for('profile', username=user.id))
         else:
             flash('用户名或密码错误', 'danger')
-    return render_template('login.html', form=form)
+    return render_page('login.html', form=form)
 
 @app.route('/logout')
 @login_required
@@ -166,13 +2402,15 @@ def logout():
 
 @app.route('/profile/<username>', methods=['GET', 'POST'])
 @login_required
+@rate_limited('upload', methods=('POST',))
 def profile(username):
     user = User.get(username)
     if not user:
         abort(404)
     is_owner = (username == current_user.id)
-    form = UploadForm()
-    if form.validate_on_submit() and is_owner:
+    # 只有本人能看到上传表单，其他人的主页不生成 CSRF 令牌，页面可以压缩
+    form = UploadForm() if is_owner else None
+    if is_owner and form.validate_on_submit():
         file = request.files.get('file')
         if file and file.filename != '':
             filename = secure_filename(file.filename)
@@ -189,32 +2427,39 @@ def profile(username):
 
             # 生成唯一文件名防止冲突
             unique_filename = f"{uuid4().hex}_{filename}"
-            file.save(os.path.join(save_path, unique_filename))
+            atomic_save(file.stream, new_upload_path(save_path, unique_filename))
             # 将文件信息存入数据库
-            db = get_db()
-            db.execute(f'INSERT INTO {filetype} (username, filename) VALUES (?, ?)', (username, unique_filename))
-            db.commit()
+            add_media(username, filetype, unique_filename)
             flash('上传成功', 'success')
             return redirect(url_for('profile', username=username))
         else:
             flash('请选择文件', 'warning')
     images, videos = get_user_files(username)
-    return render_template('profile.html', username=username, images=images, videos=videos, form=form, is_owner=is_owner)
+    return render_page('profile.html', username=username, images=images, videos=videos,
+                       video_meta=get_video_meta(videos), form=form, is_owner=is_owner)
 
 def get_user_files(username):
+    files = listing_cache.get(username)
+    if files is not None:
+        return files
     db = get_db()
     images = db.execute('SELECT filename FROM images WHERE username = ?', (username,)).fetchall()
     videos = db.execute('SELECT filename FROM videos WHERE username = ?', (username,)).fetchall()
     images = [i['filename'] for i in images]
     videos = [v['filename'] for v in videos]
+    listing_cache.put(username, [images, videos])
     return images, videos
 
 @app.route('/uploads/<filetype>/<filename>')
 def uploaded_file(filetype, filename):
-    if filetype not in ('images', 'videos'):
+    if filetype not in ('images', 'videos', 'posters'):
         abort(404)
-    folder = app.config['UPLOAD_FOLDER_IMAGES'] if filetype=='images' else app.config['UPLOAD_FOLDER_VIDEOS']
-    return send_from_directory(folder, filename)
+    if filetype == 'images' and image_optimization_enabled():
+        response = send_media(*pick_image_variant(filename, request.accept_mimetypes))
+        response.vary.add('Accept')
+        return response
+    folder = app.config[f'UPLOAD_FOLDER_{filetype.upper()}']
+    return send_media(folder, filename)
 
 @app.route('/delete/<filetype>/<filename>', methods=['POST'])
 @login_required
@@ -228,59 +2473,47 @@ def delete_file(filetype, filename):
         flash('无权限或文件不存在', 'danger')
         return redirect(url_for('profile', username=current_user.id))
     folder = app.config['UPLOAD_FOLDER_IMAGES'] if filetype=='images' else app.config['UPLOAD_FOLDER_VIDEOS']
-    file_path = os.path.join(folder, filename)
+    file_path = upload_path(folder, filename)
     try:
         os.remove(file_path)
-    except Exception as e:
-        print('删除文件错误:', e)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        # 文件还在时保留记录，否则文件会变成无人管理的孤儿
+        app.logger.error('删除文件失败 %s: %s', file_path, e)
+        flash('删除文件失败，请稍后重试', 'danger')
+        return redirect(url_for('profile', username=current_user.id))
+    remove_derived(db, filetype, filename)
     # 从数据库中删除记录
     db.execute(f'DELETE FROM {filetype} WHERE username = ? AND filename = ?', (current_user.id, filename))
     db.commit()
+    # 和 add_media 一样先提交再清缓存，否则并发请求可能读到旧记录又写回缓存
+    invalidate_media(filetype, filename, current_user.id)
     flash('文件已删除', 'success')
     return redirect(url_for('profile', username=current_user.id))
 
 @app.route('/search', methods=['GET', 'POST'])
 @login_required
+@rate_limited('search', heavy=True, methods=('POST',))
 def search():
     form = SearchForm()
     results = []
     if form.validate_on_submit():
         keyword = form.keyword.data.lower()
-        # 从数据库中获取所有用户名
-        db = get_db()
-        users_list = db.execute('SELECT username FROM users').fetchall()
-        users_list = [u['username'] for u in users_list]
-        # 使用LCS算法计算所有用户名与搜索关键字的匹配度
-        matches = []
-        for username in users_list:
-            score = lcs_length(keyword, username)
-            if score > 0:
-                matches.append((username, score))
-        # 按匹配度降序排序
-        matches.sort(key=lambda x: x[1], reverse=True)
-        results = [username for username, score in matches]
-    return render_template('search.html', form=form, results=results)
+        # 使用LCS算法计算所有用户名与搜索关键字的匹配度，按匹配度降序排序
+        results = rank_users(keyword)
+    return render_page('search.html', form=form, results=results)
 
 # 新增的三个接口
 
 # 1. API接口：搜索用户
 @app.route('/api/search_user')
+@rate_limited('search', heavy=True)
 def api_search_user():
     keyword = request.args.get('keyword', '').lower()
     if not keyword:
         return jsonify({'error': 'Keyword is required.'}), 400
-    db = get_db()
-    users_list = db.execute('SELECT username FROM users').fetchall()
-    users_list = [u['username'] for u in users_list]
-    matches = []
-    for username in users_list:
-        score = lcs_length(keyword, username)
-        if score > 0:
-            matches.append((username, score))
-    # 按匹配度降序排序
-    matches.sort(key=lambda x: x[1], reverse=True)
-    results = [username for username, score in matches]
-    return jsonify({'results': results})
+    return jsonify({'results': rank_users(keyword)})
 
 # 2. API接口：获取用户的所有文件信息
 @app.route('/api/user_files/<username>')
@@ -296,13 +2529,148 @@ def api_user_files(username):
 def api_download_file(username, filetype, filename):
     if filetype not in ('images', 'videos'):
         return jsonify({'error': 'Invalid file type.'}), 400
-    db = get_db()
     # 检查文件是否存在
-    file = db.execute(f'SELECT * FROM {filetype} WHERE username = ? AND filename = ?', (username, filename)).fetchone()
-    if not file:
+    if media_owner(filetype, filename) != username:
         return jsonify({'error': 'File not found.'}), 404
     folder = app.config['UPLOAD_FOLDER_IMAGES'] if filetype == 'images' else app.config['UPLOAD_FOLDER_VIDEOS']
-    return send_from_directory(folder, filename)
+    return send_media(folder, filename)
+
+# 4. API接口：查找与指定图片相似的图片（缩放、重新压缩过的副本）
+@app.route('/api/near_duplicates/<filename>')
+def api_near_duplicates(filename):
+    if not image_hashing_enabled():
+        return jsonify({'error': 'Image hashing is not enabled.'}), 404
+    max_distance = request.args.get('max_distance', NEAR_DUPLICATE_MAX_DISTANCE, type=int)
+    if not 0 <= max_distance <= NEAR_DUPLICATE_MAX_DISTANCE:
+        return jsonify({'error': f'max_distance must be between 0 and {NEAR_DUPLICATE_MAX_DISTANCE}.'}), 400
+    matches = find_near_duplicates(filename, max_distance)
+    if matches is None:
+        return jsonify({'error': 'Image not found or not hashed yet.'}), 404
+    return jsonify({'filename': filename, 'duplicates': matches})
+
+############### 采样分析 ###############
+# 定时抓取线程调用栈，输出 flamegraph.pl / speedscope 可直接读取的折叠栈格式
+# （"函数;函数;函数 次数"）。空闲时不启动任何线程，没有额外开销。
+
+profiler_lock = threading.Lock()
+request_threads = set()  # 正在处理请求的线程 id，/admin/profile 默认只采样这些线程
+
+@app.before_request
+def register_request_thread():
+    if app.config['PROFILER_ENABLED']:
+        request_threads.add(threading.get_ident())
+
+@app.teardown_request
+def unregister_request_thread(exception):
+    request_threads.discard(threading.get_ident())
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def _format_collapsed(counter):
+    return ''.join(f'{stack} {count}\n' for stack, count in counter.most_common())
+
+def sample_stacks(seconds, interval, exclude=(), all_threads=False):
+    """默认只采样当时正在处理请求的线程；all_threads 为 True 时采样整个进程，
+    包括缓存失效订阅、后台转码、采样器自身等线程"""
+    counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id not in exclude and (all_threads or thread_id in request_threads):
+                counter[_collapse(frame)] += 1
+        time.sleep(interval)
+    return counter
+
+def _sample_thread(thread_id, interval, stop, counter):
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            counter[_collapse(frame)] += 1
+
+# 带 X-Profile 头的请求（仅管理员）：采样处理该请求的线程，响应体替换为折叠栈
+@app.before_request
+def start_request_profile():
+    if not app.config['PROFILER_ENABLED'] or 'X-Profile' not in request.headers:
+        return
+    if not current_user.is_authenticated or current_user.id not in app.config['ADMIN_USERS']:
+        return
+    stop = threading.Event()
+    counter = Counter()
+    sampler = threading.Thread(target=_sample_thread, daemon=True,
+                               args=(threading.get_ident(), 0.001, stop, counter))
+    sampler.start()
+    g.request_profile = (sampler, stop, counter)
+
+@app.after_request
+def finish_request_profile(response):
+    profile = g.pop('request_profile', None)
+    if profile is None:
+        return response
+    sampler, stop, counter = profile
+    stop.set()
+    sampler.join()
+    response.close()
+    return app.response_class(_format_collapsed(counter), mimetype='text/plain',
+                              headers={'X-Profiled-Status': str(response.status_code)})
+
+############### 管理接口 ###############
+
+# 采样正在处理请求的线程 N 秒，返回折叠栈；threads=all 时采样进程内所有线程
+@app.route('/admin/profile')
+@admin_required
+def admin_profile():
+    if not app.config['PROFILER_ENABLED']:
+        abort(404)
+    seconds = min(request.args.get('seconds', 5, type=float), app.config['PROFILER_MAX_SECONDS'])
+    interval = max(request.args.get('interval', 0.005, type=float), 0.001)
+    if not profiler_lock.acquire(blocking=False):
+        return jsonify({'error': 'Profiler is already running.'}), 409
+    try:
+        counter = sample_stacks(seconds, interval, exclude={threading.get_ident()},
+                                all_threads=request.args.get('threads') == 'all')
+    finally:
+        profiler_lock.release()
+    return _format_collapsed(counter), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+# 按总耗时降序列出每条 SQL 的执行统计
+@app.route('/admin/sql_stats')
+@admin_required
+def admin_sql_stats():
+    with metrics_lock:
+        items = [(sql, list(stats)) for sql, stats in query_stats.items()]
+    items.sort(key=lambda item: item[1][1], reverse=True)
+    return jsonify({
+        'enabled': app.config['SLOW_QUERY_LOG'],
+        'threshold_ms': app.config['SLOW_QUERY_THRESHOLD_MS'],
+        'statements': [{
+            'sql': sql,
+            'count': count,
+            'total_ms': round(total * 1000, 3),
+            'avg_ms': round(total * 1000 / count, 3),
+            'max_ms': round(worst * 1000, 3),
+            'slow': slow,
+        } for sql, (count, total, worst, slow) in items],
+    })
+
+############### 应用配置 ###############
+# 导入本模块不会创建目录或数据库，初始化推迟到 configure_app() 或第一次访问数据库时。
+# 预加载模式（gunicorn --preload "app:configure_app()"）下主进程完成初始化，
+# fork 出的 worker 无需再做任何事；不预加载时各 worker 的初始化也是幂等的。
+
+def configure_app(config=None):
+    """更新模块级 app 的配置并初始化存储，返回同一个 app。
+    路由、钩子都注册在导入时创建的这个全局 app 上，这里不是工厂函数：每次调用修改的
+    都是同一个对象，一个进程中不能用不同配置得到多个互相独立的应用"""
+    if config:
+        app.config.update(config)
+    init_storage()
+    return app
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    configure_app().run(debug=True)
@@ -0,0 +1,451 @@
+"""
+ASGI 入口：大文件的上传、下载和文件列表由协程处理，其余请求交给 Flask。
+
+    pip install uvicorn
+    uvicorn asgi:application --workers 4
+
+WSGI 模式下每个传输占用一个线程直到传完，慢客户端会把线程池耗尽。这里的协程只在
+真正读写磁盘、访问数据库时借用线程（asyncio.to_thread），等待网络的时间不占线程，
+几千个慢连接只是几千个协程。
+
+异步处理的路由：
+    GET/HEAD /uploads/<filetype>/<filename>                     支持 Range 断点续传
+    GET/HEAD /api/download_file/<username>/<filetype>/<filename>
+    GET      /api/user_files/<username>
+    PUT      /api/upload/<filename>      请求体即文件内容，需要登录，返回保存后的文件名
+
+其他路由（页面、表单、/metrics 等）在线程池中按 WSGI 方式运行，行为与 python app.py 一致。
+"""
+import asyncio
+import json
+import math
+import mimetypes
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from time import perf_counter
+from uuid import uuid4
+
+from itsdangerous import BadSignature
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import (http_date, parse_accept_header, parse_cookie, parse_date, parse_etags,
+                           parse_range_header, quote_etag)
+from werkzeug.utils import secure_filename
+
+import app as share
+from compression import compress, pick_encoding
+
+app = share.app
+READ_SIZE = 256 * 1024         # 下载时每次读取的字节数
+WRITE_SIZE = 1024 * 1024       # 上传时攒够这么多再写一次磁盘，减少线程切换
+SPOOL_SIZE = 1024 * 1024       # 转交 Flask 的请求体超过这个大小写入临时文件
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+############### 通用工具 ###############
+
+def _in_app_context(func, *args):
+    with app.app_context():
+        return func(*args)
+
+async def run_in_app(func, *args):
+    """在线程中带应用上下文执行 func，可以使用 get_db() 等 Flask 工具"""
+    return await asyncio.to_thread(_in_app_context, func, *args)
+
+def request_headers(scope):
+    return {k.decode('latin-1'): v.decode('latin-1') for k, v in scope['headers']}
+
+def content_length(scope):
+    """Content-Length 请求头，没有时返回 None；不是非负整数时抛出 ValueError，调用方返回 400"""
+    length = request_headers(scope).get('content-length')
+    if length is None:
+        return None
+    if not re.fullmatch(r'[0-9]+', length.strip()):  # int() 还接受 '-1'、'+5'、'1_000'
+        raise ValueError(f'Content-Length 格式不正确: {length!r}')
+    return int(length)
+
+async def send_response(send, status, headers, body=b''):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(k.encode('latin-1'), str(v).encode('latin-1')) for k, v in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_json(send, status, data, scope=None, extra_headers=()):
+    """传入 scope 时与 Flask 响应一样按 Accept-Encoding 压缩较大的 JSON"""
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    headers = [('content-type', 'application/json'), *extra_headers]
+    if scope is not None and app.config['COMPRESS_ENABLED'] and len(body) >= app.config['COMPRESS_MIN_SIZE']:
+        headers.append(('vary', 'Accept-Encoding'))
+        encoding = pick_encoding(parse_accept_header(request_headers(scope).get('accept-encoding')))
+        if encoding is not None:
+            body = await asyncio.to_thread(compress, body, encoding, app.config['COMPRESS_LEVEL'])
+            headers.append(('content-encoding', encoding))
+    await send_response(send, status, headers + [('content-length', len(body))], body)
+
+def session_user(scope):
+    """从 Flask 的 session cookie 中取出 Flask-Login 保存的用户名，未登录返回 None"""
+    cookies = parse_cookie(request_headers(scope).get('cookie', ''))
+    value = cookies.get(app.config['SESSION_COOKIE_NAME'])
+    if not value:
+        return None
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        data = serializer.loads(value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    return data.get('_user_id')
+
+async def wait_for_disconnect(receive, event):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            event.set()
+            return
+
+
+############### 下载 ###############
+
+def _open_upload(folder, filename, info):
+    """打开文件并用 fstat 核对缓存的元数据；文件已被移走时重新查找一次"""
+    try:
+        f = open(info.path, 'rb')
+    except FileNotFoundError:
+        info = share.file_info(folder, filename, refresh=True)
+        if info is None:
+            return None, None
+        f = open(info.path, 'rb')
+    st = os.fstat(f.fileno())
+    if st.st_size != info.size or st.st_mtime_ns != info.mtime_ns:
+        info = share.cache_file_info(folder, filename, info.path, st)
+    return f, info
+
+async def send_upload_file(scope, receive, send, folder, filename, extra_headers=()):
+    # 元数据命中本地缓存时不需要借用线程
+    info = share.file_cache.peek((folder, filename))
+    if info is None:
+        info = await asyncio.to_thread(share.file_info, folder, filename)
+    if info is None:
+        return await send_response(send, 404, [('content-type', 'text/plain')], b'Not Found')
+
+    headers = request_headers(scope)
+    if_none_match = headers.get('if-none-match')
+    since = parse_date(headers.get('if-modified-since'))
+    if if_none_match is not None:
+        not_modified = parse_etags(if_none_match).contains_weak(info.etag)
+    else:
+        not_modified = since is not None and info.mtime.replace(microsecond=0) <= since
+    if not_modified:
+        return await send_response(send, 304, [('etag', quote_etag(info.etag)),
+                                               ('last-modified', http_date(info.mtime)), *extra_headers])
+
+    try:
+        f, info = await asyncio.to_thread(_open_upload, folder, filename, info)
+    except OSError:
+        f = None
+    if f is None:
+        return await send_response(send, 404, [('content-type', 'text/plain')], b'Not Found')
+    try:
+        size = info.size
+        base_headers = [
+            ('content-type', mimetypes.guess_type(filename)[0] or 'application/octet-stream'),
+            ('etag', quote_etag(info.etag)),
+            ('last-modified', http_date(info.mtime)),
+            ('accept-ranges', 'bytes'),
+            *extra_headers,
+        ]
+
+        # 上传的文件名带随机前缀、内容不会改变，不需要处理 If-Range；多段 Range 按整个文件返回
+        start, stop, status = 0, size, 200
+        rng = parse_range_header(headers.get('range'))
+        if rng is not None and len(rng.ranges) == 1:
+            bounds = rng.range_for_length(size)
+            if bounds is None:
+                return await send_response(send, 416, base_headers + [('content-range', f'bytes */{size}')])
+            start, stop = bounds
+            status = 206
+            base_headers.append(('content-range', f'bytes {start}-{stop - 1}/{size}'))
+        base_headers.append(('content-length', stop - start))
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(k.encode('latin-1'), str(v).encode('latin-1')) for k, v in base_headers]})
+        if scope['method'] == 'HEAD':
+            return await send({'type': 'http.response.body', 'body': b''})
+
+        # 客户端中途断开时及时停止读盘，不把剩下的文件读完
+        disconnected = asyncio.Event()
+        watcher = asyncio.create_task(wait_for_disconnect(receive, disconnected))
+        try:
+            await asyncio.to_thread(f.seek, start)
+            remaining = stop - start
+            while remaining > 0 and not disconnected.is_set():
+                chunk = await asyncio.to_thread(f.read, min(READ_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+            if remaining > 0 and not disconnected.is_set():
+                # 文件在发送过程中被截断，已声明的长度无法满足，只能中断连接
+                raise OSError(f'{info.path} 在发送过程中被截断')
+        finally:
+            watcher.cancel()
+    finally:
+        await asyncio.to_thread(f.close)
+
+def _upload_folder(filetype):
+    return app.config['UPLOAD_FOLDER_IMAGES'] if filetype == 'images' else app.config['UPLOAD_FOLDER_VIDEOS']
+
+async def uploaded_file(scope, receive, send, filetype, filename):
+    if filetype == 'images' and share.image_optimization_enabled():
+        # 与 Flask 路由相同，按 Accept 选择图片的优化版本
+        accept = parse_accept_header(request_headers(scope).get('accept'), MIMEAccept)
+        folder, name = await run_in_app(share.pick_image_variant, filename, accept)
+        return await send_upload_file(scope, receive, send, folder, name, [('vary', 'Accept')])
+    await send_upload_file(scope, receive, send, _upload_folder(filetype), filename)
+
+async def api_download_file(scope, receive, send, username, filetype, filename):
+    owner = share.owner_cache.peek((filetype, filename))
+    if owner is None:
+        owner = await run_in_app(share.media_owner, filetype, filename)
+    if owner != username:
+        return await send_json(send, 404, {'error': 'File not found.'})
+    await send_upload_file(scope, receive, send, _upload_folder(filetype), filename)
+
+
+############### 文件列表 ###############
+
+def _user_files(username):
+    if not share.User.get(username):
+        return None
+    return share.get_user_files(username)
+
+async def api_user_files(scope, receive, send, username):
+    files = await run_in_app(_user_files, username)
+    if files is None:
+        return await send_json(send, 404, {'error': 'User not found.'})
+    images, videos = files
+    await send_json(send, 200, {'username': username, 'images': images, 'videos': videos}, scope)
+
+
+############### 上传 ###############
+# 使用 PUT 而不是表单提交：跨站页面无法在没有 CORS 许可的情况下发出 PUT 请求，
+# 因此不需要 CSRF 令牌，客户端直接 fetch(url, {method: 'PUT', body: file}) 即可。
+
+def _record_upload(username, filetype, filename):
+    if not share.User.get(username):
+        return False
+    share.add_media(username, filetype, filename)
+    return True
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+async def receive_to_file(receive, f, limit):
+    """把请求体写入 f，超过 limit 返回 False"""
+    total = 0
+    buffered = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+        chunk = message.get('body', b'')
+        total += len(chunk)
+        if total > limit:
+            return False
+        buffered += chunk
+        more = message.get('more_body', False)
+        if len(buffered) >= WRITE_SIZE or (not more and buffered):
+            await asyncio.to_thread(f.write, buffered)
+            buffered = bytearray()
+        if not more:
+            return True
+
+async def api_upload(scope, receive, send, filename):
+    username = session_user(scope)
+    if not username:
+        return await send_json(send, 401, {'error': 'Login required.'})
+    client_ip = scope['client'][0] if scope.get('client') else None
+    wait = await asyncio.to_thread(share.rate_limit_wait, 'upload', username, client_ip)
+    if wait:
+        return await send_json(send, 429, {'error': 'Too many requests.'},
+                               extra_headers=[('retry-after', math.ceil(wait))])
+    filename = secure_filename(filename)
+    if share.allowed_file(filename, 'image'):
+        filetype = 'images'
+    elif share.allowed_file(filename, 'video'):
+        filetype = 'videos'
+    else:
+        return await send_json(send, 400, {'error': 'Unsupported file type.'})
+    limit = app.config['MAX_CONTENT_LENGTH']
+    try:
+        length = content_length(scope)
+    except ValueError:
+        return await send_json(send, 400, {'error': 'Invalid Content-Length.'})
+    if length is not None and length > limit:
+        return await send_json(send, 413, {'error': 'File too large.'})
+
+    folder = _upload_folder(filetype)
+    unique_filename = f'{uuid4().hex}_{filename}'
+    # 先写入临时文件，完整收到后再改名，中断的上传不会留下半个文件
+    tmp_path = os.path.join(folder, f'.tmp-{uuid4().hex}')
+    f = await asyncio.to_thread(open, tmp_path, 'wb')
+    saved = False
+    try:
+        complete = await receive_to_file(receive, f, limit)
+        if not complete:
+            return await send_json(send, 413, {'error': 'File too large.'})
+        await asyncio.to_thread(share.sync_upload_file, f)
+        await asyncio.to_thread(f.close)
+        final_path = await asyncio.to_thread(share.new_upload_path, folder, unique_filename)
+        await asyncio.to_thread(os.replace, tmp_path, final_path)
+        saved = True
+        await asyncio.to_thread(share.sync_upload_dir, final_path)
+        if not await run_in_app(_record_upload, username, filetype, unique_filename):
+            await asyncio.to_thread(_remove, final_path)
+            return await send_json(send, 401, {'error': 'Login required.'})
+    finally:
+        if not f.closed:
+            await asyncio.to_thread(f.close)
+        if not saved:
+            await asyncio.to_thread(_remove, tmp_path)
+    await send_json(send, 201, {'filetype': filetype, 'filename': unique_filename})
+
+
+############### 转交 Flask ###############
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+        environ[name] = value
+    return environ
+
+def run_wsgi(scope, body, send, loop):
+    """在线程中运行 Flask，响应通过事件循环逐块发回"""
+    def push(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    result = app(build_environ(scope, body), start_response)
+    try:
+        push({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+        for chunk in result:
+            if chunk:
+                push({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        push({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+async def call_flask(scope, receive, send):
+    limit = app.config['MAX_CONTENT_LENGTH']
+    try:
+        length = content_length(scope)
+    except ValueError:
+        return await send_response(send, 400, [('content-type', 'text/plain')], b'Bad Request')
+    if length is not None and length > limit:
+        return await send_response(send, 413, [('content-type', 'text/plain')], b'Request Entity Too Large')
+    with SpooledTemporaryFile(max_size=SPOOL_SIZE) as body:
+        total = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunk = message.get('body', b'')
+            total += len(chunk)
+            if total > limit:
+                return await send_response(send, 413, [('content-type', 'text/plain')], b'Request Entity Too Large')
+            if chunk:
+                await asyncio.to_thread(body.write, chunk)
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+        await asyncio.to_thread(run_wsgi, scope, body, send, asyncio.get_running_loop())
+
+
+############### 路由 ###############
+
+ROUTES = [
+    (re.compile(r'/uploads/(images|videos)/([^/]+)'), ('GET', 'HEAD'), uploaded_file),
+    (re.compile(r'/api/download_file/([^/]+)/(images|videos)/([^/]+)'), ('GET', 'HEAD'), api_download_file),
+    (re.compile(r'/api/user_files/([^/]+)'), ('GET',), api_user_files),
+    (re.compile(r'/api/upload/([^/]+)'), ('PUT',), api_upload),
+]
+
+def find_route(scope):
+    for pattern, methods, handler in ROUTES:
+        match = pattern.fullmatch(scope['path'])
+        if match and scope['method'] in methods:
+            return handler, match.groups()
+    return None, ()
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # 线程只用于磁盘和数据库操作以及普通 Flask 请求，不随连接数增长
+            loop = asyncio.get_running_loop()
+            loop.set_default_executor(ThreadPoolExecutor(app.config['ASGI_THREADS'], thread_name_prefix='asgi-io'))
+            await asyncio.to_thread(share.configure_app)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    handler, args = find_route(scope)
+    if handler is None:
+        # Flask 路由的耗时由 app.py 中的请求钩子统计
+        return await call_flask(scope, receive, send)
+    if not app.config['METRICS_ENABLED']:
+        return await handler(scope, receive, send, *args)
+
+    status = 500
+    async def timed_send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        await send(message)
+    start = perf_counter()
+    try:
+        await handler(scope, receive, timed_send, *args)
+    finally:
+        share.observe(share.request_histograms, (handler.__name__, scope['method'], status), perf_counter() - start)
@@ -0,0 +1,405 @@
+"""
+压测与基准脚本
+
+在临时目录里生成合成数据（默认 10 万用户、100 万条图片/视频记录，以及若干真实文件），
+把 app.py、无脑云盘.py、超级精简版.py 分别跑在本地端口上，按固定并发压测真实接口，
+输出每个场景的 p50/p95/p99 延迟和吞吐量（JSON），便于在不同提交之间对比。
+
+用法：
+    python benchmark.py                         # 默认规模，结果打印到标准输出
+    python benchmark.py --users 1000 --media 10000 --output before.json
+    python benchmark.py --workdir /tmp/bench --reuse --compare before.json
+    python benchmark.py --accept-encoding gzip   # 带 Accept-Encoding 请求，对比响应压缩后的大小和耗时
+    python benchmark.py --only upload --fsync file+dir --compare before.json   # 对比上传刷盘策略的开销
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from flask import session
+from flask_wtf.csrf import generate_csrf
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_USER = 'benchuser'
+BENCH_IMAGES = 200
+BENCH_VIDEOS = 20
+LISTING_FILES = 1000
+
+
+def load_module(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module  # Flask 根据模块查找 root_path 和模板目录
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_random_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+
+
+############### 生成数据 ###############
+
+def seed_share_app(app_module, workdir, users, media):
+    app = app_module.app
+    db = sqlite3.connect(app.config['DATABASE'])
+    # 所有合成用户共用一个密码哈希，避免生成数据时耗在哈希上
+    password_hash = generate_password_hash('benchmark')
+    with db:
+        db.execute('INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)', (BENCH_USER, password_hash))
+        db.executemany('INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)',
+                       ((f'user{i:06d}', password_hash) for i in range(users)))
+
+    images, videos = [], []
+    for i in range(BENCH_IMAGES):
+        name = f'{uuid4().hex}_bench{i}.jpg'
+        write_random_file(app_module.new_upload_path(app.config['UPLOAD_FOLDER_IMAGES'], name), 100 * 1024)
+        images.append(name)
+    for i in range(BENCH_VIDEOS):
+        name = f'{uuid4().hex}_bench{i}.mp4'
+        write_random_file(app_module.new_upload_path(app.config['UPLOAD_FOLDER_VIDEOS'], name), 2 * 1024 * 1024)
+        videos.append(name)
+
+    rng = random.Random(0)
+    with db:
+        db.executemany('INSERT INTO images (username, filename) VALUES (?, ?)', ((BENCH_USER, n) for n in images))
+        db.executemany('INSERT INTO videos (username, filename) VALUES (?, ?)', ((BENCH_USER, n) for n in videos))
+        # 其余记录只写数据库，不落真实文件，80% 图片 20% 视频
+        for table, count in (('images', media * 4 // 5), ('videos', media - media * 4 // 5)):
+            db.executemany(f'INSERT INTO {table} (username, filename) VALUES (?, ?)',
+                           ((f'user{rng.randrange(max(users, 1)):06d}', f'{uuid4().hex}_synthetic') for _ in range(count)))
+    db.close()
+    return {'images': images, 'videos': videos}
+
+
+def seed_cloud_drive(module):
+    with sqlite3.connect(module.DATABASE) as conn:
+        conn.execute('INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)',
+                     (BENCH_USER, generate_password_hash('benchmark')))
+    listing = os.path.join(module.app.config['UPLOAD_FOLDER'], BENCH_USER, 'listing')
+    os.makedirs(listing, exist_ok=True)
+    os.makedirs(os.path.join(module.app.config['UPLOAD_FOLDER'], BENCH_USER, 'incoming'), exist_ok=True)
+    for i in range(LISTING_FILES):
+        write_random_file(os.path.join(listing, f'file{i:05d}.bin'), 1024)
+
+
+def seed_file_manager(module):
+    listing = os.path.join(module.ROOT_DIR, 'listing')
+    os.makedirs(listing, exist_ok=True)
+    os.makedirs(os.path.join(module.ROOT_DIR, 'incoming'), exist_ok=True)
+    for i in range(LISTING_FILES):
+        write_random_file(os.path.join(listing, f'file{i:05d}.bin'), 1024)
+
+
+############### 服务与请求 ###############
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class Server:
+    def __init__(self, app):
+        self.httpd = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        self.port = self.httpd.server_port
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+
+
+def session_cookie(app, data):
+    # 直接签发会话 cookie，跳过登录页（验证码、密码哈希都不在压测范围内）
+    value = app.session_interface.get_signing_serializer(app).dumps(data)
+    return f"{app.config['SESSION_COOKIE_NAME']}={value}"
+
+
+def csrf_session(app, data):
+    # 和真实表单一样带上 CSRF 令牌：原始令牌放进会话，签名后的令牌随表单提交
+    with app.test_request_context():
+        session.update(data)
+        token = generate_csrf()
+        return session_cookie(app, dict(session)), token
+
+
+def multipart(fields, files):
+    boundary = uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def do_request(port, method, path, headers, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    try:
+        start = time.perf_counter()
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        # http.client 不会解压，读到的就是实际传输的字节数
+        size = len(response.read())
+        return time.perf_counter() - start, response.status, size
+    finally:
+        conn.close()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    # 最近秩法
+    rank = math.ceil(q / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def run_scenario(port, make_request, concurrency, max_requests, max_seconds, accept_encoding=None):
+    latencies = []
+    sizes = []
+    errors = 0
+    lock = threading.Lock()
+    issued = [0]
+    deadline = time.perf_counter() + max_seconds
+
+    def worker(seed):
+        nonlocal errors
+        rng = random.Random(seed)
+        while True:
+            with lock:
+                if issued[0] >= max_requests or time.perf_counter() > deadline:
+                    return
+                issued[0] += 1
+            method, path, headers, body = make_request(rng)
+            if accept_encoding:
+                headers = dict(headers, **{'Accept-Encoding': accept_encoding})
+            try:
+                elapsed, status, size = do_request(port, method, path, headers, body)
+            except OSError:
+                elapsed, status, size = None, 0, 0
+            with lock:
+                if elapsed is None or status >= 400:
+                    errors += 1
+                else:
+                    latencies.append(elapsed)
+                    sizes.append(size)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'seconds': round(wall, 3),
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'max_ms': ms(latencies[-1] if latencies else None),
+        'mean_bytes': round(sum(sizes) / len(sizes)) if sizes else None,
+    }
+
+
+def random_keyword(rng):
+    return ''.join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(3))
+
+
+def share_app_scenarios(app, seeded):
+    cookie, token = csrf_session(app, {'_user_id': BENCH_USER, '_fresh': True})
+    cookie = {'Cookie': cookie}
+    images, videos, users = seeded['images'], seeded['videos'], max(seeded['users'], 1)
+    payload = os.urandom(64 * 1024)
+
+    def search(rng):
+        body = f'csrf_token={token}&keyword={random_keyword(rng)}'.encode()
+        return 'POST', '/search', dict(cookie, **{'Content-Type': 'application/x-www-form-urlencoded'}), body
+
+    def upload(rng):
+        body, content_type = multipart({'csrf_token': token},
+                                       {'file': (f'bench{rng.randrange(10 ** 6)}.jpg', payload)})
+        return 'POST', f'/profile/{BENCH_USER}', dict(cookie, **{'Content-Type': content_type}), body
+
+    return {
+        'share.search': search,
+        'share.api_search_user': lambda rng: ('GET', f'/api/search_user?keyword={random_keyword(rng)}', {}, None),
+        'share.profile': lambda rng: ('GET', f'/profile/{BENCH_USER}', cookie, None),
+        # 别人的主页没有上传表单，也就没有 CSRF 令牌，可以压缩
+        'share.profile_other': lambda rng: ('GET', f'/profile/user{rng.randrange(users):06d}', cookie, None),
+        'share.uploads_image': lambda rng: ('GET', f'/uploads/images/{rng.choice(images)}', {}, None),
+        'share.uploads_video': lambda rng: ('GET', f'/uploads/videos/{rng.choice(videos)}', {}, None),
+        'share.api_download_file': lambda rng: (
+            'GET', f'/api/download_file/{BENCH_USER}/images/{rng.choice(images)}', {}, None),
+        'share.upload': upload,
+    }
+
+
+def cloud_drive_scenarios(app):
+    cookie = {'Cookie': session_cookie(app, {'username': BENCH_USER})}
+    payload = os.urandom(64 * 1024)
+
+    def upload(rng):
+        body, content_type = multipart({'path': 'incoming'}, {'file': (f'{uuid4().hex}.bin', payload)})
+        return 'POST', '/upload', dict(cookie, **{'Content-Type': content_type}), body
+
+    return {
+        'cloud.listing': lambda rng: ('GET', '/listing', cookie, None),
+        'cloud.upload': upload,
+    }
+
+
+def file_manager_scenarios():
+    payload = os.urandom(64 * 1024)
+
+    def upload(rng):
+        body, content_type = multipart({'path': 'incoming'}, {'files': (f'{uuid4().hex}.bin', payload)})
+        return 'POST', '/upload', {'Content-Type': content_type}, body
+
+    return {
+        'mini.list': lambda rng: ('GET', '/list?path=listing', {}, None),
+        'mini.upload': upload,
+    }
+
+
+############### 结果对比 ###############
+
+def compare(previous, current):
+    print(f"{'场景':<28}{'指标':<16}{'之前':>12}{'现在':>12}{'变化':>10}", file=sys.stderr)
+    for name, result in current['results'].items():
+        before = previous.get('results', {}).get(name)
+        if not before:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'mean_bytes'):
+            old, new = before.get(key), result.get(key)
+            if old and new:
+                change = (new - old) / old * 100
+                print(f'{name:<28}{key:<16}{old:>12}{new:>12}{change:>+9.1f}%', file=sys.stderr)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对各应用的真实接口进行压测')
+    parser.add_argument('--users', type=int, default=100_000, help='合成用户数')
+    parser.add_argument('--media', type=int, default=1_000_000, help='合成图片/视频记录数')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发请求数')
+    parser.add_argument('--requests', type=int, default=2000, help='每个场景最多请求数')
+    parser.add_argument('--seconds', type=float, default=30, help='每个场景最长运行秒数')
+    parser.add_argument('--only', help='只运行名称包含该字符串的场景，如 share. 或 upload')
+    parser.add_argument('--workdir', help='数据目录，默认使用临时目录')
+    parser.add_argument('--reuse', action='store_true', help='数据目录已生成过数据时直接复用')
+    parser.add_argument('--output', help='结果写入该 JSON 文件，默认打印到标准输出')
+    parser.add_argument('--compare', help='与之前保存的结果 JSON 对比')
+    parser.add_argument('--accept-encoding', help='所有请求带上该 Accept-Encoding 头，如 gzip 或 "br, gzip"')
+    parser.add_argument('--fsync', choices=('none', 'file', 'file+dir'), default='none',
+                        help='三个应用保存上传文件时的刷盘策略（UPLOAD_FSYNC）')
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='bench-'))
+    os.makedirs(workdir, exist_ok=True)
+    marker = os.path.join(workdir, '.seeded.json')
+    reuse = args.reuse and os.path.exists(marker)
+    # 三个应用都以当前目录为基准存放数据，先切换到数据目录再导入
+    os.chdir(workdir)
+
+    share = load_module('bench_share_app', 'app.py')
+    share.configure_app({
+        'DATABASE': os.path.join(workdir, 'database.db'),
+        'UPLOAD_FOLDER_IMAGES': os.path.join(workdir, 'static', 'uploads', 'images'),
+        'UPLOAD_FOLDER_VIDEOS': os.path.join(workdir, 'static', 'uploads', 'videos'),
+        'IMAGE_HASH_ENABLED': False,  # 上传场景只测保存文件本身，随机数据也算不出哈希
+        'UPLOAD_FSYNC': args.fsync,
+    })
+    cloud = load_module('bench_cloud_drive', '无脑云盘.py')
+    cloud.configure_app({'UPLOAD_FSYNC': args.fsync})
+    mini = load_module('bench_file_manager', '超级精简版.py')
+    mini.UPLOAD_FSYNC = args.fsync
+
+    if reuse:
+        with open(marker, encoding='utf-8') as f:
+            seeded = json.load(f)
+    else:
+        print(f'生成数据到 {workdir} ...', file=sys.stderr)
+        seeded = seed_share_app(share, workdir, args.users, args.media)
+        seed_cloud_drive(cloud)
+        seed_file_manager(mini)
+        seeded.update(users=args.users, media=args.media)
+        with open(marker, 'w', encoding='utf-8') as f:
+            json.dump(seeded, f)
+
+    targets = [
+        (share.app, share_app_scenarios(share.app, seeded)),
+        (cloud.app, cloud_drive_scenarios(cloud.app)),
+        (mini.app, file_manager_scenarios()),
+    ]
+    results = {}
+    for app, scenarios in targets:
+        server = Server(app)
+        try:
+            for name, make_request in scenarios.items():
+                if args.only and args.only not in name:
+                    continue
+                print(f'运行 {name} ...', file=sys.stderr)
+                results[name] = run_scenario(server.port, make_request, args.concurrency,
+                                             args.requests, args.seconds, args.accept_encoding)
+        finally:
+            server.stop()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'users': seeded['users'],
+            'media': seeded['media'],
+            'concurrency': args.concurrency,
+            'max_requests': args.requests,
+            'max_seconds': args.seconds,
+            'accept_encoding': args.accept_encoding,
+            'fsync': args.fsync,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
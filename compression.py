@@ -0,0 +1,137 @@
+"""
+响应压缩和带指纹的静态资源，app.py、一键运行.py、无脑云盘.py、超级精简版.py 共用
+
+页面和 JSON 按 Accept-Encoding 压缩，优先 brotli（需要安装 brotli），其次 gzip。配置项：
+COMPRESS_ENABLED、COMPRESS_MIN_SIZE、COMPRESS_LEVEL（gzip 级别，brotli 固定 quality 5）、
+ASSET_MAX_AGE，没有设置时使用 init_compression() 中的默认值。
+
+BREACH：攻击者能让页面反射自己的输入、又能观察压缩后的长度时，可以逐个字符猜出同一个
+响应中的秘密。所以正文中出现了 CSRF 令牌（Flask-WTF 放在 g.csrf_token）或调用过
+skip_compression() 的响应不压缩；只生成了令牌、页面上没有输出的响应，以及其余页面、
+JSON 和静态资源照常压缩。
+
+Bootstrap 等第三方资源放在 static/vendor 下，模板中用 asset_url() 生成带内容指纹的地址
+/assets/<指纹>/<路径>，浏览器可以缓存一年；文件更新后指纹随之变化，页面自然引用新地址。
+资源压缩后的内容按进程缓存，只压缩一次。
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from contextlib import nullcontext
+
+from flask import abort, current_app, g, request, url_for
+from werkzeug.security import safe_join
+try:
+    import brotli
+except ImportError:  # 没有安装 brotli 时只使用 gzip
+    brotli = None
+
+COMPRESSIBLE_TYPES = {'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+                      'application/json', 'image/svg+xml'}
+
+def pick_encoding(accept_encodings):
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress(data, encoding, level=6, best=False):
+    """best 为 True 时使用最高压缩率，用于只压缩一次的静态资源"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else 5)
+    return gzip.compress(data, compresslevel=9 if best else level, mtime=0)
+
+def skip_compression():
+    """响应中带有 CSRF 令牌以外的秘密（例如加密密钥）时，在视图中调用"""
+    g.skip_compression = True
+
+def carries_secret(response):
+    if g.get('skip_compression', False):
+        return True
+    # 表单构造时就会生成令牌，但页面不一定输出它，只看正文中是否真的有
+    token = g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+    return token is not None and token.encode() in response.get_data()
+
+def compress_response(response):
+    config = current_app.config
+    if (not config['COMPRESS_ENABLED'] or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESSIBLE_TYPES or 'Content-Encoding' in response.headers
+            or 'Content-Range' in response.headers):
+        return response
+    if (response.content_length or 0) < config['COMPRESS_MIN_SIZE'] or carries_secret(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = pick_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    with current_app.extensions['compression']['timer']():
+        response.set_data(compress(response.get_data(), encoding, config['COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = encoding
+    # 压缩后的内容不同，ETag 也要不同，否则缓存可能把 gzip 版本发给不支持的客户端
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
+
+def asset_folder():
+    return os.path.join(current_app.static_folder, 'vendor')
+
+def asset_version(filename):
+    """资源内容的指纹，文件不存在时返回 None；按进程缓存，更新资源后需要重启"""
+    versions = current_app.extensions['compression']['versions']
+    version = versions.get(filename)
+    if version is None:
+        path = safe_join(asset_folder(), filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            version = versions[filename] = hashlib.sha256(f.read()).hexdigest()[:12]
+    return version
+
+def asset_url(filename):
+    return url_for('asset', version=asset_version(filename) or '0', filename=filename)
+
+def asset(version, filename):
+    current = asset_version(filename)
+    if current is None:
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = pick_encoding(request.accept_encodings) if mimetype in COMPRESSIBLE_TYPES else None
+    bodies = current_app.extensions['compression']['bodies']
+    key = (filename, current, encoding)
+    body = bodies.get(key)
+    if body is None:
+        with open(safe_join(asset_folder(), filename), 'rb') as f:
+            body = f.read()
+        if encoding is not None:
+            body = compress(body, encoding, best=True)
+        bodies[key] = body
+    response = current_app.response_class(body, mimetype=mimetype)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if mimetype in COMPRESSIBLE_TYPES:
+        response.vary.add('Accept-Encoding')
+    if version == current:
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['ASSET_MAX_AGE']
+        response.cache_control.immutable = True
+    else:
+        # 页面引用的是旧版本，内容已经变了，不能让浏览器长期缓存
+        response.cache_control.no_cache = True
+    response.set_etag(f'{current}-{encoding or "identity"}')
+    return response.make_conditional(request)
+
+def init_compression(app, assets=True, timer=None):
+    """注册压缩钩子；assets 为 True 时同时注册 /assets 路由和模板函数 asset_url()。
+    timer 为返回上下文管理器的函数，用来统计压缩耗时"""
+    app.config.setdefault('COMPRESS_ENABLED', True)
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('ASSET_MAX_AGE', 365 * 24 * 3600)
+    app.extensions['compression'] = {'timer': timer or nullcontext, 'versions': {}, 'bodies': {}}
+    app.after_request(compress_response)
+    if assets:
+        app.add_url_rule('/assets/<version>/<path:filename>', 'asset', asset)
+        app.add_template_global(asset_url)
@@ -20,3 +20,59 @@ CREATE TABLE IF NOT EXISTS videos (
     filename TEXT NOT NULL,
     FOREIGN KEY (username) REFERENCES users(username) ON DELETE CASCADE
 );
+
+-- 视频元数据表，由后台处理填充；status 为 pending / done / failed
+CREATE TABLE IF NOT EXISTS video_meta (
+    filename TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    duration REAL,
+    width INTEGER,
+    height INTEGER,
+    codec TEXT,
+    poster TEXT
+);
+
+-- HLS 转码状态表；renditions 为逗号分隔的档位，如 720p,480p
+CREATE TABLE IF NOT EXISTS video_hls (
+    filename TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    renditions TEXT
+);
+
+-- 图片优化版本表；format 为 original 的一行记录原图本身，variant 为优化版本的文件名
+CREATE TABLE IF NOT EXISTS image_variants (
+    filename TEXT NOT NULL,
+    format TEXT NOT NULL,
+    variant TEXT,
+    mimetype TEXT,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (filename, format)
+);
+
+-- 图片感知哈希表；b0-b3 为 pHash 的四段 16 位，分别建索引用于查找相似图片
+CREATE TABLE IF NOT EXISTS image_hashes (
+    filename TEXT PRIMARY KEY,
+    phash INTEGER NOT NULL,
+    dhash INTEGER NOT NULL,
+    b0 INTEGER NOT NULL,
+    b1 INTEGER NOT NULL,
+    b2 INTEGER NOT NULL,
+    b3 INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_image_hashes_b0 ON image_hashes (b0);
+CREATE INDEX IF NOT EXISTS idx_image_hashes_b1 ON image_hashes (b1);
+CREATE INDEX IF NOT EXISTS idx_image_hashes_b2 ON image_hashes (b2);
+CREATE INDEX IF NOT EXISTS idx_image_hashes_b3 ON image_hashes (b3);
+
+-- ingest-media 导入过的源文件；大小和修改时间不变时重复导入会跳过
+CREATE TABLE IF NOT EXISTS ingested_files (
+    source TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    filetype TEXT NOT NULL,
+    filename TEXT NOT NULL
+);
+
+-- 按文件名查找和对账时使用
+CREATE INDEX IF NOT EXISTS idx_images_filename ON images (filename);
+CREATE INDEX IF NOT EXISTS idx_videos_filename ON videos (filename);
@@ -0,0 +1,174 @@
+"""
+测试用的进程内 Redis 协议服务器
+
+只实现 RedisCacheBackend 用到的命令：AUTH SELECT PING GET SET(EX/PX) DEL PUBLISH SUBSCRIBE
+WATCH UNWATCH MULTI EXEC。数据只在内存中，过期时间按读取时的时刻判断。
+drop_connections() 断开所有客户端，用来测试断线重连。
+"""
+import socket
+import socketserver
+import threading
+import time
+
+
+def encode(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(encode(v) for v in value)
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class FakeRedis:
+    def __init__(self, password=None):
+        self.password = password
+        self.store = {}     # 键 -> (值, 过期时刻或 None)
+        self.versions = {}  # 键 -> 修改次数，WATCH 用它判断是否被改过
+        self.subscribers = set()
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.commands = []  # 收到的命令名，测试可以据此检查调用方式
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                with server.lock:
+                    server.connections.add(self.connection)
+                try:
+                    server.serve(self.rfile, self.wfile)
+                except (OSError, ValueError):
+                    pass
+                finally:
+                    with server.lock:
+                        server.connections.discard(self.connection)
+                        server.subscribers.discard(self.wfile)
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = f'redis://{":" + password + "@" if password else ""}127.0.0.1:{self.port}/1'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        with self.lock:
+            connections = list(self.connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _read_command(self, rfile):
+        line = rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(rfile.readline()[1:-2])
+            args.append(rfile.read(length + 2)[:-2])
+        return args
+
+    def _get(self, key):
+        item = self.store.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= time.time():
+            del self.store[key]
+            return None
+        return value
+
+    def _set(self, key, value, expires=None):
+        self.store[key] = (value, expires)
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _execute(self, name, args):
+        if name == 'GET':
+            return self._get(args[0])
+        if name == 'SET':
+            expires = None
+            options = [a.decode().upper() for a in args[2::2]]
+            for option, amount in zip(options, args[3::2]):
+                if option == 'EX':
+                    expires = time.time() + int(amount)
+                elif option == 'PX':
+                    expires = time.time() + int(amount) / 1000
+            self._set(args[0], args[1], expires)
+            return 'OK'
+        if name == 'DEL':
+            removed = 0
+            for key in args:
+                if self.store.pop(key, None) is not None:
+                    removed += 1
+                    self.versions[key] = self.versions.get(key, 0) + 1
+            return removed
+        raise ValueError(name)
+
+    def serve(self, rfile, wfile):
+        watched = {}
+        queued = None
+        while True:
+            args = self._read_command(rfile)
+            if args is None:
+                return
+            name = args[0].decode().upper()
+            args = args[1:]
+            self.commands.append(name)
+            with self.lock:
+                if name == 'AUTH':
+                    ok = args[-1].decode() == self.password
+                    reply = 'OK' if ok else RuntimeError('WRONGPASS invalid password')
+                elif name in ('SELECT', 'PING'):
+                    reply = 'OK' if name == 'SELECT' else 'PONG'
+                elif name == 'WATCH':
+                    for key in args:
+                        watched[key] = self.versions.get(key, 0)
+                    reply = 'OK'
+                elif name == 'UNWATCH':
+                    watched = {}
+                    reply = 'OK'
+                elif name == 'MULTI':
+                    queued = []
+                    reply = 'OK'
+                elif name == 'EXEC':
+                    if queued is None:
+                        reply = RuntimeError('ERR EXEC without MULTI')
+                    elif any(self.versions.get(k, 0) != v for k, v in watched.items()):
+                        reply = None
+                    else:
+                        reply = [self._execute(n, a) for n, a in queued]
+                    queued, watched = None, {}
+                elif queued is not None:
+                    queued.append((name, args))
+                    reply = 'QUEUED'
+                elif name == 'PUBLISH':
+                    message = encode([b'message', args[0], args[1]])
+                    for subscriber in list(self.subscribers):
+                        try:
+                            subscriber.write(message)
+                            subscriber.flush()
+                        except (OSError, ValueError):
+                            self.subscribers.discard(subscriber)
+                    reply = len(self.subscribers)
+                elif name == 'SUBSCRIBE':
+                    self.subscribers.add(wfile)
+                    reply = [b'subscribe', args[0], 1]
+                else:
+                    reply = self._execute(name, args)
+            if isinstance(reply, RuntimeError):
+                wfile.write(b'-%s\r\n' % str(reply).encode())
+            elif reply in ('OK', 'QUEUED', 'PONG'):
+                wfile.write(b'+%s\r\n' % reply.encode())
+            else:
+                wfile.write(encode(reply))
+            wfile.flush()
@@ -0,0 +1,120 @@
+"""RedisCacheBackend 与进程内 RESP 假服务器的测试：python -m pytest tests"""
+import io
+import time
+
+import pytest
+
+import app as share
+from fake_redis import FakeRedis
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('等待超时')
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def redis_cache(monkeypatch):
+    fake = FakeRedis(password='secret')
+    monkeypatch.setitem(share.app.config, 'CACHE_BACKEND', 'redis')
+    monkeypatch.setitem(share.app.config, 'CACHE_URL', fake.url)
+    monkeypatch.setattr(share, 'shared_cache', None)
+    backend = share.cache_backend()
+    wait_until(lambda: backend.keep_local)
+    yield fake, backend
+    # 订阅线程无法停止，让它之后不再影响其他测试
+    backend.on_invalidate = lambda key: None
+    fake.close()
+    share.failed_invalidations.clear()
+    for cache in share.caches.values():
+        cache.local.clear()
+
+
+def other_worker(fake):
+    """另一个 worker 的后端：清除条目时通过 PUBLISH 通知本进程"""
+    return share.RedisCacheBackend(fake.url, lambda key: None)
+
+
+def test_resp_encoding():
+    assert share.redis_command('SET', 'k', 1) == b'*3\r\n$3\r\nSET\r\n$1\r\nk\r\n$1\r\n1\r\n'
+    reply = io.BytesIO(b'*4\r\n$3\r\nfoo\r\n:5\r\n$-1\r\n+OK\r\n')
+    assert share.redis_reply(reply) == [b'foo', 5, None, b'OK']
+    with pytest.raises(share.CacheError):
+        share.redis_reply(io.BytesIO(b'-ERR wrong\r\n'))
+    with pytest.raises(ConnectionError):
+        share.redis_reply(io.BytesIO(b'$10\r\nshort\r\n'))
+
+
+def test_get_set_delete(redis_cache):
+    fake, backend = redis_cache
+    backend.set('t:a', '[1]')
+    assert backend.get('t:a') == '[1]'
+    backend.delete('t:a')
+    assert backend.get('t:a') is None
+    # 清除后的占位期间不接受写回
+    backend.set('t:a', '[2]')
+    assert backend.get('t:a') is None
+    assert fake.store[b'cache:t:a'][0] == b''
+
+
+def test_invalidation_is_broadcast(redis_cache):
+    fake, backend = redis_cache
+    share.listing_cache.put('alice', [['a.jpg'], []])
+    assert share.listing_cache.peek('alice') == [['a.jpg'], []]
+    assert share.listing_cache.get('alice') == [['a.jpg'], []]
+    other_worker(fake).delete('listing:alice')
+    wait_until(lambda: share.listing_cache.peek('alice') is None)
+    assert share.listing_cache.get('alice') is None
+
+
+def test_stale_put_after_invalidation_is_dropped(redis_cache):
+    fake, backend = redis_cache
+    assert share.listing_cache.get('bob') is None  # 未命中，随后去读数据库
+    generation = share.listing_cache.generation
+    other_worker(fake).delete('listing:bob')       # 读数据库期间另一个 worker 修改并清除
+    wait_until(lambda: share.listing_cache.generation != generation)
+    share.listing_cache.put('bob', [['old.jpg'], []])
+    assert share.listing_cache.peek('bob') is None
+    assert backend.get('listing:bob') is None
+
+
+def test_rate_limit_take(redis_cache):
+    fake, backend = redis_cache
+    assert backend.take([('ip:1', 1.0, 1.0)], 1) == 0
+    assert backend.take([('ip:1', 1.0, 1.0)], 1) > 0
+    assert {'WATCH', 'MULTI', 'EXEC', 'UNWATCH'} <= set(fake.commands)
+
+
+def test_rate_limit_take_is_all_or_nothing(redis_cache):
+    fake, backend = redis_cache
+    assert backend.take([('user:x', 1.0, 1.0)], 1) == 0
+    # 用户桶已空：IP 桶不应被扣除
+    assert backend.take([('ip:2', 1.0, 1.0), ('user:x', 1.0, 1.0)], 1) > 0
+    assert b'cache:rate:ip:2' not in fake.store
+    assert backend.take([('ip:2', 1.0, 1.0)], 1) == 0
+
+
+def test_reconnect(redis_cache):
+    fake, backend = redis_cache
+    share.user_cache.put('carol', True)
+    fake.drop_connections()
+    # 订阅断开后不再保留本地副本，重新订阅后恢复
+    wait_until(lambda: not backend.keep_local)
+    assert share.user_cache.peek('carol') is None
+    wait_until(lambda: backend.keep_local)
+
+    # 请求线程的连接也断了：第一次清除失败，记下来之后重试
+    share.user_cache.pop('carol')
+    assert 'user:carol' in share.failed_invalidations
+    assert share.user_cache.get('carol') is None
+    assert not share.failed_invalidations
+    assert fake.store[b'cache:user:carol'][0] == b''
+
+    # 重连之后通知照常送达
+    share.user_cache.put('dave', True)
+    assert share.user_cache.peek('dave') is True
+    other_worker(fake).delete('user:dave')
+    wait_until(lambda: share.user_cache.peek('dave') is None)
@@ -1,5 +1,7 @@
 import os
+import shutil
 import sqlite3
+import threading
 from flask import Flask, jsonify, render_template_string, redirect, url_for, flash, request, send_from_directory, abort, g
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -8,12 +10,14 @@ from flask_wtf import FlaskForm, CSRFProtect
 from wtforms import StringField, PasswordField, SubmitField, FileField
 from wtforms.validators import DataRequired, EqualTo, Length
 from uuid import uuid4
+from compression import init_compression
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key_here'  # 请替换为您的密钥
 app.config['UPLOAD_FOLDER_IMAGES'] = os.path.join(app.root_path, 'static', 'uploads', 'images')
 app.config['UPLOAD_FOLDER_VIDEOS'] = os.path.join(app.root_path, 'static', 'uploads', 'videos')
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB
+app.config['UPLOAD_FSYNC'] = 'none'  # 上传保存后的刷盘策略：none 交给操作系统；file 刷文件内容；file+dir 再刷目录，断电也不丢已确认的上传
 app.config['DATABASE'] = os.path.join(app.root_path, 'database.db')  # 数据库文件路径
 
 # 启用 CSRF 保护
@@ -23,10 +27,6 @@ csrf = CSRFProtect(app)
 ALLOWED_EXTENSIONS_IMAGES = {'png', 'jpg', 'jpeg', 'gif'}
 ALLOWED_EXTENSIONS_VIDEOS = {'mp4', 'avi', 'mov', 'mkv'}
 
-# 确保上传文件夹存在
-os.makedirs(app.config['UPLOAD_FOLDER_IMAGES'], exist_ok=True)
-os.makedirs(app.config['UPLOAD_FOLDER_VIDEOS'], exist_ok=True)
-
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -34,6 +34,8 @@ login_manager.login_view = 'login'
 ############### 数据库部分 ###############
 
 def get_db():
+    if not storage_ready:
+        init_storage()
     if 'db' not in g:
         g.db = sqlite3.connect(app.config['DATABASE'])
         g.db.row_factory = sqlite3.Row  # 使查询结果支持字典访问
@@ -45,10 +47,14 @@ def close_db(exception):
     if db is not None:
         db.close()
 
+# 建表语句全部是 IF NOT EXISTS，放在 BEGIN IMMEDIATE 事务里执行：
+# 多个进程同时启动时由 SQLite 的写锁串行化，重复执行也没有副作用
 def init_db():
-    db = get_db()
-    db.executescript(schema_sql)
-    db.commit()
+    db = sqlite3.connect(app.config['DATABASE'], timeout=30)
+    try:
+        db.executescript('BEGIN IMMEDIATE;\n' + schema_sql + '\nCOMMIT;')
+    finally:
+        db.close()
 
 # 数据库表结构（SQL 脚本）
 schema_sql = """
@@ -76,9 +82,19 @@ CREATE TABLE IF NOT EXISTS videos (
 );
 """
 
-# 在应用启动时检查数据库是否存在，如不存在则初始化
-if not os.path.exists(app.config['DATABASE']):
-    init_db()
+storage_ready = False
+storage_lock = threading.Lock()
+
+# 创建上传目录和数据库表，每个进程只执行一次
+def init_storage():
+    global storage_ready
+    with storage_lock:
+        if storage_ready:
+            return
+        os.makedirs(app.config['UPLOAD_FOLDER_IMAGES'], exist_ok=True)
+        os.makedirs(app.config['UPLOAD_FOLDER_VIDEOS'], exist_ok=True)
+        init_db()
+        storage_ready = True
 
 #########################################
 
@@ -135,6 +151,33 @@ def allowed_file(filename, type='image'):
     else:
         return ext in ALLOWED_EXTENSIONS_VIDEOS
 
+# 先写入同目录的隐藏临时文件，写完再改名，其他请求不会读到写了一半的文件
+def atomic_save(stream, path):
+    directory = os.path.dirname(path)
+    tmp_path = os.path.join(directory, f'.tmp-{uuid4().hex}')
+    try:
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(stream, f, 64 * 1024)
+            if app.config['UPLOAD_FSYNC'] in ('file', 'file+dir'):
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    if app.config['UPLOAD_FSYNC'] == 'file+dir':
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return  # Windows 不能打开目录
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
 # LCS算法实现
 def lcs_length(s1, s2):
     m = len(s1)
@@ -217,7 +260,7 @@ def profile(username):
             # 生成唯一文件名防止冲突
             unique_filename = f"{uuid4().hex}_{filename}"
             full_path = os.path.join(save_path, unique_filename)
-            file.save(full_path)
+            atomic_save(file.stream, full_path)
 
             # 将文件信息存入数据库
             db = get_db()
@@ -333,8 +376,24 @@ def api_download_file(username, filetype, filename):
     folder = app.config['UPLOAD_FOLDER_IMAGES'] if filetype == 'images' else app.config['UPLOAD_FOLDER_VIDEOS']
     return send_from_directory(folder, filename)
 
+############### 压缩和静态资源 ###############
+# 页面和 JSON 按 Accept-Encoding 压缩，输出了 CSRF 令牌的页面不压缩（BREACH）。Bootstrap 放在
+# static/vendor 下，页面通过带内容指纹的 /assets/<指纹>/<路径> 引用。实现在 compression.py
+
+init_compression(app)
+
+#########################################
+
+# 导入本模块不会创建目录或数据库，初始化推迟到 configure_app() 或第一次访问数据库时
+def configure_app(config=None):
+    """更新全局 app 的配置并初始化存储，返回同一个 app；不是工厂函数，每次调用修改的都是同一个对象"""
+    if config:
+        app.config.update(config)
+    init_storage()
+    return app
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    configure_app().run(debug=True)
 
 ######### 以下是模板字符串 #########
 
@@ -346,7 +405,7 @@ base_html = """
   <meta charset="UTF-8">
   <title>{{ title }}</title>
   <!-- 引入 Bootstrap CSS -->
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css" rel="stylesheet">
+  <link href="{{ asset_url('bootstrap/bootstrap.min.css') }}" rel="stylesheet">
   <style>
   body {
     background-color: #f8f9fa;
@@ -425,7 +484,8 @@ base_html = """
     {{ content }}
   </div>
 
-<script src="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js"></script>
+<script src="{{ asset_url('popper/popper.min.js') }}"></script>
+<script src="{{ asset_url('bootstrap/bootstrap.min.js') }}"></script>
 </body>
 </html>
 {% endmacro %}
@@ -1,16 +1,25 @@
 # app.py
 
-from flask import Flask, request, redirect, url_for, render_template_string, send_file, session, jsonify, abort
+from flask import Flask, request, redirect, url_for, render_template_string, send_file, session, jsonify, abort, Response
 import os
 import shutil
 import sqlite3
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
 from PIL import Image, ImageDraw, ImageFont
-from io import BytesIO
+from io import BytesIO, RawIOBase
+from urllib.parse import quote
+import zipfile
 import random
 import string
 import base64
+import threading
+import time
+from uuid import uuid4
+import math
+from functools import wraps
+from compression import init_compression
 
 app = Flask(__name__)
 
@@ -20,10 +29,16 @@ app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'  # Session 加密密钥，请替换为安全密钥
 app.config['UPLOAD_FOLDER'] = 'uploads'  # 上传文件存储目录，非 static，不自动提供静态文件访问
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 最大上传大小16MB
-
-# 确保 uploads 目录存在
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+app.config['TRASH_FOLDER'] = 'trash'  # 回收区，必须和 UPLOAD_FOLDER 在同一文件系统上，保证改名是原子操作
+app.config['TRASH_REAP_BATCH'] = 500  # 后台回收时每批最多删除的条目数
+app.config['TRASH_REAP_PAUSE'] = 0.2  # 每批之间休眠的秒数，限制回收对磁盘的占用
+app.config['MAX_UPLOAD_FILE_SIZE'] = 4 * 1024 * 1024 * 1024  # 分块上传时单个文件的大小上限 4GB
+app.config['STALE_UPLOAD_AGE'] = 24 * 3600  # 超过这个秒数未完成的分块上传会被清理
+app.config['UPLOAD_FSYNC'] = 'none'  # 上传完成时的刷盘策略：none 交给操作系统；file 刷文件内容；file+dir 再刷目录，断电也不丢已确认的上传
+app.config['RATE_LIMIT_ENABLED'] = False  # 开启后验证码、登录注册、上传按 IP 和用户限速，超出时返回 429
+app.config['RATE_LIMIT'] = (5, 100)  # 令牌桶：(每秒补充的令牌数, 最多攒下的令牌数)，IP 和用户各一个
+app.config['RATE_LIMIT_COSTS'] = {'captcha': 2, 'auth': 5, 'upload': 2, 'upload_chunk': 1}  # 每次请求消耗的令牌数
+app.config['HEAVY_CONCURRENCY'] = 0  # 同时生成验证码、计算密码哈希的请求上限，超出时立即返回 503；0 表示不限
 
 # SQLite 数据库路径
 DATABASE = 'users.db'
@@ -32,7 +47,7 @@ DATABASE = 'users.db'
 # 初始化数据库
 # --------------------------
 def init_db():
-    with sqlite3.connect(DATABASE) as conn:
+    with sqlite3.connect(DATABASE, timeout=30) as conn:
         c = conn.cursor()
         c.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -43,8 +58,6 @@ def init_db():
         ''')
         conn.commit()
 
-init_db()
-
 # --------------------------
 # 工具函数：路径安全检测
 # --------------------------
@@ -53,6 +66,262 @@ def is_sub_path(path, directory):
     abs_path = os.path.abspath(path)
     return abs_path.startswith(abs_directory)
 
+# --------------------------
+# 回收区：删除时先原子改名进回收区并立即返回，
+# 由后台线程分批回收磁盘空间。回收区里的条目就是进度记录，
+# 进程崩溃后重启会从剩余的条目继续删除。
+# --------------------------
+trash_event = threading.Event()
+trash_lock = threading.Lock()
+trash_status = {'pending': 0, 'current': None, 'removed': 0, 'errors': 0}
+
+STAGED_TRASH_TTL = 3600  # 暂存条目超过这个秒数仍未提交，视为所在批量操作已崩溃，照常回收
+
+def move_to_trash(abs_path, staged=False):
+    # staged=True 时条目名以 '.' 开头，回收线程暂不处理，可以再改名还原
+    entry = f"{int(time.time())}_{uuid4().hex}"
+    name = '.' + entry if staged else entry
+    os.rename(abs_path, os.path.join(app.config['TRASH_FOLDER'], name))
+    if not staged:
+        trash_event.set()
+    return entry
+
+def commit_trash(entry):
+    trash_dir = app.config['TRASH_FOLDER']
+    os.rename(os.path.join(trash_dir, '.' + entry), os.path.join(trash_dir, entry))
+    trash_event.set()
+
+def restore_from_trash(entry, abs_path):
+    os.rename(os.path.join(app.config['TRASH_FOLDER'], '.' + entry), abs_path)
+
+# 把写好的暂存文件用 os.link 发布为不重名的文件名，重名时依次尝试 "名称 (1).扩展名"……
+# 链接已存在时 os.link 原子地失败，并发上传同名文件各自得到不同的文件名；正式文件名一出现
+# 就是完整的内容，不会先出现一个空文件。文件系统不支持硬链接（如 FAT）时退回到
+# O_EXCL 占位再改名，这时占位的空文件在改名前短暂可见
+def link_unique(src, directory, filename):
+    name, ext = os.path.splitext(filename)
+    index = 0
+    while True:
+        candidate = filename if index == 0 else f'{name} ({index}){ext}'
+        path = os.path.join(directory, candidate)
+        try:
+            os.link(src, path)
+        except FileExistsError:
+            index += 1
+            continue
+        except OSError:
+            fd, path = reserve_path(directory, filename)
+            os.close(fd)
+            os.replace(src, path)
+            return path
+        os.remove(src)
+        return path
+
+def reserve_path(directory, filename):
+    name, ext = os.path.splitext(filename)
+    index = 0
+    while True:
+        candidate = filename if index == 0 else f'{name} ({index}){ext}'
+        path = os.path.join(directory, candidate)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+            return fd, path
+        except FileExistsError:
+            index += 1
+
+# 上传先写入用户目录下的 .uploads 暂存区，写完后改名到目标位置，列表里不会出现写了一半的文件
+def sync_upload_file(f):
+    if app.config['UPLOAD_FSYNC'] in ('file', 'file+dir'):
+        f.flush()
+        os.fsync(f.fileno())
+
+def fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # Windows 不能打开目录
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def publish_upload(part_path, upload_dir, filename):
+    save_path = link_unique(part_path, upload_dir, filename)
+    if app.config['UPLOAD_FSYNC'] == 'file+dir':
+        fsync_dir(upload_dir)
+    return save_path
+
+def _is_reapable(entry):
+    if not entry.startswith('.'):
+        return True
+    stamp = entry[1:].split('_', 1)[0]
+    return stamp.isdigit() and time.time() - int(stamp) > STAGED_TRASH_TTL
+
+def _reap_one(path):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            os.rmdir(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        return  # 其他 worker 已经删掉了
+    except OSError as e:
+        app.logger.warning('回收失败 %s: %s', path, e)
+        with trash_lock:
+            trash_status['errors'] += 1
+        return
+    with trash_lock:
+        trash_status['removed'] += 1
+
+def reap_entry(entry_path):
+    # 自底向上删除：先删文件，再删已清空的目录
+    count = 0
+    if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+        for root, dirs, files in os.walk(entry_path, topdown=False):
+            for name in files + dirs:
+                _reap_one(os.path.join(root, name))
+                count += 1
+                if count % app.config['TRASH_REAP_BATCH'] == 0:
+                    time.sleep(app.config['TRASH_REAP_PAUSE'])
+    _reap_one(entry_path)
+
+def reap_trash():
+    trash_dir = app.config['TRASH_FOLDER']
+    entries = sorted(e for e in os.listdir(trash_dir) if _is_reapable(e))
+    with trash_lock:
+        trash_status['pending'] = len(entries)
+    for entry in entries:
+        with trash_lock:
+            trash_status['current'] = entry
+        reap_entry(os.path.join(trash_dir, entry))
+        with trash_lock:
+            trash_status['pending'] -= 1
+
+def trash_reaper():
+    # 一轮出错（例如回收站目录被删掉）只记录日志，下一轮照常进行，回收线程不会因此退出
+    while True:
+        try:
+            reap_trash()
+        except Exception:
+            app.logger.exception('回收站清理出错')
+            with trash_lock:
+                trash_status['errors'] += 1
+        finally:
+            with trash_lock:
+                trash_status['current'] = None
+        trash_event.wait(60)
+        trash_event.clear()
+
+# --------------------------
+# 进程初始化：目录、数据库表和回收线程
+# --------------------------
+# 导入模块时不做任何初始化。目录和建表都是幂等的，可以在预加载的主进程里做一次；
+# 线程不会跟随 fork 复制，所以回收线程按进程号记录，每个 worker 第一次处理请求时各自启动
+storage_ready = False
+reaper_pid = None
+init_lock = threading.Lock()
+
+def init_storage():
+    global storage_ready
+    with init_lock:
+        if storage_ready:
+            return
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        os.makedirs(app.config['TRASH_FOLDER'], exist_ok=True)
+        init_db()
+        storage_ready = True
+
+def start_trash_reaper():
+    global reaper_pid
+    with init_lock:
+        if reaper_pid == os.getpid():
+            return
+        reaper_pid = os.getpid()
+    threading.Thread(target=trash_reaper, name='trash-reaper', daemon=True).start()
+
+@app.before_request
+def ensure_process_ready():
+    if not storage_ready:
+        init_storage()
+    if reaper_pid != os.getpid():
+        start_trash_reaper()
+
+def configure_app(config=None):
+    """更新全局 app 的配置并初始化存储，返回同一个 app；不是工厂函数，每次调用修改的都是同一个对象"""
+    if config:
+        app.config.update(config)
+    init_storage()
+    return app
+
+# --------------------------
+# 响应压缩：页面和 JSON 按 Accept-Encoding 压缩，安装了 brotli 时优先使用。
+# 文件列表页带有包装主密钥用的 key_wrap，每次响应先和随机掩码异或再输出（mask_secret），
+# 页面中的字节每次都不同，压缩后的长度不会泄露它（BREACH）。实现在 compression.py
+# --------------------------
+init_compression(app, assets=False)
+
+def mask_secret(secret_hex):
+    """返回 掩码 + 秘密异或掩码 的十六进制串，浏览器端再异或一次还原"""
+    secret = bytes.fromhex(secret_hex)
+    mask = os.urandom(len(secret))
+    return mask.hex() + bytes(a ^ b for a, b in zip(secret, mask)).hex()
+
+# --------------------------
+# 限流：令牌桶按 GCRA 实现，每个键只记一个时间戳 tat（桶重新装满的时刻）。
+# 状态保存在进程内，多 worker 部署时每个进程各自计数
+# --------------------------
+rate_buckets = {}  # 'ip:地址' / 'user:用户名' -> tat
+rate_lock = threading.Lock()
+heavy_semaphore = None  # (上限, 信号量)
+
+def take_tokens(keys, cost):
+    """从每个键的令牌桶各取 cost 个令牌，返回需要等待的秒数，0 表示放行。
+    先检查所有桶，全部够了才一起扣除，被其中一个拒绝时其他桶的额度不受影响"""
+    rate, burst = app.config['RATE_LIMIT']
+    with rate_lock:
+        now = time.time()
+        if len(rate_buckets) > 100000:
+            for stale in [k for k, tat in rate_buckets.items() if tat <= now]:
+                del rate_buckets[stale]
+        tats = {key: max(rate_buckets.get(key, now), now) + cost / rate for key in keys}
+        wait = max(tat - burst / rate - now for tat in tats.values())
+        if wait > 0:
+            return wait
+        rate_buckets.update(tats)
+        return 0
+
+def rate_limited(cost_key, heavy=False, methods=None):
+    """methods 指定时只对这些请求方法生效；heavy 表示受 HEAVY_CONCURRENCY 限制"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            global heavy_semaphore
+            if methods is not None and request.method not in methods:
+                return view(*args, **kwargs)
+            if app.config['RATE_LIMIT_ENABLED']:
+                cost = app.config['RATE_LIMIT_COSTS'].get(cost_key, 1)
+                keys = ['ip:' + (request.remote_addr or '')]
+                if 'username' in session:
+                    keys.append('user:' + session['username'])
+                wait = take_tokens(keys, cost)
+                if wait:
+                    raise TooManyRequests(retry_after=math.ceil(wait))
+            limit = app.config['HEAVY_CONCURRENCY']
+            if not heavy or limit <= 0:
+                return view(*args, **kwargs)
+            with rate_lock:
+                if heavy_semaphore is None or heavy_semaphore[0] != limit:
+                    heavy_semaphore = (limit, threading.BoundedSemaphore(limit))
+                semaphore = heavy_semaphore[1]
+            if not semaphore.acquire(blocking=False):
+                raise ServiceUnavailable('服务器繁忙，请稍后重试', retry_after=1)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                semaphore.release()
+        return wrapper
+    return decorator
+
 # --------------------------
 # 生成图片验证码
 # --------------------------
@@ -84,6 +353,7 @@ def generate_captcha():
 
 # 获取验证码图片
 @app.route('/captcha')
+@rate_limited('captcha', heavy=True)
 def captcha():
     code, img = generate_captcha()
     session['captcha_code'] = code.lower()
@@ -93,6 +363,7 @@ def captcha():
 # 登录注册共用页面
 # --------------------------
 @app.route('/auth', methods=['GET', 'POST'])
+@rate_limited('auth', heavy=True, methods=('POST',))
 def auth():
     error = ''
     captcha_image_url = url_for('captcha')
@@ -154,7 +425,7 @@ def delete_account():
 
         user_folder = os.path.join(app.config['UPLOAD_FOLDER'], username)
         if os.path.exists(user_folder):
-            shutil.rmtree(user_folder)
+            move_to_trash(user_folder)
 
         session.clear()
         return redirect(url_for('auth'))
@@ -179,10 +450,13 @@ def dir_listing(req_path):
     if not os.path.exists(abs_path):
         abort(404)
     if os.path.isfile(abs_path):
-        return send_file(abs_path, as_attachment=True, attachment_filename=os.path.basename(abs_path))
+        # conditional=True 支持 Range 请求，客户端可以按段续传/读取
+        return send_file(abs_path, as_attachment=True, download_name=os.path.basename(abs_path), conditional=True)
 
     files = []
     for f in sorted(os.listdir(abs_path)):
+        if f.startswith('.'):
+            continue  # 隐藏未完成的分块上传等内部文件
         fpath = os.path.join(req_path, f).replace('\\','/')
         fullpath = os.path.join(base_dir, fpath)
         files.append({
@@ -192,11 +466,14 @@ def dir_listing(req_path):
         })
 
     parent_path = '/'.join(req_path.split('/')[:-1])
+    # 浏览器用它加密暂存在 sessionStorage 里的主密钥，退出登录时随会话一起清除
+    key_wrap = session.setdefault('key_wrap', os.urandom(32).hex())
     return render_template_string(index_template,
                                   files=files,
                                   current_path=req_path,
                                   parent_path=parent_path,
-                                  username=username)
+                                  username=username,
+                                  key_wrap=mask_secret(key_wrap))
 
 # --------------------------
 # 文件或文件夹移动路由
@@ -252,7 +529,6 @@ def delete_item():
     base_dir = os.path.join(app.config['UPLOAD_FOLDER'], username)
 
     path = data.get('path', '')
-    is_file = data.get('is_file', False)
 
     if not path:
         abort(400)
@@ -265,14 +541,141 @@ def delete_item():
         abort(404)
 
     try:
-        if is_file:
-            os.remove(abs_path)
-        else:
-            shutil.rmtree(abs_path)
+        move_to_trash(abs_path)
         return 'Success', 200
     except Exception as e:
         return str(e), 500
 
+# --------------------------
+# 批量移动/重命名/删除：先统一校验所有路径，再一次性执行
+# --------------------------
+class BatchError(Exception):
+    pass
+
+def plan_operation(base_dir, op):
+    # 返回 (类型, 源绝对路径, 目标绝对路径)，删除的目标为 None
+    kind = op.get('op')
+    path = op.get('path', '')
+    if not path:
+        raise BatchError('路径不能为空')
+    src_path = os.path.normpath(os.path.join(base_dir, path))
+    if kind == 'move':
+        dst_path = os.path.join(base_dir, op.get('destination', ''), os.path.basename(src_path))
+    elif kind == 'rename':
+        new_name = secure_filename(op.get('new_name', ''))
+        if not new_name:
+            raise BatchError('新名称不能为空')
+        dst_path = os.path.join(os.path.dirname(src_path), new_name)
+    elif kind == 'delete':
+        dst_path = None
+    else:
+        raise BatchError('未知操作')
+    if dst_path is not None:
+        dst_path = os.path.normpath(dst_path)
+
+    if src_path == os.path.normpath(base_dir) or not is_sub_path(src_path, base_dir):
+        raise BatchError('非法路径')
+    if dst_path is not None and not is_sub_path(dst_path, base_dir):
+        raise BatchError('非法路径')
+    if not os.path.exists(src_path):
+        raise BatchError('文件不存在')
+    if dst_path is not None:
+        if os.path.exists(dst_path):
+            raise BatchError('目标已存在')
+        if dst_path.startswith(src_path + os.sep):
+            raise BatchError('不能移动到自身内部')
+        if not os.path.isdir(os.path.dirname(dst_path)):
+            raise BatchError('目标文件夹不存在')
+    return kind, src_path, dst_path
+
+def _overlaps(a, b):
+    return a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep)
+
+@app.route('/batch', methods=['POST'])
+def batch_operations():
+    if 'username' not in session:
+        abort(401)
+
+    data = request.get_json()
+    if not data or not isinstance(data.get('operations'), list):
+        abort(400)
+
+    username = session['username']
+    base_dir = os.path.join(app.config['UPLOAD_FOLDER'], username)
+    atomic = bool(data.get('atomic', False))
+
+    # 第一遍：校验全部操作，同一批次内的源路径和目标路径互不重叠
+    results = []
+    plans = []
+    claimed = []
+    for index, op in enumerate(data['operations']):
+        try:
+            if not isinstance(op, dict):
+                raise BatchError('操作格式错误')
+            plan = plan_operation(base_dir, op)
+            touched = [p for p in plan[1:] if p is not None]
+            if any(_overlaps(p, c) for p in touched for c in claimed):
+                raise BatchError('与本批次中其他操作的路径冲突')
+            claimed.extend(touched)
+            plans.append((index, plan))
+            results.append({'index': index, 'ok': True})
+        except BatchError as e:
+            results.append({'index': index, 'ok': False, 'error': str(e)})
+
+    if atomic and len(plans) != len(results):
+        for r in results:
+            if r['ok']:
+                r.update(ok=False, error='批次中有无效操作，未执行')
+        return jsonify({'results': results, 'committed': False}), 400
+
+    # 第二遍：执行。原子模式下删除先进入暂存区，失败时按相反顺序撤销
+    done = []
+    for index, (kind, src_path, dst_path) in plans:
+        try:
+            if kind == 'delete':
+                entry = move_to_trash(src_path, staged=atomic)
+                done.append((index, kind, src_path, entry))
+            else:
+                os.rename(src_path, dst_path)
+                done.append((index, kind, src_path, dst_path))
+        except OSError as e:
+            results[index].update(ok=False, error=str(e))
+            if atomic:
+                # 撤销也可能失败（例如原位置已被其他请求占用），逐个报告，其余继续撤销
+                rolled_back = True
+                for done_index, kind, src_path, target in reversed(done):
+                    try:
+                        if kind == 'delete':
+                            restore_from_trash(target, src_path)
+                        else:
+                            os.rename(target, src_path)
+                    except OSError as undo_error:
+                        # 无法恢复的删除留在暂存区，到期前管理员还能按日志中的条目名找回
+                        app.logger.error('批量操作回滚失败 %s -> %s: %s', src_path, target, undo_error)
+                        results[done_index].update(ok=False, error=f'回滚失败，操作已生效: {undo_error}')
+                        rolled_back = False
+                for r in results:
+                    if r['ok']:
+                        r.update(ok=False, error='批次执行失败，已回滚')
+                return jsonify({'results': results, 'committed': False, 'rolled_back': rolled_back}), 500
+
+    if atomic:
+        for index, kind, src_path, target in done:
+            if kind == 'delete':
+                commit_trash(target)
+    return jsonify({'results': results, 'committed': bool(done)})
+
+# --------------------------
+# 回收进度查询
+# --------------------------
+@app.route('/trash_status')
+def get_trash_status():
+    if 'username' not in session:
+        abort(401)
+    with trash_lock:
+        status = dict(trash_status)
+    return jsonify(status)
+
 # --------------------------
 # 重命名文件/文件夹路由
 # --------------------------
@@ -310,10 +713,73 @@ def rename_item():
     except Exception as e:
         return str(e), 500
 
+# --------------------------
+# 文件夹打包下载：边读边生成 ZIP 流，不落临时文件也不在内存里攒整个压缩包
+# --------------------------
+class ZipStream(RawIOBase):
+    # 不可 seek 的写入目标，zipfile 会自动改用数据描述符格式
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_zip(folder):
+    stream = ZipStream()
+    top = os.path.dirname(os.path.abspath(folder))
+    with zipfile.ZipFile(stream, 'w') as zf:
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            files = [f for f in files if not f.startswith('.')]
+            if not dirs and not files:
+                zf.writestr(os.path.relpath(root, top) + '/', b'')
+            for name in sorted(files):
+                full_path = os.path.join(root, name)
+                zinfo = zipfile.ZipInfo.from_file(full_path, os.path.relpath(full_path, top))
+                # 云盘里的文件都是客户端加密后的密文，再压缩没有意义，一律 STORED
+                zinfo.compress_type = zipfile.ZIP_STORED
+                with open(full_path, 'rb') as src, zf.open(zinfo, 'w') as dst:
+                    while True:
+                        chunk = src.read(64 * 1024)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        yield stream.drain()
+                yield stream.drain()
+    yield stream.drain()
+
+@app.route('/download_zip')
+def download_zip():
+    if 'username' not in session:
+        abort(401)
+
+    username = session['username']
+    base_dir = os.path.join(app.config['UPLOAD_FOLDER'], username)
+    abs_path = os.path.join(base_dir, request.args.get('path', ''))
+
+    if not is_sub_path(abs_path, base_dir):
+        abort(403)
+    if not os.path.isdir(abs_path):
+        abort(404)
+
+    zip_name = os.path.basename(os.path.normpath(abs_path)) + '.zip'
+    return Response(iter_zip(abs_path), mimetype='application/zip',
+                    headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(zip_name)}"})
+
 # --------------------------
 # 文件上传路由
 # --------------------------
 @app.route('/upload', methods=['POST'])
+@rate_limited('upload')
 def upload_file():
     if 'username' not in session:
         abort(401)
@@ -334,11 +800,123 @@ def upload_file():
         os.makedirs(upload_dir)
 
     filename = secure_filename(file.filename)
-    save_path = os.path.join(upload_dir, filename)
-    file.save(save_path)
+    if not filename:
+        abort(400)
+    staging_dir = os.path.join(base_dir, '.uploads')
+    os.makedirs(staging_dir, exist_ok=True)
+    part_path = os.path.join(staging_dir, uuid4().hex)
+    try:
+        with open(part_path, 'xb') as f:
+            shutil.copyfileobj(file.stream, f, 64 * 1024)
+            sync_upload_file(f)
+        publish_upload(part_path, upload_dir, filename)
+    except BaseException:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
 
     return 'Success', 200
 
+# --------------------------
+# 分块上传路由：客户端按段加密后分多次追加，最后一块提交时原子改名到目标位置。
+# upload_id 由客户端生成（32 位十六进制），第一块的响应丢失后用同一个 id 重发，
+# 服务器第一次见到它时才创建分块文件，不会产生重复上传或无人认领的分块文件。
+# 偏移量不一致时返回服务器已收到的字节数，客户端据此续传。
+# 最后一块的响应丢失后客户端会重发，此时分块文件已经改名发布，所以完成的上传在进程内
+# 记住 COMPLETED_UPLOAD_TTL 秒，重发时直接返回发布后的文件名。
+# --------------------------
+COMPLETED_UPLOAD_TTL = 600
+completed_uploads = {}  # (用户名, upload_id) -> (过期时刻, 总字节数, 文件名)
+completed_lock = threading.Lock()
+
+def remember_completed_upload(username, upload_id, size, filename):
+    now = time.monotonic()
+    with completed_lock:
+        for stale in [k for k, (expires, _, _) in completed_uploads.items() if expires <= now]:
+            del completed_uploads[stale]
+        completed_uploads[(username, upload_id)] = (now + COMPLETED_UPLOAD_TTL, size, filename)
+
+def completed_upload(username, upload_id):
+    with completed_lock:
+        entry = completed_uploads.get((username, upload_id))
+    if entry is None or entry[0] <= time.monotonic():
+        return None
+    return entry[1], entry[2]
+
+def _sweep_stale_uploads(staging_dir):
+    cutoff = time.time() - app.config['STALE_UPLOAD_AGE']
+    for entry in os.scandir(staging_dir):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                move_to_trash(entry.path)
+        except OSError:
+            pass
+
+@app.route('/upload_chunk', methods=['POST'])
+@rate_limited('upload_chunk')
+def upload_chunk():
+    if 'username' not in session:
+        abort(401)
+
+    chunk = request.files.get('chunk')
+    if chunk is None:
+        abort(400)
+
+    username = session['username']
+    base_dir = os.path.join(app.config['UPLOAD_FOLDER'], username)
+    staging_dir = os.path.join(base_dir, '.uploads')
+    os.makedirs(staging_dir, exist_ok=True)
+
+    try:
+        offset = int(request.form.get('offset', '0'))
+    except ValueError:
+        abort(400)
+    upload_id = request.form.get('upload_id', '')
+    if len(upload_id) != 32 or not all(c in string.hexdigits for c in upload_id):
+        abort(400)
+
+    part_path = os.path.join(staging_dir, upload_id)
+    if not os.path.exists(part_path):
+        done = completed_upload(username, upload_id)
+        if done is not None:
+            return jsonify({'upload_id': upload_id, 'offset': done[0], 'filename': done[1]})
+        if offset != 0:
+            abort(404)
+        _sweep_stale_uploads(staging_dir)
+        try:
+            open(part_path, 'xb').close()
+        except FileExistsError:
+            pass  # 同一个 id 的重发请求刚刚创建了它，下面按偏移量处理
+    received = os.path.getsize(part_path)
+    if offset != received:
+        return jsonify({'upload_id': upload_id, 'offset': received}), 409
+
+    final = request.form.get('final') == '1'
+    with open(part_path, 'ab') as f:
+        shutil.copyfileobj(chunk.stream, f, 64 * 1024)
+        received = f.tell()
+        if final:
+            sync_upload_file(f)
+    if received > app.config['MAX_UPLOAD_FILE_SIZE']:
+        move_to_trash(part_path)
+        return '文件过大', 413
+
+    if final:
+        upload_dir = os.path.join(base_dir, request.form.get('path', ''))
+        filename = secure_filename(request.form.get('filename', ''))
+        if not filename:
+            abort(400)
+        if not is_sub_path(upload_dir, base_dir):
+            abort(403)
+        os.makedirs(upload_dir, exist_ok=True)
+        save_path = publish_upload(part_path, upload_dir, filename)
+        remember_completed_upload(username, upload_id, received, os.path.basename(save_path))
+        return jsonify({'upload_id': upload_id, 'offset': received, 'filename': os.path.basename(save_path)})
+
+    return jsonify({'upload_id': upload_id, 'offset': received})
+
 # --------------------------
 # 创建文件夹路由
 # --------------------------
@@ -456,6 +1034,9 @@ index_template = '''
     #context-menu li, #root-menu li { padding:8px 12px; cursor:pointer;}
     #context-menu li:hover, #root-menu li:hover { background:#ddd;}
     #file-manager { padding:20px;}
+    #batch-bar { margin-bottom:10px; }
+    #batch-bar button { margin-right:6px; }
+    #upload-panel div { font-size:13px; color:#555; }
     a { text-decoration:none; color:#000;}
     a:hover { text-decoration:underline; }
 </style>
@@ -463,10 +1044,15 @@ index_template = '''
 <body>
 <div id="header">
     <span>当前用户：{{ username }}</span>
-    <a href="{{ url_for('logout') }}">退出登录</a>
-    <a href="{{ url_for('delete_account') }}">删除账户</a>
+    <a href="{{ url_for('logout') }}" onclick="forgetMasterKey()">退出登录</a>
+    <a href="{{ url_for('delete_account') }}" onclick="forgetMasterKey()">删除账户</a>
 </div>
 <div id="file-manager">
+<div id="batch-bar">
+<button onclick="batchDelete()">删除所选</button>
+<button onclick="batchMove()">移动所选到…</button>
+</div>
+<div id="upload-panel"></div>
 <ul id="file-list" oncontextmenu="onBlankContextMenu(event)">
 {% if current_path %}
 <li><a href="{{ url_for('dir_listing', req_path=parent_path) }}">⬅ 返回上一级</a></li>
@@ -474,6 +1060,7 @@ index_template = '''
 {% for file in files %}
 <li class="file-item" data-file-path="{{ file.path }}" data-is-file="{{ 'true' if file.is_file else 'false' }}"
  draggable="true" ondragstart="onDragStart(event)" oncontextmenu="onFileContextMenu(event)">
+<input type="checkbox" class="select-item" value="{{ file.path }}" onclick="event.stopPropagation()">
 {% if file.is_file %}
 📄 <span style="color:blue; text-decoration:underline; cursor:pointer;" 
       onclick="downloadFile('{{ url_for('dir_listing', req_path=file.path) }}', '{{ file.name }}')">{{ file.name }}</span>
@@ -489,6 +1076,7 @@ index_template = '''
 <ul>
 <li onclick="renameItem()">重命名</li>
 <li onclick="deleteItem()">删除</li>
+<li onclick="downloadZip(currentItemPath)">打包下载</li>
 </ul>
 </div>
 
@@ -496,6 +1084,7 @@ index_template = '''
 <ul>
 <li onclick="uploadFile()">上传文件</li>
 <li onclick="createFolder()">创建文件夹</li>
+<li onclick="downloadZip(currentPath)">打包下载当前文件夹</li>
 </ul>
 </div>
 
@@ -505,6 +1094,7 @@ let currentItemPath = '';
 let isFile = false;
 const currentPath = "{{ current_path }}";
 const parentPath = "{{ parent_path }}";
+const username = {{ username|tojson }};
 
 let userPassword = null;
 
@@ -516,7 +1106,76 @@ async function askPassword(){
         }
     }
 }
-askPassword();
+
+// --------------------------
+// 会话主密钥：每个会话只跑一次 PBKDF2，得到不可导出的 HKDF 主密钥，只保存在内存里。
+// 为了刷新页面、进入子文件夹后不必重新输入密码，PBKDF2 的结果用服务器为本次登录
+// 生成的随机密钥（keyWrapMasked 还原后）以 AES-GCM 加密后存进 sessionStorage：关闭标签页时
+// 密文随之清除，退出登录后服务器不再下发这个密钥，留下的密文也无法解开。
+// 页面中的密钥和每次随机生成的掩码异或过（前一半是掩码），用之前先还原。
+// 每个文件再用自己的 salt 经 HKDF 派生密钥。
+// --------------------------
+const MASTER_KEY_ITERATIONS = 100000;
+const keyWrapMasked = {{ key_wrap|tojson }};
+let masterKey = null;
+
+// 旧版本把主密钥存在持久的 IndexedDB 里，清理掉
+if(window.indexedDB) indexedDB.deleteDatabase("wnyp-keys");
+
+const toHex = bytes => Array.from(bytes, b => b.toString(16).padStart(2, "0")).join("");
+const fromHex = hex => new Uint8Array(hex.match(/../g).map(h => parseInt(h, 16)));
+
+function wrappingKey(){
+    const masked = fromHex(keyWrapMasked), half = masked.length / 2;
+    const secret = masked.slice(half).map((b, i) => b ^ masked[i]);
+    return crypto.subtle.importKey('raw', secret, 'AES-GCM', false, ['encrypt', 'decrypt']);
+}
+
+function importMasterKey(bits){
+    return crypto.subtle.importKey('raw', bits, 'HKDF', false, ['deriveKey']);
+}
+
+async function loadMasterKey(){
+    const saved = sessionStorage.getItem("wnypMasterKey:" + username);
+    if(!saved) return null;
+    try {
+        const [iv, data] = saved.split(":").map(fromHex);
+        const bits = await crypto.subtle.decrypt({name:'AES-GCM', iv}, await wrappingKey(), data);
+        return await importMasterKey(bits);
+    } catch(e) {
+        // 换了登录会话，旧的密文已经解不开
+        sessionStorage.removeItem("wnypMasterKey:" + username);
+        return null;
+    }
+}
+
+async function saveMasterKey(bits){
+    const iv = crypto.getRandomValues(new Uint8Array(12));
+    const data = await crypto.subtle.encrypt({name:'AES-GCM', iv}, await wrappingKey(), bits);
+    sessionStorage.setItem("wnypMasterKey:" + username, toHex(iv) + ":" + toHex(new Uint8Array(data)));
+}
+
+function forgetMasterKey(){
+    masterKey = null;
+    sessionStorage.removeItem("wnypMasterKey:" + username);
+}
+
+async function ensureMasterKey(){
+    if(masterKey) return masterKey;
+    masterKey = await loadMasterKey();
+    if(masterKey) return masterKey;
+    await askPassword();
+    if(!userPassword) return null;
+    const enc = new TextEncoder();
+    const salt = new Uint8Array(await crypto.subtle.digest('SHA-256', enc.encode("wnyp-master:" + username)));
+    const pwKey = await crypto.subtle.importKey('raw', enc.encode(userPassword), 'PBKDF2', false, ['deriveBits']);
+    const bits = await crypto.subtle.deriveBits(
+        {name:'PBKDF2', salt, iterations:MASTER_KEY_ITERATIONS, hash:'SHA-256'}, pwKey, 256);
+    masterKey = await importMasterKey(bits);
+    await saveMasterKey(bits);
+    return masterKey;
+}
+ensureMasterKey();
 
 function onDragStart(event){
     draggedItem=event.target;
@@ -525,15 +1184,55 @@ function onDragStart(event){
 
 document.addEventListener("dragover", e=>e.preventDefault());
 
+function selectedPaths(){
+    return Array.from(document.querySelectorAll(".select-item:checked")).map(c=>c.value);
+}
+
+// 一次请求提交多个操作，结束后只刷新一次页面
+async function runBatch(operations, atomic){
+    if(operations.length === 0) return;
+    const res = await fetch("/batch", {
+        method:"POST",
+        headers:{"Content-Type":"application/json"},
+        body: JSON.stringify({operations, atomic})
+    });
+    if(!(res.headers.get("Content-Type") || "").includes("json")){
+        alert("操作失败：" + await res.text());
+        return;
+    }
+    const data = await res.json();
+    const failed = data.results.filter(r=>!r.ok);
+    if(failed.length){
+        alert("以下操作失败：\\n" + failed.map(r=>operations[r.index].path + "：" + r.error).join("\\n"));
+    }
+    if(data.committed) location.reload();
+}
+
+function batchDelete(){
+    const paths = selectedPaths();
+    if(paths.length === 0){ alert("请先勾选文件"); return; }
+    if(confirm("确定要删除所选的 " + paths.length + " 项吗？")){
+        runBatch(paths.map(p=>({op:"delete", path:p})), false);
+    }
+}
+
+function batchMove(){
+    const paths = selectedPaths();
+    if(paths.length === 0){ alert("请先勾选文件"); return; }
+    const dest = prompt("移动到的文件夹（相对路径，留空为根目录）", currentPath);
+    if(dest === null) return;
+    runBatch(paths.map(p=>({op:"move", path:p, destination:dest})), true);
+}
+
 document.addEventListener("drop", e=>{
     e.preventDefault();
     const sourcePath = e.dataTransfer.getData("text/plain");
-    const targetPath = currentPath;
-    fetch("/move",
-        {method:"POST",
-        headers:{"Content-Type":"application/json"},
-        body: JSON.stringify({"source":sourcePath,"destination":targetPath})
-    }).then(r=>r.ok?location.reload():r.text().then(t=>alert("移动失败："+t)));
+    // 拖到文件夹上就移动进该文件夹，否则移动到当前目录
+    const folder = e.target.closest ? e.target.closest(".file-item[data-is-file='false']") : null;
+    const targetPath = folder ? folder.dataset.filePath : currentPath;
+    const selected = selectedPaths();
+    const sources = selected.includes(sourcePath) ? selected : [sourcePath];
+    runBatch(sources.filter(p=>p!==targetPath).map(p=>({op:"move", path:p, destination:targetPath})), true);
 });
 
 function onFileContextMenu(e){
@@ -571,6 +1270,15 @@ function deleteItem(){
     }
 }
 
+function downloadZip(path){
+    if(path === currentItemPath && isFile){
+        alert("只能打包下载文件夹");
+        return;
+    }
+    // 压缩包里是加密后的原始文件，需要解密时请逐个下载
+    location.href = "/download_zip?path=" + encodeURIComponent(path);
+}
+
 function renameItem(){
     const newName = prompt("输入新的名称", currentItemPath.split("/").pop());
     if(newName){
@@ -582,93 +1290,365 @@ function renameItem(){
     }
 }
 
-async function uploadFile(){
-    if(!userPassword){await askPassword(); if(!userPassword) return;}
-    const input=document.createElement("input");
-    input.type="file";
-    input.onchange=async function(){
-        const file=input.files[0];
-        if(!file) return;
-
-        const arrayBuffer=await file.arrayBuffer();
-
-        // Web Crypto AES-GCM加密部分
-        const enc = new TextEncoder();
-        const pwKey = await crypto.subtle.importKey('raw', enc.encode(userPassword), 'PBKDF2', false, ['deriveKey']);
-        const salt = crypto.getRandomValues(new Uint8Array(16));
-        const iv = crypto.getRandomValues(new Uint8Array(12));
-        const key = await crypto.subtle.deriveKey(
-            {
-                name:'PBKDF2', salt, iterations:100000, hash:'SHA-256'
-            }, pwKey,
+// --------------------------
+// 分段加密容器（v2）
+// 文件头 36 字节：魔数 "WNYP"、版本、密钥派生方式、段大小、salt(16)、nonce 前缀(8)；
+// 之后是固定大小的明文段，每段用 AES-GCM 独立加密认证。
+// 段 IV = nonce 前缀 + 段序号，附加数据 = 文件头 + 段序号 + 是否最后一段，
+// 这样段被调换、截断或拼到别的文件里都会解密失败。
+// 旧格式（salt(16) + iv(12) + 整体密文）依然可以解密。
+// --------------------------
+const MAGIC = [0x57, 0x4E, 0x59, 0x50];
+const FORMAT_VERSION = 2;
+const KDF_PBKDF2 = 0;
+const KDF_SESSION_HKDF = 1;
+const HEADER_SIZE = 36;
+const SEGMENT_SIZE = 1024 * 1024;
+const TAG_SIZE = 16;
+const SEGMENTS_PER_REQUEST = 8;
+
+// 旧文件和 KDF_PBKDF2 文件仍按文件跑一次 PBKDF2，需要时才询问密码
+async function passwordKey(salt, usages){
+    await askPassword();
+    if(!userPassword) throw new Error("需要密码");
+    const enc = new TextEncoder();
+    const pwKey = await crypto.subtle.importKey('raw', enc.encode(userPassword), 'PBKDF2', false, ['deriveKey']);
+    return crypto.subtle.deriveKey(
+        {name:'PBKDF2', salt, iterations:100000, hash:'SHA-256'},
+        pwKey,
+        {name:'AES-GCM', length:256},
+        false,
+        usages
+    );
+}
+
+function buildHeader(kdf, salt, noncePrefix){
+    const header = new Uint8Array(HEADER_SIZE);
+    header.set(MAGIC, 0);
+    header[4] = FORMAT_VERSION;
+    header[5] = kdf;
+    new DataView(header.buffer).setUint32(8, SEGMENT_SIZE);
+    header.set(salt, 12);
+    header.set(noncePrefix, 28);
+    return header;
+}
+
+function parseHeader(header){
+    for(let i = 0; i < MAGIC.length; i++){
+        if(header[i] !== MAGIC[i]) return null;
+    }
+    return {
+        version: header[4],
+        kdf: header[5],
+        segmentSize: new DataView(header.buffer, header.byteOffset).getUint32(8),
+        salt: header.slice(12, 28),
+        noncePrefix: header.slice(28, 36)
+    };
+}
+
+function segmentIv(noncePrefix, index){
+    const iv = new Uint8Array(12);
+    iv.set(noncePrefix, 0);
+    new DataView(iv.buffer).setUint32(8, index);
+    return iv;
+}
+
+function segmentAad(header, index, isFinal){
+    const aad = new Uint8Array(HEADER_SIZE + 5);
+    aad.set(header, 0);
+    new DataView(aad.buffer).setUint32(HEADER_SIZE, index);
+    aad[HEADER_SIZE + 4] = isFinal ? 1 : 0;
+    return aad;
+}
+
+async function keyForHeader(info, usages){
+    if(info.kdf === KDF_SESSION_HKDF){
+        const base = await ensureMasterKey();
+        if(!base) throw new Error("需要密码");
+        return crypto.subtle.deriveKey(
+            {name:'HKDF', hash:'SHA-256', salt:info.salt, info:new TextEncoder().encode("wnyp-file-v2")},
+            base,
             {name:'AES-GCM', length:256},
             false,
-            ['encrypt']
+            usages
         );
-        const encrypted = await crypto.subtle.encrypt({name:'AES-GCM', iv}, key, arrayBuffer);
+    }
+    if(info.kdf === KDF_PBKDF2) return passwordKey(info.salt, usages);
+    throw new Error("不支持的密钥派生方式");
+}
+
+// 逐段读取并加密文件，依次产出文件头和每个密文段
+async function* encryptFile(file){
+    const salt = crypto.getRandomValues(new Uint8Array(16));
+    const noncePrefix = crypto.getRandomValues(new Uint8Array(8));
+    const header = buildHeader(KDF_SESSION_HKDF, salt, noncePrefix);
+    const key = await keyForHeader(parseHeader(header), ['encrypt']);
+    yield header;
+    const count = Math.max(1, Math.ceil(file.size / SEGMENT_SIZE));
+    for(let i = 0; i < count; i++){
+        const plain = await file.slice(i * SEGMENT_SIZE, (i + 1) * SEGMENT_SIZE).arrayBuffer();
+        const cipher = await crypto.subtle.encrypt(
+            {name:'AES-GCM', iv:segmentIv(noncePrefix, i), additionalData:segmentAad(header, i, i === count - 1)},
+            key, plain);
+        yield new Uint8Array(cipher);
+    }
+}
+
+// 先进先出的字节缓冲，按需取出指定长度，避免反复拼接大数组
+class ByteQueue {
+    constructor(){ this.chunks = []; this.length = 0; }
+    push(chunk){ this.chunks.push(chunk); this.length += chunk.byteLength; }
+    take(n){
+        const out = new Uint8Array(n);
+        let filled = 0;
+        while(filled < n){
+            const head = this.chunks[0];
+            const size = Math.min(head.byteLength, n - filled);
+            out.set(head.subarray(0, size), filled);
+            filled += size;
+            if(size === head.byteLength) this.chunks.shift();
+            else this.chunks[0] = head.subarray(size);
+        }
+        this.length -= n;
+        return out;
+    }
+}
+
+async function decryptLegacy(bytes){
+    if(bytes.byteLength < 28) throw new Error("文件格式错误");
+    const key = await passwordKey(bytes.slice(0, 16), ['decrypt']);
+    const plain = await crypto.subtle.decrypt({name:'AES-GCM', iv:bytes.slice(16, 28)}, key, bytes.slice(28));
+    return new Uint8Array(plain);
+}
+
+// 边下载边解密，每解出一段明文就交给 sink
+async function decryptStream(reader, sink){
+    const queue = new ByteQueue();
+    let done = false;
+    async function fill(min){
+        while(!done && queue.length < min){
+            const r = await reader.read();
+            if(r.done) done = true;
+            else queue.push(r.value);
+        }
+    }
+    await fill(HEADER_SIZE);
+    if(queue.length < HEADER_SIZE) throw new Error("文件格式错误");
+    const header = queue.take(HEADER_SIZE);
+    const info = parseHeader(header);
+    if(!info){
+        // 旧格式只能整体解密
+        await fill(Infinity);
+        const all = new Uint8Array(HEADER_SIZE + queue.length);
+        all.set(header, 0);
+        all.set(queue.take(queue.length), HEADER_SIZE);
+        await sink(await decryptLegacy(all));
+        return;
+    }
+    if(info.version !== FORMAT_VERSION) throw new Error("不支持的文件格式版本");
+    const key = await keyForHeader(info, ['decrypt']);
+    const segmentLength = info.segmentSize + TAG_SIZE;
+    for(let i = 0; ; i++){
+        // 多读一个字节才能判断当前段是不是最后一段
+        await fill(segmentLength + 1);
+        const isFinal = queue.length <= segmentLength;
+        if(queue.length < TAG_SIZE) throw new Error("文件被截断");
+        const cipher = queue.take(isFinal ? queue.length : segmentLength);
+        const plain = await crypto.subtle.decrypt(
+            {name:'AES-GCM', iv:segmentIv(info.noncePrefix, i), additionalData:segmentAad(header, i, isFinal)},
+            key, cipher);
+        await sink(new Uint8Array(plain));
+        if(isFinal) return;
+    }
+}
+
+// --------------------------
+// 上传管理：最多同时上传 UPLOAD_CONCURRENCY 个文件，逐个显示进度；
+// 每个分块请求在网络异常或服务器 5xx 时指数退避重试，被限流时按 Retry-After 等待，全部结束后只刷新一次页面
+// --------------------------
+const UPLOAD_CONCURRENCY = 3;
+const UPLOAD_ATTEMPTS = 4;
+const UPLOAD_THROTTLE_WAITS = 20;  // 429/503 最多等待这么多次
+
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+async function runPool(items, limit, worker){
+    let next = 0;
+    async function lane(){
+        while(next < items.length){
+            const index = next++;
+            await worker(items[index], index);
+        }
+    }
+    await Promise.all(Array.from({length: Math.min(limit, items.length)}, lane));
+}
+
+// 被限流（429）或服务器繁忙（503）时按 Retry-After 等待，这类等待不计入重试次数
+async function withRetry(fn){
+    let throttled = 0;
+    for(let attempt = 0; ; ){
+        try {
+            return await fn();
+        } catch(e) {
+            if(e.retryAfter !== undefined && throttled++ < UPLOAD_THROTTLE_WAITS){
+                await sleep(e.retryAfter + Math.random() * 250);
+                continue;
+            }
+            if(e.fatal || attempt >= UPLOAD_ATTEMPTS - 1) throw e;
+            await sleep(500 * 2 ** attempt++ + Math.random() * 250);
+        }
+    }
+}
+
+function fatalError(message){
+    const err = new Error(message);
+    err.fatal = true;
+    return err;
+}
 
-        // 拼接salt+iv+加密体
-        const totalLength = salt.byteLength + iv.byteLength + encrypted.byteLength;
-        const combined = new Uint8Array(totalLength);
-        combined.set(salt, 0);
-        combined.set(iv, salt.byteLength);
-        combined.set(new Uint8Array(encrypted), salt.byteLength + iv.byteLength);
+function throttledError(res){
+    const err = new Error(res.status === 429 ? "请求过于频繁" : "服务器繁忙");
+    const seconds = parseInt(res.headers.get("Retry-After"), 10);
+    err.retryAfter = (seconds >= 0 ? seconds : 1) * 1000;
+    return err;
+}
+
+// 加密后的总长度可以事先算出，用来显示进度
+function encryptedSize(size){
+    return HEADER_SIZE + size + TAG_SIZE * Math.max(1, Math.ceil(size / SEGMENT_SIZE));
+}
 
-        const blob = new Blob([combined], {type:'application/octet-stream'});
+async function postChunk(formData, expectedOffset){
+    const res = await fetch("/upload_chunk", {method:"POST", body:formData});
+    if(res.status === 409){
+        // 上一次请求其实已经写入成功，只是响应丢了
+        const data = await res.json();
+        if(data.offset === expectedOffset) return data;
+        throw fatalError("服务器偏移量不一致");
+    }
+    if(res.status === 429 || res.status === 503) throw throttledError(res);
+    if(res.status >= 500) throw new Error("服务器错误 " + res.status);
+    if(!res.ok) throw fatalError(await res.text());
+    return res.json();
+}
 
+// 每攒够若干个密文段就追加上传一次，最后一块带 final 标记。
+// upload_id 在这里生成，第一块的响应丢失后重发也是同一个上传
+async function uploadEncrypted(file, path, onProgress){
+    const total = encryptedSize(file.size);
+    const uploadId = toHex(crypto.getRandomValues(new Uint8Array(16)));
+    let offset = 0;
+    let parts = [];
+    async function flush(final){
+        const chunk = new Blob(parts);
         const formData = new FormData();
-        formData.append("file", blob, file.name);
-        formData.append("path", currentPath);
+        formData.append("chunk", chunk, "chunk");
+        formData.append("upload_id", uploadId);
+        formData.append("offset", offset);
+        formData.append("path", path);
+        formData.append("filename", file.name);
+        formData.append("final", final ? "1" : "0");
+        const data = await withRetry(() => postChunk(formData, offset + chunk.size));
+        offset = data.offset;
+        parts = [];
+        onProgress(offset / total);
+    }
+    for await (const part of encryptFile(file)){
+        parts.push(part);
+        if(parts.length >= SEGMENTS_PER_REQUEST) await flush(false);
+    }
+    await flush(true);
+}
 
-        const res = await fetch("/upload", {method:"POST", body:formData});
-        if(res.ok) location.reload();
-        else {
-            const t=await res.text();
-            alert("上传失败：" + t);
+async function uploadFiles(files){
+    const panel = document.getElementById("upload-panel");
+    panel.innerHTML = "";
+    const rows = files.map(f => {
+        const row = document.createElement("div");
+        row.textContent = f.name + "：等待中";
+        panel.appendChild(row);
+        return row;
+    });
+    const failed = [];
+    await runPool(files, UPLOAD_CONCURRENCY, async (file, i) => {
+        const row = rows[i];
+        try {
+            await uploadEncrypted(file, currentPath, p => {
+                row.textContent = file.name + "：" + Math.round(p * 100) + "%";
+            });
+            row.textContent = file.name + "：完成";
+        } catch(e) {
+            row.textContent = file.name + "：失败（" + e.message + "）";
+            failed.push(file.name);
         }
+    });
+    if(failed.length) alert("以下文件上传失败：" + failed.join("、"));
+    location.reload();
+}
+
+async function uploadFile(){
+    if(!await ensureMasterKey()) return;
+    const input=document.createElement("input");
+    input.type="file";
+    input.multiple=true;
+    input.onchange=function(){
+        if(input.files.length) uploadFiles(Array.from(input.files));
     };
     input.click();
 }
 
+// 支持文件系统访问 API 时直接写盘，否则收集成 Blob 交给浏览器保存
+async function openSaveTarget(fileName){
+    if(window.showSaveFilePicker){
+        const handle = await window.showSaveFilePicker({suggestedName:fileName});
+        const writable = await handle.createWritable();
+        return {
+            write: chunk => writable.write(chunk),
+            close: () => writable.close(),
+            abort: () => writable.abort()
+        };
+    }
+    const parts = [];
+    return {
+        write: chunk => { parts.push(chunk); },
+        close: () => {
+            const url = URL.createObjectURL(new Blob(parts));
+            let a = document.createElement("a");
+            a.href = url;
+            a.download = fileName;
+            document.body.appendChild(a);
+            a.click();
+            a.remove();
+            URL.revokeObjectURL(url);
+        },
+        abort: () => {}
+    };
+}
+
 async function downloadFile(fileUrl, fileName){
-    if(!userPassword){await askPassword(); if(!userPassword) return;}
+    if(!await ensureMasterKey()) return;
+    let target;
+    try {
+        target = await openSaveTarget(fileName);
+    } catch(e) {
+        return;  // 用户取消了保存
+    }
     const res = await fetch(fileUrl);
-    if(!res.ok){alert("下载失败"); return;}
-    const arrayBuffer = await res.arrayBuffer();
-
-    if(arrayBuffer.byteLength < 28){
-        alert("文件格式错误");
+    if(!res.ok){
+        await target.abort();
+        alert("下载失败");
         return;
     }
-    const salt = arrayBuffer.slice(0,16);
-    const iv = arrayBuffer.slice(16,28);
-    const data = arrayBuffer.slice(28);
-
-    const enc = new TextEncoder();
-    const pwKey = await crypto.subtle.importKey('raw', enc.encode(userPassword), 'PBKDF2', false, ['deriveKey']);
-    const key = await crypto.subtle.deriveKey(
-        {name:'PBKDF2', salt:new Uint8Array(salt), iterations:100000, hash:'SHA-256'},
-        pwKey,
-        {name:'AES-GCM', length:256},
-        false,
-        ['decrypt']
-    );
-    let decrypted;
     try {
-        decrypted = await crypto.subtle.decrypt({name:'AES-GCM', iv:new Uint8Array(iv)}, key, data);
+        await decryptStream(res.body.getReader(), chunk => target.write(chunk));
+        await target.close();
     } catch(e) {
+        await target.abort();
+        // 可能是输错了密码，清掉缓存的密钥，下次重新询问
+        forgetMasterKey();
+        userPassword = null;
         alert("解密失败，密码错误或文件损坏");
-        return;
     }
-    const blob = new Blob([decrypted]);
-    const url = URL.createObjectURL(blob);
-    let a = document.createElement("a");
-    a.href = url;
-    a.download = fileName;
-    document.body.appendChild(a);
-    a.click();
-    a.remove();
-    URL.revokeObjectURL(url);
 }
 
 function createFolder() {
@@ -692,4 +1672,4 @@ function createFolder() {
 # 运行
 # --------------------------
 if __name__ == '__main__':
-    app.run(debug=True)
+    configure_app().run(debug=True)
@@ -1,10 +1,19 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template_string
+from flask import Flask, request, jsonify, send_from_directory, render_template_string, Response
+from io import RawIOBase
+from urllib.parse import quote
 import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from compression import init_compression
 
 app = Flask(__name__)
 
 # 根目录（文件管理根路径），当前目录下的 'files' 文件夹
 ROOT_DIR = os.path.abspath('files')
+UPLOAD_FSYNC = 'none'  # 上传保存后的刷盘策略：none 交给操作系统；file 刷文件内容；file+dir 再刷目录，断电也不丢已确认的上传
 
 # 保证文件夹存在
 os.makedirs(ROOT_DIR, exist_ok=True)
@@ -17,6 +26,146 @@ def safe_path(req_path):
         raise Exception('非法路径访问')
     return full_path
 
+# 把写好的暂存文件用 os.link 发布为不重名的文件名，重名时依次尝试 "名称 (1).扩展名"……
+# 链接已存在时 os.link 原子地失败，多个请求同时上传同名文件各自得到不同的文件名；正式文件名一出现
+# 就是完整的内容，不会先出现一个空文件。文件系统不支持硬链接（如 FAT）时退回到
+# O_EXCL 占位再改名，这时占位的空文件在改名前短暂可见
+def link_unique(src, directory, filename):
+    name, ext = os.path.splitext(filename)
+    index = 0
+    while True:
+        candidate = filename if index == 0 else f'{name} ({index}){ext}'
+        path = os.path.join(directory, candidate)
+        try:
+            os.link(src, path)
+        except FileExistsError:
+            index += 1
+            continue
+        except OSError:
+            fd, path = reserve_path(directory, filename)
+            os.close(fd)
+            os.replace(src, path)
+            return path
+        os.remove(src)
+        return path
+
+def reserve_path(directory, filename):
+    name, ext = os.path.splitext(filename)
+    index = 0
+    while True:
+        candidate = filename if index == 0 else f'{name} ({index}){ext}'
+        path = os.path.join(directory, candidate)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+            return fd, path
+        except FileExistsError:
+            index += 1
+
+# 先写入同目录下以点开头的临时文件（列表中不显示），写完再改名为不重名的正式文件名，
+# 其他请求不会看到写了一半的文件
+def save_upload(stream, directory, filename):
+    fd, tmp_path = tempfile.mkstemp(prefix='.upload-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(stream, f, 64 * 1024)
+            if UPLOAD_FSYNC in ('file', 'file+dir'):
+                f.flush()
+                os.fsync(f.fileno())
+        save_path = link_unique(tmp_path, directory, filename)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    if UPLOAD_FSYNC == 'file+dir':
+        fsync_dir(directory)
+    return save_path
+
+# 客户端每个上传请求带一个随机的 upload_key，服务器记住最近保存的结果。
+# 响应丢失后客户端重试同一个请求时直接返回上次的结果，不会再保存一份 "名称 (1).扩展名"。
+# 记录只在进程内存中，本脚本按单进程运行
+UPLOAD_KEY_TTL = 600  # 秒
+recent_uploads = {}  # upload_key -> (过期时刻, 保存的文件名列表；None 表示正在保存)
+recent_uploads_lock = threading.Lock()
+
+def claim_upload_key(key):
+    """返回 (是否由本请求保存, 上次保存的文件名列表)"""
+    now = time.monotonic()
+    with recent_uploads_lock:
+        for stale in [k for k, (expires, _) in recent_uploads.items() if expires <= now]:
+            del recent_uploads[stale]
+        if key in recent_uploads:
+            return False, recent_uploads[key][1]
+        recent_uploads[key] = (now + UPLOAD_KEY_TTL, None)
+        return True, None
+
+def finish_upload_key(key, saved):
+    with recent_uploads_lock:
+        if saved is None:
+            recent_uploads.pop(key, None)  # 保存失败，允许重试
+        else:
+            recent_uploads[key] = (time.monotonic() + UPLOAD_KEY_TTL, saved)
+
+def fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # Windows 不能打开目录
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# 本身已经压缩过的格式，打包时直接 STORED，避免白白消耗 CPU
+COMPRESSED_EXTENSIONS = {
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'avif', 'heic',
+    'mp4', 'mov', 'mkv', 'avi', 'webm', 'mp3', 'aac', 'm4a', 'ogg', 'flac',
+    'zip', 'gz', 'bz2', 'xz', '7z', 'rar', 'zst', 'pdf', 'docx', 'xlsx', 'pptx',
+}
+
+# ZIP 流的写入目标，不可 seek，zipfile 会自动改用数据描述符格式
+class ZipStream(RawIOBase):
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+# 边读文件边产出 ZIP 数据块，内存占用与文件夹大小无关
+def iter_zip(folder):
+    stream = ZipStream()
+    top = os.path.dirname(folder)
+    with zipfile.ZipFile(stream, 'w') as zf:
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            files = sorted(f for f in files if not f.startswith('.'))
+            if not dirs and not files:
+                zf.writestr(os.path.relpath(root, top) + '/', b'')
+            for name in files:
+                full_path = os.path.join(root, name)
+                zinfo = zipfile.ZipInfo.from_file(full_path, os.path.relpath(full_path, top))
+                ext = name.rsplit('.', 1)[-1].lower()
+                zinfo.compress_type = zipfile.ZIP_STORED if ext in COMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                with open(full_path, 'rb') as src, zf.open(zinfo, 'w') as dst:
+                    while True:
+                        chunk = src.read(64 * 1024)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        yield stream.drain()
+                yield stream.drain()
+    yield stream.drain()
+
 # 主页面 HTML，集成Bootstrap 5，美化，黑底红字，字体大，开放布局，没有边框
 # 备注：Bootstrap 5 通过 CDN 载入，使用类 container-fluid，p-4 边距，黑底红字主题
 HTML = """
@@ -27,7 +176,7 @@ HTML = """
   <meta name="viewport" content="width=device-width, initial-scale=1">
   <title>文件管理器（黑底红字版）</title>
   <!-- Bootstrap 5 CSS -->
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
+  <link href="{{ asset_url('bootstrap/bootstrap.min.css') }}" rel="stylesheet">
   <style>
     body {
       background-color: #000000;  /* 黑色背景 */
@@ -153,6 +302,9 @@ HTML = """
   <!-- 拖拽上传区域 -->
   <div id="dropZone" class="mb-3" title="将文件拖拽到这里上传">⬇ 拖拽文件到这里上传 ⬇</div>
 
+  <!-- 上传进度 -->
+  <div id="uploadPanel" class="mb-3 fs-6"></div>
+
   <!-- 文件列表显示 -->
   <div id="fileList" class="fs-5" style="word-break:break-word;"></div>
 
@@ -161,7 +313,8 @@ HTML = """
 </div>
 
 <!-- Bootstrap 5 JS Bundle (Popper + Bootstrap) -->
-<script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
+<script src="{{ asset_url('popper/popper.min.js') }}"></script>
+<script src="{{ asset_url('bootstrap/bootstrap.min.js') }}"></script>
 
 <script>
 let currentPath = '';
@@ -211,10 +364,17 @@ function showRootMenu() {
     contextTargetType = null;
     showCustomMenu([
         {text: '新建文件夹', action: createFolder},
-        {text: '上传文件', action: () => uploadInput.click()}
+        {text: '上传文件', action: () => uploadInput.click()},
+        {text: '打包下载当前文件夹', action: () => downloadZip('')}
     ], window.innerWidth/2, window.innerHeight/2);
 }
 
+// 打包下载文件夹（ZIP）
+function downloadZip(name) {
+    const fullPath = name ? (currentPath ? currentPath + '/' + name : name) : currentPath;
+    window.open('/download_zip?path=' + encodeURIComponent(fullPath), '_blank');
+}
+
 // 右键菜单事件，显示菜单
 function showMenu(event, name, type) {
     event.preventDefault();
@@ -226,6 +386,7 @@ function showMenu(event, name, type) {
 
     if(type === 'folder') {
         menuItems.push({text: '打开', action: () => openItem(name, type)});
+        menuItems.push({text: '打包下载', action: () => downloadZip(name)});
         menuItems.push({text: '重命名', action: renameItem});
         menuItems.push({text: '删除', action: deleteItem});
         menuItems.push({text: '上传文件', action: () => {uploadInput.click(); closeMenu();}});
@@ -331,24 +492,117 @@ function createFolder() {
     }
 }
 
-// 文件上传input改变事件
-uploadInput.onchange = () => {
-    if(uploadInput.files.length > 0){
-        let formData = new FormData();
-        for(let f of uploadInput.files){
-            formData.append('files', f);
+// --------------------------
+// 上传管理：最多同时上传 UPLOAD_CONCURRENCY 个文件，逐个显示进度，
+// 网络异常或服务器 5xx 时指数退避重试，429/503 时按 Retry-After 等待，全部结束后只刷新一次列表
+// --------------------------
+const UPLOAD_CONCURRENCY = 4;
+const UPLOAD_ATTEMPTS = 4;
+const UPLOAD_THROTTLE_WAITS = 20;  // 429/503 最多等待这么多次
+
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+async function runPool(items, limit, worker) {
+    let next = 0;
+    async function lane() {
+        while(next < items.length) {
+            const index = next++;
+            await worker(items[index], index);
+        }
+    }
+    await Promise.all(Array.from({length: Math.min(limit, items.length)}, lane));
+}
+
+// 429/503 表示请求没有被处理，按 Retry-After 等待后重发，这类等待不计入重试次数
+async function withRetry(fn) {
+    let throttled = 0;
+    for(let attempt = 0; ; ) {
+        try {
+            return await fn();
+        } catch(e) {
+            if(e.retryAfter !== undefined && throttled++ < UPLOAD_THROTTLE_WAITS) {
+                await sleep(e.retryAfter + Math.random() * 250);
+                continue;
+            }
+            if(e.fatal || attempt >= UPLOAD_ATTEMPTS - 1) throw e;
+            await sleep(500 * 2 ** attempt++ + Math.random() * 250);
         }
-        formData.append('path', currentPath);
-        fetch('/upload', {method: 'POST', body: formData})
-        .then(res => res.json())
-        .then(data => {
-            alert(data.message);
-            listFiles(currentPath);
-            uploadInput.value = '';
-        }).catch(() => alert('上传失败，网络异常'));
     }
 }
 
+// 每个文件生成一个随机的 upload_key，重试时带同一个，服务器据此识别已经保存过的请求
+function uploadKey() {
+    const bytes = crypto.getRandomValues(new Uint8Array(16));
+    return Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// 单个文件一个请求，用 XHR 以便拿到上传进度
+function sendFile(file, path, key, onProgress) {
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhr.open('POST', '/upload');
+        xhr.upload.onprogress = e => { if(e.lengthComputable) onProgress(e.loaded / e.total); };
+        xhr.onload = () => {
+            if(xhr.status === 429 || xhr.status === 503) {
+                const err = new Error(xhr.status === 429 ? '请求过于频繁' : '服务器繁忙');
+                const seconds = parseInt(xhr.getResponseHeader('Retry-After'), 10);
+                err.retryAfter = (seconds >= 0 ? seconds : 1) * 1000;
+                return reject(err);
+            }
+            if(xhr.status >= 500) return reject(new Error('服务器错误 ' + xhr.status));
+            let data = {};
+            try { data = JSON.parse(xhr.responseText); } catch(e) {}
+            if(xhr.status === 200 && data.saved && data.saved.length) return resolve(data);
+            const err = new Error(data.message || ('HTTP ' + xhr.status));
+            err.fatal = true;  // 业务错误，重试也没用
+            reject(err);
+        };
+        xhr.onerror = () => reject(new Error('网络异常'));
+        const formData = new FormData();
+        formData.append('files', file);
+        formData.append('path', path);
+        formData.append('upload_key', key);
+        xhr.send(formData);
+    });
+}
+
+async function uploadFiles(fileList) {
+    const files = Array.from(fileList);
+    if(files.length === 0) return;
+    const path = currentPath;
+    const panel = document.getElementById('uploadPanel');
+    panel.innerHTML = '';
+    const rows = files.map(f => {
+        const row = document.createElement('div');
+        row.textContent = f.name + '：等待中';
+        panel.appendChild(row);
+        return row;
+    });
+    let succeeded = 0;
+    const failed = [];
+    await runPool(files, UPLOAD_CONCURRENCY, async (file, i) => {
+        const row = rows[i];
+        try {
+            const key = uploadKey();
+            await withRetry(() => sendFile(file, path, key, p => {
+                row.textContent = file.name + '：' + Math.round(p * 100) + '%';
+            }));
+            row.textContent = file.name + '：完成';
+            succeeded++;
+        } catch(e) {
+            row.textContent = file.name + '：失败（' + e.message + '）';
+            failed.push(file.name);
+        }
+    });
+    listFiles(currentPath);
+    alert('成功上传 ' + succeeded + ' 个文件' + (failed.length ? '，失败 ' + failed.length + ' 个：' + failed.join('、') : ''));
+}
+
+// 文件上传input改变事件
+uploadInput.onchange = () => {
+    uploadFiles(uploadInput.files).then(() => { uploadInput.value = ''; });
+}
+
 // 拖拽上传事件绑定
 dropZone.ondragover = (e) => {
     e.preventDefault();
@@ -361,20 +615,7 @@ dropZone.ondragleave = (e) => {
 dropZone.ondrop = (e) => {
     e.preventDefault();
     dropZone.classList.remove('dragover');
-    let files = e.dataTransfer.files;
-    if(files.length > 0){
-        let formData = new FormData();
-        for(let f of files){
-            formData.append('files', f);
-        }
-        formData.append('path', currentPath);
-        fetch('/upload', {method: 'POST', body: formData})
-        .then(res => res.json())
-        .then(data => {
-            alert(data.message);
-            listFiles(currentPath);
-        }).catch(() => alert('上传失败，网络异常'));
-    }
+    uploadFiles(e.dataTransfer.files);
 }
 
 // 页面首次加载列出根目录
@@ -384,6 +625,10 @@ listFiles();
 </html>
 """
 
+# 页面和 JSON 按 Accept-Encoding 压缩（安装了 brotli 时优先使用）。Bootstrap 放在
+# static/vendor 下，页面通过带内容指纹的 /assets/<指纹>/<路径> 引用。实现在 compression.py
+init_compression(app)
+
 @app.route('/')
 def index():
     # 渲染主页，集成Bootstrap黑底红字风格
@@ -424,6 +669,20 @@ def download_file():
     except Exception:
         return "非法路径或文件不存在", 403
 
+@app.route('/download_zip')
+def download_zip():
+    # 把指定文件夹打包成 ZIP 流式下载
+    req_path = request.args.get('path', '').strip('/')
+    try:
+        full_path = safe_path(req_path)
+    except Exception:
+        return "非法路径", 403
+    if not os.path.isdir(full_path):
+        return "文件夹未找到", 404
+    zip_name = (os.path.basename(full_path) or 'files') + '.zip'
+    return Response(iter_zip(full_path), mimetype='application/zip',
+                    headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(zip_name)}"})
+
 @app.route('/delete', methods=['POST'])
 def delete_file_or_dir():
     # 删除文件或文件夹
@@ -486,23 +745,35 @@ def upload():
     # 上传文件到当前文件夹
     upload_files = request.files.getlist('files')
     req_path = request.form.get('path', '').strip('/')
+    upload_key = request.form.get('upload_key', '')[:64]
+    if upload_key:
+        claimed, saved = claim_upload_key(upload_key)
+        if not claimed:
+            if saved is None:
+                # 上一次请求还没保存完，稍后再问
+                return jsonify({'message': '同一请求正在处理'}), 503, {'Retry-After': '1'}
+            return jsonify({'message': f'成功上传 {len(saved)} 个文件', 'saved': saved})
+    saved = None
     try:
         upload_dir = safe_path(req_path)
         if not os.path.exists(upload_dir):
             os.makedirs(upload_dir)
-        count = 0
+        saved = []
         for file in upload_files:
             if file and file.filename:
                 # 防止上传文件名包含路径，且避免隐藏文件上传
                 filename = os.path.basename(file.filename)
                 if filename.startswith('.'):
                     continue
-                save_path = os.path.join(upload_dir, filename)
-                file.save(save_path)
-                count += 1
-        return jsonify({'message': f'成功上传 {count} 个文件'})
+                save_path = save_upload(file.stream, upload_dir, filename)
+                saved.append(os.path.basename(save_path))
+        return jsonify({'message': f'成功上传 {len(saved)} 个文件', 'saved': saved})
     except Exception as e:
+        saved = None
         return jsonify({'message': f'上传失败: {e}'})
+    finally:
+        if upload_key:
+            finish_upload_key(upload_key, saved)
 
 if __name__ == '__main__':
     # 运行服务，调试模式开启，0.0.0.0 监听所有网卡 IP 方便局域网访问